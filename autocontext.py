@@ -10,22 +10,374 @@ How to use:
 """
 import argparse
 import glob
+import itertools
+import json
 import os
 import random
 import shutil
 import subprocess
 import sys
+import time
 
 import colorama as col
-import vigra
+import h5py
+import numpy
 
+from core import h5_copy
 from core.ilp import ILP
-from core.ilp import merge_datasets, reshape_tzyxc
-from core.labels import scatter_labels
+from core.ilp import ingest_datasets_parallel, merge_datasets, merge_datasets_parallel, run_jobs_parallel
+from core.ilp import PROB_ENCODINGS, ilastik_export_arguments, recover_virtual_merge
+from core.labels import scatter_labels_sparse
+from core.manifest import Manifest, file_sha1
+from core.pyramid import downsample_dataset, downsample_labels, upsample_probabilities
+from core.pyramid import load_settings as load_pyramid_settings, save_settings as save_pyramid_settings
+from core.resources import lazyflow_environment
+from core.roi import feature_halo, label_boxes, merge_roi_outputs, roi_blocks, write_roi_dataset
+from core.result_cache import ResultCache, dataset_content_sha1, dataset_sha1, project_sha1, result_key
+from core.round_cache import RoundCache, label_subset_sha1
+from core.wavefront import Wavefront
+from core.worker import IlastikWorker, LocalWorker
 from core.ilp_constants import default_export_key
 
 
-def autocontext(ilastik_cmd, project, runs, label_data_nr, weights=None, predict_file=False):
+def merge_progress(names):
+    """Returns a callback for merge_datasets_parallel() that prints the progress of the merge jobs.
+
+    :param names: names of the merged files
+    :return: callback function
+    """
+    finished = [0]
+
+    def callback(index, error, seconds):
+        finished[0] += 1
+        if error is None:
+            print "Merged %s (%d of %d) in %.1f s." % (names[index], finished[0], len(names), seconds)
+        else:
+            print col.Fore.RED + "Merging %s (%d of %d) failed: %s" % (names[index], finished[0], len(names), error) \
+                + col.Fore.RESET
+    return callback
+
+
+def ingest_progress(names):
+    """Returns a callback for ingest_datasets_parallel() that prints the progress and throughput of the ingest jobs.
+
+    :param names: names of the ingested files
+    :return: callback function
+    """
+    finished = [0]
+
+    def callback(index, result, error, seconds):
+        finished[0] += 1
+        if error is None:
+            megabytes = result[3] / float(2**20)
+            print "Copied %s (%d of %d) to the cache: %.1f MB in %.1f s (%.1f MB/s)." \
+                % (names[index], finished[0], len(names), megabytes, seconds, megabytes / max(seconds, 1e-6))
+        else:
+            print col.Fore.RED + "Copying %s (%d of %d) to the cache failed: %s" \
+                % (names[index], finished[0], len(names), error) + col.Fore.RESET
+    return callback
+
+
+def check_merge_errors(names, errors):
+    """Raises an exception if one of the merge jobs failed.
+
+    :param names: names of the merged files
+    :param errors: error messages from merge_datasets_parallel()
+    """
+    failed = [name for name, error in zip(names, errors) if error is not None]
+    if len(failed) > 0:
+        raise Exception("Merging failed for %d file(s): %s" % (len(failed), ", ".join(failed)))
+
+
+def split_labels(project, label_data_nr, runs, weights, label_seed):
+    """Reads the labels of the project and splits them into one subset for each autocontext round.
+
+    Each dataset gets its own random generator that is seeded with the label seed, so the same seed always gives the
+    same label subsets.
+    :param project: the ILP object of the project that holds the labels
+    :param label_data_nr: number of dataset that contains the labels (-1: use all datasets)
+    :param runs: number of runs of the autocontext loop
+    :param weights: weights for the labels
+    :param label_seed: seed of the label subsets
+    :return: list with the dataset numbers and their labels and block slices, list with the label subsets of each
+             dataset
+    """
+    label_count = len(project.label_names)
+    if label_data_nr == -1:
+        blocks_with_slicing = [(i, project.get_labels(i)) for i in xrange(project.labelsets_count)]
+    else:
+        blocks_with_slicing = [(label_data_nr, project.get_labels(label_data_nr))]
+    scattered_labels_list = [scatter_labels_sparse(blocks, label_count, runs, weights,
+                                                   rng=numpy.random.RandomState([label_seed, i]))
+                             for i, (blocks, block_slices) in blocks_with_slicing]
+    return blocks_with_slicing, scattered_labels_list
+
+
+def round_keys(project, blocks_with_slicing, scattered_labels_list, keep_channels, runs, variant="", roi=False):
+    """Returns the keys of the autocontext rounds in the round cache.
+
+    The key of a round is computed from the key of the previous round, the selected features and the label subset of
+    the round. The key of the first round also depends on the content of the (not yet merged) datasets and the merge
+    settings. In the ROI mode, the predicted regions of a round grow with the number of remaining rounds and the last
+    round is not predicted, so the key also depends on the number of remaining rounds.
+    :param project: the ILP object of the project
+    :param blocks_with_slicing: list with the dataset numbers and their labels and block slices
+    :param scattered_labels_list: list with the label subsets of each dataset
+    :param keep_channels: list with the number of raw channels of each dataset
+    :param runs: number of runs of the autocontext loop
+    :param variant: description of the settings that change which parts of the datasets are predicted
+    :param roi: whether only the regions around the labels are predicted, see roi_predict()
+    :return: list with the keys
+    """
+    inputs = [dataset_content_sha1(project.get_data_path(k), project.get_data_key(k), project.block_budget)
+              for k in range(project.data_count)]
+    features = project_sha1(project.project_filename, include=("FeatureSelections",))
+    key = result_key(project.merge_mode + variant, project.compression, keep_channels, list(project.label_names),
+                     *inputs)
+    keys = []
+    for i in range(runs):
+        subset = label_subset_sha1([(k, scattered_labels[i], block_slices)
+                                    for (k, (blocks, block_slices)), scattered_labels
+                                    in zip(blocks_with_slicing, scattered_labels_list)])
+        if roi:
+            key = result_key(key, features, subset, "roi%d" % (runs-1-i) if i+1 < runs else "roi-unpredicted")
+        else:
+            key = result_key(key, features, subset)
+        keys.append(key)
+    return keys
+
+
+def rf_filename(cache_folder, index, runs):
+    """Returns the path of the random forest file that is saved in the given round.
+
+    :param cache_folder: the cache folder
+    :param index: index of the round
+    :param runs: number of runs of the autocontext loop
+    :return: path of the random forest file
+    """
+    return os.path.join(cache_folder, "rf_" + str(index).zfill(len(str(runs-1))) + ".ilp")
+
+
+def roi_files(project, rois, data_nrs):
+    """Returns the files of the regions in the cache folder that are predicted by roi_predict().
+
+    :param project: the ILP object of the project
+    :param rois: list with the regions (block_yielder.BlockWithMargin objects) of each dataset
+    :param data_nrs: numbers of the datasets
+    :return: tuple with the h5 paths and keys of the regions and a dict with the ilastik outputs of each dataset (see
+             merge_roi_outputs())
+    """
+    filenames = []
+    outputs = {}
+    for k in data_nrs:
+        outputs[k] = []
+        for j, block in enumerate(rois[k]):
+            roi_path = os.path.join(project.cache_folder, "roi_%s_%s.h5" % (str(k).zfill(4), str(j).zfill(4)))
+            filenames.append(roi_path + "/" + project.get_data_key(k))
+            outputs[k].append((os.path.splitext(roi_path)[0] + "_probs.h5", default_export_key(), block))
+    return filenames, outputs
+
+
+def roi_predict(ilastik_cmd, project, rois, keep_channels, predict_file=False, worker=None, merge_workers=1,
+                data_nrs=None, before_merge=None):
+    """Predicts the given regions of the datasets and merges the inner blocks of the regions into the datasets.
+
+    Each region is copied into its own file in the cache folder, so ilastik only computes the features of the region.
+    The datasets without regions only get the probability channels (filled with zeros), since all datasets must have
+    the same number of channels.
+    :param ilastik_cmd: path to run_ilastik.sh
+    :param project: the ILP object of the project
+    :param rois: list with the regions (block_yielder.BlockWithMargin objects) of each dataset
+    :param keep_channels: list with the number of raw channels of each dataset
+    :param predict_file: if this is True, the --predict_file option of ilastik is used
+    :param worker: persistent ilastik worker (see core.worker)
+    :param merge_workers: number of processes that merge the ilastik output into the datasets
+    :param data_nrs: numbers of the datasets (default: all datasets)
+    :param before_merge: function that is called with the paths of the ilastik outputs before they are merged
+    """
+    if data_nrs is None:
+        data_nrs = range(project.data_count)
+
+    # Copy the regions into the cache folder.
+    filenames, outputs = roi_files(project, rois, data_nrs)
+    for filename, (k, block) in zip(filenames, [(k, block) for k in data_nrs for block in rois[k]]):
+        roi_path = filename[:-len(os.path.basename(filename))-1]
+        write_roi_dataset(project.get_data_path(k), project.get_data_key(k), block, roi_path, project.block_budget)
+
+    # Predict the regions.
+    voxels = sum(numpy.prod([e - b for b, e in zip(b.outerBlock.begin, b.outerBlock.end)])
+                 for k in data_nrs for b in rois[k])
+    print col.Fore.GREEN + "Predicting %d regions (%d voxels):" % (len(filenames), voxels) + col.Fore.RESET
+    if len(filenames) > 0:
+        project.predict_all_datasets(ilastik_cmd, predict_file=predict_file, worker=worker, filenames=filenames)
+
+    # Merge the inner blocks into the datasets.
+    if before_merge is not None:
+        before_merge([output_path for k in data_nrs for output_path, output_key, block in outputs[k]])
+    roi_merge(project, filenames, outputs, keep_channels, merge_workers=merge_workers, data_nrs=data_nrs)
+
+
+def roi_merge(project, filenames, outputs, keep_channels, merge_workers=1, data_nrs=None):
+    """Merges the inner blocks of the predicted regions into the datasets and removes the files of the regions, see
+    roi_predict().
+
+    :param project: the ILP object of the project
+    :param filenames: the h5 paths and keys of the regions (see roi_files())
+    :param outputs: dict with the ilastik outputs of each dataset (see roi_files())
+    :param keep_channels: list with the number of raw channels of each dataset
+    :param merge_workers: number of processes that merge the ilastik output into the datasets
+    :param data_nrs: numbers of the datasets (default: all datasets)
+    """
+    if data_nrs is None:
+        data_nrs = range(project.data_count)
+
+    print col.Fore.GREEN + "Merging output back into datasets." + col.Fore.RESET
+    label_count = len(project.label_names)
+    jobs = [((project.get_data_path(k), project.get_data_key(k), outputs[k], keep_channels[k], label_count),
+             {"compression": project.compression, "encoding": project.prob_encoding,
+              "block_budget": project.block_budget})
+            for k in data_nrs]
+    errors = run_jobs_parallel(merge_roi_outputs, jobs, workers=merge_workers)[1]
+    check_merge_errors([project.get_data_path_key(k) for k in data_nrs], errors)
+
+    # Remove the regions and their outputs.
+    for filename in filenames:
+        os.remove(filename[:-len(os.path.basename(filename))-1])
+    for lane_outputs in outputs.values():
+        for output_path, output_key, block in lane_outputs:
+            os.remove(output_path)
+
+
+def forest_stack_predict(ilastik_cmd, project, rf_files, data_nrs, keep_channels, predict_file=False, worker=None,
+                         merge_workers=1):
+    """Predicts the given datasets with the saved forests of all rounds, like the batch prediction, and merges the
+    outputs into the datasets.
+
+    :param ilastik_cmd: path to run_ilastik.sh
+    :param project: the ILP object of the project
+    :param rf_files: the saved random forest files
+    :param data_nrs: numbers of the predicted datasets
+    :param keep_channels: list with the number of raw channels of each dataset
+    :param predict_file: if this is True, the --predict_file option of ilastik is used
+    :param worker: persistent ilastik worker (see core.worker)
+    :param merge_workers: number of processes that merge the ilastik output into the datasets
+    """
+    filenames = [project.get_data_path_key(k) for k in data_nrs]
+    stack_file = os.path.join(project.cache_folder, "rf_stack.ilp")
+    for i, rf_file in enumerate(rf_files):
+        print col.Fore.GREEN + "- Predicting the datasets without labels with the forest of round %d of %d -" \
+            % (i+1, len(rf_files)) + col.Fore.RESET
+
+        # Set the lanes of the forest to a predicted dataset to prevent the ilastik error "wrong number of channels".
+        shutil.copyfile(rf_file, stack_file)
+        rf = ILP(stack_file, project.cache_folder, prob_encoding=project.prob_encoding)
+        with rf.transaction():
+            for j in xrange(rf.data_count):
+                rf.set_data_path_key(j, project.get_data_path(data_nrs[0]), project.get_data_key(data_nrs[0]))
+        rf.predict_all_datasets(ilastik_cmd, predict_file=predict_file, worker=worker, filenames=filenames)
+
+        print col.Fore.GREEN + "Merging output back into datasets." + col.Fore.RESET
+        errors = project.merge_outputs_into_datasets(keep_channels, data_nrs=data_nrs, workers=merge_workers,
+                                                     callback=merge_progress(filenames))
+        check_merge_errors(filenames, errors)
+    os.remove(stack_file)
+
+
+def coarse_filename(path):
+    """Returns the path of the downsampled copy of the given h5 file in the pyramid mode.
+
+    :param path: path to the h5 file
+    :return: path of the downsampled copy
+    """
+    return os.path.join(os.path.dirname(path), "coarse_" + os.path.basename(path))
+
+
+def downsample_datasets(files, keep_channels, factor, compression=None, resizable=False,
+                        block_budget=h5_copy.DEFAULT_BLOCK_BUDGET, workers=1):
+    """Creates the downsampled copies of the raw channels of the datasets for the coarse rounds of the pyramid mode.
+
+    :param files: h5 paths with keys of the datasets
+    :param keep_channels: list with the number of raw channels of each dataset
+    :param factor: downsampling factor of the axes z, y and x
+    :param compression: the compression
+    :param resizable: whether the channel axis of the copies can be resized
+    :param block_budget: maximum number of bytes per block
+    :param workers: number of worker processes
+    :return: h5 paths with keys of the downsampled copies
+    """
+    coarse_files = []
+    jobs = []
+    for filename, n in zip(files, keep_channels):
+        key = os.path.basename(filename)
+        path = filename[:-len(key)-1]
+        coarse_files.append(coarse_filename(path) + "/" + key)
+        jobs.append(((path, key, coarse_filename(path), key, factor, n),
+                     {"compression": compression, "resizable": resizable, "block_budget": block_budget}))
+    print col.Fore.GREEN + "Downsampling the datasets by %d for the coarse rounds." % factor + col.Fore.RESET
+    errors = run_jobs_parallel(downsample_dataset, jobs, workers=workers)[1]
+    failed = [filename for filename, error in zip(files, errors) if error is not None]
+    if len(failed) > 0:
+        raise Exception("Downsampling failed for %d file(s): %s" % (len(failed), ", ".join(failed)))
+    return coarse_files
+
+
+def upsample_into_datasets(coarse_files, files, keep_channels, factor, compression=None, mode="copy", encoding="raw",
+                           block_budget=h5_copy.DEFAULT_BLOCK_BUDGET, workers=1):
+    """Upsamples the probabilities of the last coarse round of the pyramid mode and merges them into the full
+    resolution datasets, so the following rounds get them as input.
+
+    :param coarse_files: h5 paths with keys of the downsampled datasets
+    :param files: h5 paths with keys of the full resolution datasets
+    :param keep_channels: list with the number of raw channels of each dataset
+    :param factor: downsampling factor of the axes z, y and x
+    :param compression: the compression
+    :param mode: the merge mode
+    :param encoding: the encoding of the probabilities
+    :param block_budget: maximum number of bytes per block
+    :param workers: number of worker processes
+    """
+    print col.Fore.GREEN + "Upsampling the probabilities of the coarse rounds." + col.Fore.RESET
+    upsample_jobs = []
+    merge_jobs = []
+    for coarse_file, filename, n in zip(coarse_files, files, keep_channels):
+        coarse_key = os.path.basename(coarse_file)
+        coarse_path = coarse_file[:-len(coarse_key)-1]
+        key = os.path.basename(filename)
+        path = filename[:-len(key)-1]
+        output_path = os.path.splitext(coarse_path)[0] + "_upsampled.h5"
+        upsample_jobs.append(((coarse_path, coarse_key, path, key, n, output_path, default_export_key(), factor),
+                              {"encoding": encoding, "block_budget": block_budget}))
+        merge_jobs.append(((path, key, output_path, default_export_key()),
+                           {"n": n, "compression": compression, "mode": mode, "encoding": encoding,
+                            "block_budget": block_budget}))
+    errors = run_jobs_parallel(upsample_probabilities, upsample_jobs, workers=workers)[1]
+    check_merge_errors(files, errors)
+    errors = merge_datasets_parallel(merge_jobs, workers=workers, callback=merge_progress(files))
+    check_merge_errors(files, errors)
+    for (path, key, output_path, output_key), kwargs in merge_jobs:
+        if os.path.isfile(output_path):
+            os.remove(output_path)
+
+
+def summarize_changes(changes):
+    """Combines the probability changes of all datasets (see ILP.probability_changes()).
+
+    :param changes: list with the results of ILP.probability_changes()
+    :return: dict with the mean absolute change of each class and the fraction of voxels whose most probable class
+             changed; None if the datasets had no probabilities yet
+    """
+    changes = [c for c in changes if c is not None]
+    if len(changes) == 0:
+        return None
+    abs_sums = sum(c[0] for c in changes)
+    flips = sum(c[1] for c in changes)
+    voxels = float(sum(c[2] for c in changes))
+    return {"mean_abs_change": [float(x) for x in abs_sums / voxels], "flip_fraction": flips / voxels}
+
+
+def autocontext(ilastik_cmd, project, runs, label_data_nr, weights=None, predict_file=False, merge_workers=1,
+                worker=None, fused=False, resume=False, round_cache=None, converge_threshold=None, flip_threshold=None,
+                time_budget=None, roi=False, skip_unlabelled=False, coarse_rounds=0, downsample=2):
     """Trains and predicts the ilastik project using the autocontext method.
 
     The parameter weights can be used to take different amounts of the labels in each loop run.
@@ -39,8 +391,50 @@ def autocontext(ilastik_cmd, project, runs, label_data_nr, weights=None, predict
     :param label_data_nr: number of dataset that contains the labels (-1: use all datasets)
     :param weights: weights for the labels
     :param predict_file: if this is True, the --predict_file option of ilastik is used
+    :param merge_workers: number of processes that merge the ilastik output into the datasets
+    :param worker: persistent ilastik worker (see core.worker) that is used instead of starting ilastik in each round
+    :param fused: if this is True, the project is retrained and all datasets are predicted in a single ilastik call, as
+                  long as the ilastik version supports this
+    :param resume: if this is True, the training continues after the last finished round that is stored in the
+                   manifest in the cache folder
+    :param round_cache: RoundCache object; the longest prefix of rounds that is stored in the round cache is reused
+                        and the new rounds are stored
+    :param converge_threshold: the training stops early if the mean absolute change of the probabilities of each
+                               class in a round is below this threshold
+    :param flip_threshold: the training stops early if the fraction of voxels whose most probable class changed in a
+                           round is below this threshold
+    :param time_budget: the training stops after the first round that ends later than time_budget seconds after the
+                        start
+    :param roi: if this is True, the intermediate rounds only predict the regions around the labels (grown by the
+                size of the feature filters) and the last round is not predicted; use the batch prediction to predict
+                the whole datasets
+    :param skip_unlabelled: if this is True, the datasets without labels are not predicted in the training rounds, but
+                            with the saved forests after the training
+    :param coarse_rounds: number of rounds that run on copies of the datasets and labels that are downsampled by the
+                          given factor; their probabilities are upsampled into the datasets before the full resolution
+                          rounds, which must include at least the last round
+    :param downsample: downsampling factor of the axes z, y and x in the coarse rounds
+    :return: number of rounds that were not computed, since they were restored from the round cache or finished before
+             the training was resumed
+    :rtype: int
     """
     assert isinstance(project, ILP)
+    start_time = time.time()
+    check_convergence = converge_threshold is not None or flip_threshold is not None
+    if roi and (fused or check_convergence or project.merge_mode == "virtual"):
+        raise Exception("The ROI prediction cannot be combined with fused calls, the convergence check or the merge "
+                        "mode virtual.")
+    if project.prob_encoding != "raw" and project.merge_mode != "virtual":
+        raise Exception("The probability encoding %s requires the merge mode virtual, since the merged datasets of the "
+                        "other modes store the probabilities in the dtype of the data." % project.prob_encoding)
+    if coarse_rounds > 0:
+        if coarse_rounds >= runs:
+            raise Exception("The number of coarse rounds must be smaller than the number of runs.")
+        if downsample < 2:
+            raise Exception("The downsampling factor must be at least 2.")
+        if roi or skip_unlabelled or round_cache is not None:
+            raise Exception("The coarse rounds cannot be combined with the ROI prediction, skipped datasets or the "
+                            "round cache.")
 
     # Create weights if none were given.
     if weights is None:
@@ -49,57 +443,311 @@ def autocontext(ilastik_cmd, project, runs, label_data_nr, weights=None, predict
         raise Exception("The number of weights must not be smaller than the number of runs.")
     weights = weights[:runs]
 
-    # Copy the raw data to the output folder and reshape it to txyzc.
-    project.extend_data_tzyxc()
+    manifest = Manifest(os.path.join(project.cache_folder, "manifest.json"))
+    labels_file = os.path.join(project.cache_folder, "labels.ilp")
+    settings = {"project": os.path.abspath(project.project_filename),
+                "runs": runs,
+                "label_data_nr": label_data_nr,
+                "weights": list(weights),
+                "coarse_rounds": coarse_rounds,
+                "downsample": downsample if coarse_rounds > 0 else None,
+                "prob_encoding": project.prob_encoding}
+    resumed = resume and manifest.exists
+    if resume and not manifest.exists:
+        print "No manifest found in the cache folder, starting the training from the first round."
+    if resumed:
+        # Check that the last finished round can be continued.
+        for key, value in settings.items():
+            if manifest.settings.get(key) != value:
+                raise Exception("Cannot resume the training: The setting %s differs from %s." % (key, manifest.path))
+        if file_sha1(labels_file) != manifest.settings["labels_sha1"]:
+            raise Exception("Cannot resume the training: %s was modified." % labels_file)
+        start_round = len(manifest.rounds)
+        merging = manifest.merging
+        if start_round > 0:
+            # The datasets of an interrupted merge are checked when the merge is redone.
+            problems = manifest.check_round(start_round-1, exclude=merging["datasets"] if merging is not None else ())
+            if len(problems) > 0:
+                raise Exception("Cannot resume the training: %s." % ", ".join(problems))
+        print "Resuming the training after round %d of %d." % (start_round, runs)
+        if manifest.stopped is not None:
+            print "The training was stopped after round %d: %s" % (start_round, manifest.stopped)
+            start_round = runs
+        keep_channels = manifest.settings["keep_channels"]
+        label_seed = manifest.settings["label_seed"]
+        label_project = ILP(labels_file, project.cache_folder)
+    else:
+        # Copy the raw data to the output folder and reshape it to txyzc.
+        start_round = 0
+        merging = None
+        project.extend_data_tzyxc()
+
+        # Get the current number of channels in the datasets.
+        # The data in those channels is left unchanged when the ilastik output is merged back.
+        keep_channels = [project.get_channel_count(i) for i in range(project.data_count)]
+
+        # Save the original labels, so the training can be resumed.
+        label_seed = random.getrandbits(32)
+        project.save(labels_file, remove_internal_data=True)
+        label_project = project
 
     # Get the number of datasets.
     data_count = project.data_count
 
-    # Get the current number of channels in the datasets.
-    # The data in those channels is left unchanged when the ilastik output is merged back.
-    keep_channels = [project.get_channel_count(i) for i in range(data_count)]
-
-    # Read the labels from the first block and split them into parts, so not all labels are used in each loop.
-    label_count = len(project.label_names)
-    if label_data_nr == -1:
-        blocks_with_slicing = [(i, project.get_labels(i)) for i in xrange(project.labelsets_count)]
-    else:
-        blocks_with_slicing = [(label_data_nr, project.get_labels(label_data_nr))]
-    scattered_labels_list = [scatter_labels(blocks, label_count, runs, weights)
-                             for i, (blocks, block_slices) in blocks_with_slicing]
+    # Read the labels and split them into parts, so not all labels are used in each loop.
+    blocks_with_slicing, scattered_labels_list = split_labels(label_project, label_data_nr, runs, weights, label_seed)
+
+    # Get the datasets of the lanes from the saved original project, since the lanes of the project may be redirected.
+    lane_project = ILP(labels_file, project.cache_folder)
+    datasets = [(lane_project.get_data_path(k), lane_project.get_data_key(k)) for k in range(data_count)]
+
+    # Find the datasets without labels. They cannot change the trained forests, so they are skipped in the training
+    # rounds and predicted with the saved forests afterwards.
+    unlabelled = []
+    if skip_unlabelled:
+        labelled = [k for k in range(data_count) if any(numpy.any(b) for b in lane_project.get_labels(k)[0])]
+        if len(labelled) > 0:
+            unlabelled = [k for k in range(data_count) if k not in labelled]
+    lanes = [k for k in range(data_count) if k not in unlabelled]
+
+    # Compute the keys of the rounds in the round cache. A resumed training takes the keys from the manifest, since the
+    # datasets were already merged.
+    keys = None
+    if round_cache is not None:
+        if resumed:
+            keys = manifest.settings.get("round_keys")
+            if keys is None:
+                print col.Fore.YELLOW + "The resumed training was started without a round cache, so the round cache " \
+                                        "is not used." + col.Fore.RESET
+        else:
+            variant = ("+roi" if roi else "") + ("+skip%s" % unlabelled if len(unlabelled) > 0 else "") \
+                + ("+" + project.prob_encoding if project.prob_encoding != "raw" else "")
+            keys = round_keys(project, blocks_with_slicing, scattered_labels_list, keep_channels, runs, variant,
+                              roi=roi)
+
+    # Start the manifest, so the training can be resumed.
+    if not resumed:
+        manifest.start(dict(settings, keep_channels=keep_channels, label_seed=label_seed,
+                            labels_sha1=file_sha1(labels_file), round_keys=keys))
+
+    # Reuse the longest prefix of rounds that is stored in the round cache. The lanes of the restored project files are
+    # set to the datasets of this training.
+    if keys is not None and not resumed:
+        while start_round < runs and round_cache.has(keys[start_round]):
+            start_round += 1
+        if start_round > 0:
+            print col.Fore.GREEN + "Reusing %d of %d rounds from the round cache." % (start_round, runs) \
+                + col.Fore.RESET
+            for i in range(start_round):
+                filename = rf_filename(project.cache_folder, i, runs)
+                last = i == start_round-1
+                round_cache.restore(keys[i], filename, project.project_filename if last else None,
+                                    [path for path, key in datasets] if last else [])
+                ILP(filename, project.cache_folder).set_data_paths_from(lane_project)
+            project.invalidate_metadata()
+            project.set_data_paths_from(lane_project)
+            for i in range(start_round):
+                manifest.finish_round(rf_filename(project.cache_folder, i, runs), datasets, label_seed)
+
+    # Create the downsampled copies of the datasets and the project for the coarse rounds. Its lanes are set to the
+    # copies and its labels are replaced by the downsampled label subsets in each coarse round.
+    save_pyramid_settings(project.cache_folder, coarse_rounds, downsample)
+    coarse = None
+    coarse_datasets = []
+    if start_round < coarse_rounds:
+        coarse_file = os.path.join(project.cache_folder, "coarse.ilp")
+        if not resumed or start_round == 0:
+            lane_project.save(coarse_file, remove_labels=True, remove_internal_data=True)
+            downsample_datasets([path + "/" + key for path, key in datasets], keep_channels, downsample,
+                                compression=project.compression, resizable=project.merge_mode == "inplace",
+                                block_budget=project.block_budget, workers=merge_workers)
+        coarse = ILP(coarse_file, project.cache_folder, project.compression, project.merge_mode, project.block_budget,
+                     project.prob_encoding)
+        coarse_datasets = [(coarse_filename(path), key) for path, key in datasets]
+        with coarse.transaction():
+            for k, (path, key) in enumerate(coarse_datasets):
+                coarse.set_data_path_key(k, path, key)
+
+    # Redirect the lanes without labels to a dataset with labels, so all lanes have the same number of channels.
+    if len(unlabelled) > 0:
+        print "Skipping %d of %d datasets without labels in the training rounds." % (len(unlabelled), data_count)
+        with project.transaction():
+            for k in unlabelled:
+                project.set_data_path_key(k, *datasets[lanes[0]])
+
+    # Find the regions around the labels.
+    if roi:
+        halo = feature_halo(project.project_filename)
+        boxes = [[] for k in range(data_count)]
+        for k, (blocks, block_slices) in blocks_with_slicing:
+            boxes[k] = label_boxes(blocks, block_slices)
+        shapes = []
+        for k in range(data_count):
+            with h5py.File(project.get_data_path(k), "r") as f:
+                shapes.append(f[project.get_data_key(k)].shape[:-1])
 
     # Do the autocontext loop.
-    for i in range(runs):
+    skipped_rounds = start_round
+    for i in range(start_round, runs):
         print col.Fore.GREEN + "- Running autocontext training round %d of %d -" % (i+1, runs) + col.Fore.RESET
 
-        # Insert the subset of the labels into the project.
-        for (k, (blocks, block_slices)), scattered_labels in zip(blocks_with_slicing, scattered_labels_list):
-            split_blocks = scattered_labels[i]
-            project.replace_labels(k, split_blocks, block_slices)
-
-        # Retrain the project.
-        print col.Fore.GREEN + "Retraining:" + col.Fore.RESET
-        project.retrain(ilastik_cmd)
-
-        # Save the project so it can be used in the batch prediction.
-        filename = "rf_" + str(i).zfill(len(str(runs-1))) + ".ilp"
-        filename = os.path.join(project.cache_folder, filename)
-        print col.Fore.GREEN + "Saving the project to " + filename + col.Fore.RESET
-        project.save(filename, remove_labels=True, remove_internal_data=True)
-
-        # Predict all datasets.
-        print col.Fore.GREEN + "Predicting all datasets:" + col.Fore.RESET
-        project.predict_all_datasets(ilastik_cmd, predict_file=predict_file)
+        # The coarse rounds train and predict the downsampled copies of the datasets.
+        round_project = coarse if i < coarse_rounds else project
+        round_datasets = coarse_datasets if i < coarse_rounds else datasets
+        filename = rf_filename(project.cache_folder, i, runs)
+
+        # Get the datasets that are modified by the merge of this round.
+        merge_targets = [round_datasets[k] for k in lanes] + (datasets if i+1 == coarse_rounds else [])
+
+        change = None
+        merged = []
+        if i == start_round and merging is not None:
+            # Redo the interrupted merge with the saved forest and the ilastik outputs of this round. Outputs that
+            # were moved by the virtual merge mode are moved back.
+            print col.Fore.YELLOW + "Redoing the interrupted merge of round %d." % (i+1) + col.Fore.RESET
+            change = merging["change"]
+            if roi:
+                rois = [roi_blocks(shapes[k], boxes[k], halo, runs-1-i) for k in range(data_count)]
+                roi_filenames, roi_outputs = roi_files(project, rois, lanes)
+            else:
+                merged = round_project.recover_merges(lanes)
+            if i+1 == coarse_rounds and project.merge_mode == "virtual":
+                for path, key in datasets:
+                    recover_virtual_merge(path, key)
+            problems = manifest.check_merge([round_project.get_output_data_path(k) for k in merged])
+            if len(problems) > 0:
+                raise Exception("Cannot resume the training: %s." % ", ".join(problems))
+            if roi:
+                roi_merge(project, roi_filenames, roi_outputs, keep_channels, merge_workers=merge_workers,
+                          data_nrs=lanes)
+        else:
+            # Insert the subset of the labels into the project.
+            for (k, (blocks, block_slices)), scattered_labels in zip(blocks_with_slicing, scattered_labels_list):
+                split_blocks = scattered_labels[i]
+                if i < coarse_rounds:
+                    round_project.replace_labels(k, *downsample_labels(split_blocks, block_slices, downsample))
+                else:
+                    round_project.replace_labels(k, split_blocks, block_slices)
+
+            # Retrain the project and predict all datasets in one call.
+            predicted = False
+            if fused:
+                print col.Fore.GREEN + "Retraining and predicting all datasets:" + col.Fore.RESET
+                predicted = round_project.retrain_and_predict_all_datasets(ilastik_cmd, predict_file=predict_file,
+                                                                           worker=worker, data_nrs=lanes)
+                if not predicted:
+                    print col.Fore.YELLOW + "ilastik did not export the predictions together with the retraining, " \
+                                            "using separate calls from now on." + col.Fore.RESET
+                    fused = False
+
+            # Retrain the project.
+            if not predicted:
+                print col.Fore.GREEN + "Retraining:" + col.Fore.RESET
+                round_project.retrain(ilastik_cmd, worker=worker)
+
+            # Save the project so it can be used in the batch prediction.
+            print col.Fore.GREEN + "Saving the project to " + filename + col.Fore.RESET
+            round_project.save(filename, remove_labels=True, remove_internal_data=True)
+
+            # Predict and merge only the regions around the labels. The last round is not needed for the training.
+            if roi:
+                if i+1 < runs:
+                    rois = [roi_blocks(shapes[k], boxes[k], halo, runs-1-i) for k in range(data_count)]
+                    roi_predict(ilastik_cmd, project, rois, keep_channels, predict_file=predict_file, worker=worker,
+                                merge_workers=merge_workers, data_nrs=lanes,
+                                before_merge=lambda outputs: manifest.start_merge(filename, merge_targets, outputs))
+                else:
+                    print "The last round is not predicted, use the batch prediction to predict the datasets."
+
+            # Predict all datasets.
+            if not predicted and not roi:
+                print col.Fore.GREEN + "Predicting all datasets:" + col.Fore.RESET
+                round_project.predict_all_datasets(ilastik_cmd, predict_file=predict_file, worker=worker,
+                                                   filenames=[round_project.get_data_path_key(k) for k in lanes])
+
+            # Compare the new probabilities with the ones of the previous round before they are overwritten.
+            if check_convergence:
+                change = summarize_changes(round_project.probability_changes(keep_channels, data_nrs=lanes,
+                                                                             workers=merge_workers))
+                if change is not None:
+                    print "Mean absolute change of the probabilities: %s, changed labels: %.4f%%" \
+                        % (", ".join("%.4f" % x for x in change["mean_abs_change"]), 100 * change["flip_fraction"])
+
+            # Store the merge marker, so an interrupted merge can be redone by a resumed training.
+            if not roi:
+                manifest.start_merge(filename, merge_targets, [round_project.get_output_data_path(k) for k in lanes],
+                                     change)
 
         # Merge the probabilities back into the datasets.
-        print col.Fore.GREEN + "Merging output back into datasets." + col.Fore.RESET
-        for k in range(data_count):
-            project.merge_output_into_dataset(k, keep_channels[k])
+        if not roi:
+            print col.Fore.GREEN + "Merging output back into datasets." + col.Fore.RESET
+            merge_lanes = [k for k in lanes if k not in merged]
+            names = [round_project.get_data_path_key(k) for k in merge_lanes]
+            errors = round_project.merge_outputs_into_datasets(keep_channels, data_nrs=merge_lanes,
+                                                               workers=merge_workers, callback=merge_progress(names))
+            check_merge_errors(names, errors)
+
+        # Store the round in the round cache.
+        if keys is not None:
+            round_cache.store(keys[i], filename, project.project_filename, [path for path, key in datasets])
+
+        # Upsample the probabilities of the last coarse round into the full resolution datasets.
+        if i+1 == coarse_rounds:
+            upsample_into_datasets([path + "/" + key for path, key in coarse_datasets],
+                                   [path + "/" + key for path, key in datasets], keep_channels, downsample,
+                                   compression=project.compression, mode=project.merge_mode,
+                                   encoding=project.prob_encoding, block_budget=project.block_budget,
+                                   workers=merge_workers)
+            round_datasets = coarse_datasets + datasets
+
+        # Mark the round as finished.
+        manifest.finish_round(filename, round_datasets, label_seed, change)
+
+        # Stop if the probabilities converged or the time is up. The forests of the skipped rounds are removed, so the
+        # cache folder holds a complete forest stack for the batch prediction. The training does not stop before the
+        # first full resolution round.
+        stop_reason = None
+        if change is not None and \
+                (converge_threshold is None or max(change["mean_abs_change"]) < converge_threshold) and \
+                (flip_threshold is None or change["flip_fraction"] < flip_threshold):
+            stop_reason = "the probabilities converged"
+        elif time_budget is not None and time.time() - start_time > time_budget:
+            stop_reason = "the time budget is exhausted"
+        if stop_reason is not None and coarse_rounds <= i < runs-1:
+            print col.Fore.YELLOW + "Stopping the training after round %d of %d, since %s." \
+                % (i+1, runs, stop_reason) + col.Fore.RESET
+            for j in range(i+1, runs):
+                if os.path.isfile(rf_filename(project.cache_folder, j, runs)):
+                    os.remove(rf_filename(project.cache_folder, j, runs))
+            manifest.stop(stop_reason)
+            break
 
     # Insert the original labels back into the project.
     for k, (blocks, block_slices) in blocks_with_slicing:
         project.replace_labels(k, blocks, block_slices)
 
+    # Restore the lanes without labels and predict them with the saved forests. In the ROI mode, the datasets are not
+    # predicted after the training, so they only get the probability channels.
+    if len(unlabelled) > 0:
+        with project.transaction():
+            for k in unlabelled:
+                project.set_data_path_key(k, *datasets[k])
+        if not manifest.has_flag("unlabelled_predicted"):
+            if roi:
+                jobs = [((project.get_data_path(k), project.get_data_key(k), [], keep_channels[k],
+                          len(project.label_names)), {"compression": project.compression,
+                                                      "encoding": project.prob_encoding,
+                                                      "block_budget": project.block_budget})
+                        for k in unlabelled]
+                errors = run_jobs_parallel(merge_roi_outputs, jobs, workers=merge_workers)[1]
+                check_merge_errors([project.get_data_path_key(k) for k in unlabelled], errors)
+            else:
+                rf_files = [rf_filename(project.cache_folder, j, runs) for j in range(len(manifest.rounds))]
+                forest_stack_predict(ilastik_cmd, project, rf_files, unlabelled, keep_channels,
+                                     predict_file=predict_file, worker=worker, merge_workers=merge_workers)
+            manifest.set_flag("unlabelled_predicted", [datasets[k] for k in unlabelled])
+    return skipped_rounds
+
 
 def autocontext_forests(dirname):
     """Open the ilastik random forests from the given trained autocontext.
@@ -134,6 +782,13 @@ def batch_predict(args, ilastik_args):
     rf_files = autocontext_forests(args.batch_predict)
     n = len(rf_files)
 
+    # The first rounds of a training in the pyramid mode run on downsampled copies of the files.
+    coarse_rounds, downsample = load_pyramid_settings(args.batch_predict)
+    if coarse_rounds >= n:
+        raise Exception("The training has %d coarse rounds, but only %d forests." % (coarse_rounds, n))
+    if coarse_rounds > 0 and args.wavefront:
+        raise Exception("The wavefront prediction does not support the coarse rounds of the pyramid mode.")
+
     # Get the output format arguments.
     default_output_format = "hdf5"
     default_output_filename_format = os.path.join(args.cache, "{nickname}_probs.h5")
@@ -149,39 +804,68 @@ def batch_predict(args, ilastik_args):
         output_filename_formats = [default_output_filename_format] * (n-1) + [format_args.output_filename_format]
     output_internal_paths = [default_export_key()] * (n-1) + [format_args.output_internal_path]
 
+    # Look up the files in the result cache. Cached results are linked to the output and the files are not predicted.
+    result_cache = None
+    result_keys = []
+    if args.result_cache is not None:
+        if format_args.output_format != "hdf5" or "{" in format_args.output_filename_format.replace("{nickname}", ""):
+            print col.Fore.YELLOW + "The result cache only supports the output format hdf5 with the placeholder " \
+                                    "{nickname}, so it is not used." + col.Fore.RESET
+        else:
+            max_bytes = int(args.result_cache_size * 2**20) if args.result_cache_size > 0 else None
+            result_cache = ResultCache(args.result_cache, max_bytes)
+            forests_sha1 = result_key(*[project_sha1(rf_file) for rf_file in rf_files])
+            remaining_files = []
+            for filename in args.files:
+                output_path = format_args.output_filename_format.replace("{nickname}", nickname(filename))
+                key = result_key(dataset_sha1(filename, args.block_budget), forests_sha1,
+                                 format_args.output_internal_path, args.merge_mode,
+                                 *([coarse_rounds, downsample] if coarse_rounds > 0 else []) +
+                                 ([args.prob_encoding] if args.prob_encoding != "raw" else []))
+                if result_cache.get(key, output_path):
+                    print "Linked the cached result of %s to %s." % (filename, output_path)
+                else:
+                    # Remove the old output, since it may be a hard link to a cached result.
+                    if os.path.isfile(output_path):
+                        os.remove(output_path)
+                    remaining_files.append(filename)
+                    result_keys.append((key, output_path))
+            print "Found %d of %d results in the result cache." % (len(args.files)-len(remaining_files),
+                                                                     len(args.files))
+            if len(remaining_files) == 0:
+                return
+            args.files = remaining_files
+
+    # Load the state of a previous wavefront run. Files that were already started in that run are not copied again.
+    wavefront = None
+    indices = range(len(args.files))
+    if args.wavefront:
+        wavefront = Wavefront(os.path.join(args.cache, "wavefront.json"), args.files, n)
+        indices = [i for i in indices if not wavefront.started(i)]
+        if len(indices) < len(args.files):
+            print "Resuming %d of %d files from a previous run." % (len(args.files)-len(indices), len(args.files))
+
     # Reshape the data to tzyxc and move it to the cache folder.
+    jobs = [((args.files[i], args.cache), {"compression": args.compression, "resizable": args.merge_mode == "inplace",
+                                           "block_budget": args.block_budget})
+            for i in indices]
+    names = [args.files[i] for i in indices]
+    ingest_results, errors = ingest_datasets_parallel(jobs, workers=args.ingest_workers, callback=ingest_progress(names))
+    failed = [name for name, error in zip(names, errors) if error is not None]
+    if len(failed) > 0:
+        raise Exception("Copying to the cache failed for %d file(s): %s" % (len(failed), ", ".join(failed)))
+    if wavefront is None:
+        results = ingest_results
+    else:
+        for i, result in zip(indices, ingest_results):
+            wavefront.set_info(i, result)
+        results = [wavefront.info(i) for i in xrange(len(args.files))]
     outfiles = []
-    keep_channels = None
-    for i in xrange(len(args.files)):
-        # Read the data and attach axistags.
-        filename = args.files[i]
-        if ".h5/" in filename or ".hdf5/" in filename:
-            data_key = os.path.basename(filename)
-            data_path = filename[:-len(data_key)-1]
-            data = vigra.readHDF5(data_path, data_key)
-        else:
-            data_key = default_export_key()
-            data_path_base, data_path_ext = os.path.splitext(filename)
-            data_path = data_path_base + ".h5"
-            data = vigra.readImage(filename)
-        if not hasattr(data, "axistags"):
-            default_tags = {1: "x",
-                            2: "xy",
-                            3: "xyz",
-                            4: "xyzc",
-                            5: "txyzc"}
-            data = vigra.VigraArray(data, axistags=vigra.defaultAxistags(default_tags[len(data.shape)]),
-                                    dtype=data.dtype)
-        new_data = reshape_tzyxc(data)
-
-        if i == 0:
-            c_index = new_data.axistags.index("c")
-            keep_channels = new_data.shape[c_index]
-
-        # Save the reshaped dataset.
-        output_filename = os.path.split(data_path)[1]
-        output_filename = os.path.join(args.cache, output_filename)
-        vigra.writeHDF5(new_data, output_filename, data_key, compression=args.compression)
+    keep_channels = results[0][2]
+    for i, (output_filename, data_key, channels, nbytes) in enumerate(results):
+        if channels != keep_channels:
+            raise Exception("%s has %d channels, but %s has %d." % (args.files[i], channels, args.files[0],
+                                                                    keep_channels))
         args.files[i] = output_filename + "/" + data_key
         if args.no_overwrite:
             outfiles.append([os.path.splitext(output_filename)[0] + "_probs_%s.h5" % str(i).zfill(2) for i in xrange(n-1)])
@@ -189,48 +873,203 @@ def batch_predict(args, ilastik_args):
             outfiles.append([os.path.splitext(output_filename)[0] + "_probs.h5"] * (n-1))
     assert keep_channels > 0
 
+    # Create the downsampled copies of the files for the coarse rounds.
+    coarse_files = []
+    coarse_outfiles = []
+    if coarse_rounds > 0:
+        coarse_files = downsample_datasets(args.files, [keep_channels] * len(args.files), downsample,
+                                           compression=args.compression, resizable=args.merge_mode == "inplace",
+                                           block_budget=args.block_budget, workers=args.merge_workers)
+        coarse_outfiles = [[coarse_filename(path) for path in filename_out] for filename_out in outfiles]
+
+    if wavefront is not None:
+        wavefront_predict(args, wavefront, rf_files, outfiles, keep_channels, output_formats, output_filename_formats,
+                          output_internal_paths)
+        cache_results(result_cache, result_keys)
+        return
+
     # Run the batch prediction.
     for i in xrange(n):
         rf_file = rf_files[i]
         output_format = output_formats[i]
         output_filename_format = output_filename_formats[i]
         output_internal_path = output_internal_paths[i]
+        files = coarse_files if i < coarse_rounds else args.files
 
-        filename_key = os.path.basename(args.files[0])
-        filename_path = args.files[0][:-len(filename_key)-1]
+        filename_key = os.path.basename(files[0])
+        filename_path = files[0][:-len(filename_key)-1]
 
         # Quick hack to prevent the ilastik error "wrong number of channels".
         p = ILP(rf_file, args.cache, compression=args.compression)
-        for j in xrange(p.data_count):
-            p.set_data_path_key(j, filename_path, filename_key)
-
-        # Call ilastik to run the batch prediction.
-        cmd = [args.ilastik,
-               "--headless",
-               "--project=%s" % rf_file,
-               "--output_format=%s" % output_format,
-               "--output_filename_format=%s" % output_filename_format,
-               "--output_internal_path=%s" % output_internal_path]
-
-        if args.predict_file:
-            pfile = os.path.join(args.cache, "predict_file.txt")
-            with open(pfile, "w") as f:
-                for pf in args.files:
-                    f.write(os.path.abspath(pf) + "\n")
-            cmd.append("--predict_file=%s" % pfile)
-        else:
-            cmd += args.files
+        with p.transaction():
+            for j in xrange(p.data_count):
+                p.set_data_path_key(j, filename_path, filename_key)
 
+        # Split the files into shards and call one ilastik process per shard to run the batch prediction.
+        shards = [files[k::args.jobs] for k in xrange(args.jobs)]
+        shards = [shard for shard in shards if len(shard) > 0]
         print col.Fore.GREEN + "- Running autocontext batch prediction round %d of %d -" % (i+1, n) + col.Fore.RESET
-        subprocess.call(cmd, stdout=sys.stdout)
+        processes = []
+        shard_rf_files = []
+        for k, shard in enumerate(shards):
+            if len(shards) > 1:
+                # Each process gets its own copy of the project file and an equal share of the machine.
+                shard_rf_file = os.path.join(args.cache, "rf_%s_shard%s.ilp" % (str(i).zfill(2), str(k).zfill(2)))
+                shutil.copyfile(rf_file, shard_rf_file)
+                shard_rf_files.append(shard_rf_file)
+                env = lazyflow_environment(len(shards))
+                pfile = os.path.join(args.cache, "predict_file_%s.txt" % str(k).zfill(2))
+            else:
+                shard_rf_file = rf_file
+                env = None
+                pfile = os.path.join(args.cache, "predict_file.txt")
+
+            cmd = [args.ilastik,
+                   "--headless",
+                   "--project=%s" % shard_rf_file,
+                   "--output_format=%s" % output_format,
+                   "--output_filename_format=%s" % output_filename_format,
+                   "--output_internal_path=%s" % output_internal_path]
+            if i < n-1:
+                cmd += ilastik_export_arguments(args.prob_encoding)
+
+            if args.predict_file:
+                with open(pfile, "w") as f:
+                    for pf in shard:
+                        f.write(os.path.abspath(pf) + "\n")
+                cmd.append("--predict_file=%s" % pfile)
+            else:
+                cmd += shard
+
+            processes.append(subprocess.Popen(cmd, stdout=sys.stdout, env=env))
+        return_codes = [process.wait() for process in processes]
+        for shard_rf_file in shard_rf_files:
+            os.remove(shard_rf_file)
+        if len(shards) > 1:
+            failed = [k for k, return_code in enumerate(return_codes) if return_code != 0]
+            if len(failed) > 0:
+                raise Exception("ilastik failed for %d of %d shards." % (len(failed), len(shards)))
 
         if i < n-1:
             # Merge the probabilities back to the original file.
-            for filename, filename_out in zip(args.files, outfiles):
+            jobs = []
+            for filename, filename_out in zip(files, coarse_outfiles if i < coarse_rounds else outfiles):
                 filename_key = os.path.basename(filename)
                 filename_path = filename[:-len(filename_key)-1]
-                merge_datasets(filename_path, filename_key, filename_out[i], output_internal_path, n=keep_channels,
-                               compression=args.compression)
+                jobs.append(((filename_path, filename_key, filename_out[i], output_internal_path),
+                             {"n": keep_channels, "compression": args.compression, "mode": args.merge_mode,
+                              "move_output": not args.no_overwrite, "encoding": args.prob_encoding,
+                              "block_budget": args.block_budget}))
+            errors = merge_datasets_parallel(jobs, workers=args.merge_workers, callback=merge_progress(files))
+            check_merge_errors(files, errors)
+
+        # Upsample the probabilities of the last coarse round into the full resolution files.
+        if i+1 == coarse_rounds:
+            upsample_into_datasets(coarse_files, args.files, [keep_channels] * len(args.files), downsample,
+                                   compression=args.compression, mode=args.merge_mode, encoding=args.prob_encoding,
+                                   block_budget=args.block_budget, workers=args.merge_workers)
+
+    cache_results(result_cache, result_keys)
+
+
+def nickname(filename):
+    """Returns the name that ilastik uses for the placeholder {nickname} when the given file is predicted from the
+    cache folder.
+
+    :param filename: path to image or hdf5 dataset
+    :return: the nickname
+    :rtype: str
+    """
+    if ".h5/" in filename or ".hdf5/" in filename:
+        filename = os.path.dirname(filename)
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def cache_results(result_cache, result_keys):
+    """Puts the outputs of the batch prediction into the result cache.
+
+    :param result_cache: the result cache (None: do nothing)
+    :param result_keys: list with the keys and the output paths of the results
+    """
+    if result_cache is None:
+        return
+    for key, output_path in result_keys:
+        if os.path.isfile(output_path):
+            result_cache.put(key, output_path)
+
+
+def wavefront_predict(args, wavefront, rf_files, outfiles, keep_channels, output_formats, output_filename_formats,
+                      output_internal_paths):
+    """Run the batch prediction with one ilastik process per file and stage, so each file advances to the next stage
+    as soon as its own previous stage is merged. At most args.jobs steps run at the same time.
+
+    :param args: command line arguments
+    :param wavefront: the scheduler
+    :type wavefront: Wavefront
+    :param rf_files: the random forest files of the stages
+    :param outfiles: for each file, the list with the ilastik output files of the stages
+    :param keep_channels: number of raw data channels
+    :param output_formats: ilastik output format of each stage
+    :param output_filename_formats: ilastik output filename format of each stage
+    :param output_internal_paths: ilastik output key of each stage
+    """
+    n = len(rf_files)
+
+    def predict(index, stage):
+        # Use a copy of the project file whose lanes point to the predicted file, so the number of channels matches.
+        filename = args.files[index]
+        filename_key = os.path.basename(filename)
+        filename_path = filename[:-len(filename_key)-1]
+        rf_file = os.path.join(args.cache, "rf_%s_file%s.ilp" % (str(stage).zfill(2), str(index).zfill(4)))
+        shutil.copyfile(rf_files[stage], rf_file)
+        try:
+            p = ILP(rf_file, args.cache, compression=args.compression)
+            with p.transaction():
+                for j in xrange(p.data_count):
+                    p.set_data_path_key(j, filename_path, filename_key)
+            cmd = [args.ilastik,
+                   "--headless",
+                   "--project=%s" % rf_file,
+                   "--output_format=%s" % output_formats[stage],
+                   "--output_filename_format=%s" % output_filename_formats[stage],
+                   "--output_internal_path=%s" % output_internal_paths[stage],
+                   filename]
+            if stage < n-1:
+                cmd += ilastik_export_arguments(args.prob_encoding)
+            env = lazyflow_environment(args.jobs) if args.jobs > 1 else None
+            # Close the file descriptors in the child process, so it does not inherit the hdf5 file locks of the
+            # other threads.
+            return_code = subprocess.call(cmd, stdout=sys.stdout, env=env, close_fds=True)
+        finally:
+            os.remove(rf_file)
+        if return_code != 0:
+            raise Exception("ilastik returned %d." % return_code)
+
+    def merge(index, stage):
+        filename = args.files[index]
+        filename_key = os.path.basename(filename)
+        filename_path = filename[:-len(filename_key)-1]
+        if args.merge_mode == "virtual" and recover_virtual_merge(filename_path, filename_key, outfiles[index][stage]):
+            # The output was already moved by the finished merge of an interrupted run.
+            return
+        merge_datasets(filename_path, filename_key, outfiles[index][stage], output_internal_paths[stage],
+                       n=keep_channels, compression=args.compression, mode=args.merge_mode,
+                       move_output=not args.no_overwrite, encoding=args.prob_encoding, block_budget=args.block_budget)
+
+    def callback(index, stage, step, error, seconds):
+        if error is None:
+            print "Finished %s %d of %d of %s in %.1f s." % ("prediction" if step == "predict" else "merge", stage+1, n,
+                                                           args.files[index], seconds)
+        else:
+            print col.Fore.RED + "%s %d of %d of %s failed: %s" % ("Prediction" if step == "predict" else "Merge",
+                                                                 stage+1, n, args.files[index], error) + col.Fore.RESET
+
+    print col.Fore.GREEN + "- Running autocontext batch prediction of %d files with %d stages -" \
+        % (len(args.files), n) + col.Fore.RESET
+    errors = wavefront.run(predict, merge, workers=args.jobs, callback=callback)
+    failed = [name for name, error in zip(args.files, errors) if error is not None]
+    if len(failed) > 0:
+        raise Exception("Batch prediction failed for %d file(s): %s" % (len(failed), ", ".join(failed)))
 
 
 def train(args):
@@ -238,17 +1077,194 @@ def train(args):
 
     :param args: command line arguments
     """
-    # Copy the project file.
+    # Copy the project file. A resumed training continues with the existing output file.
     # TODO: If the file exists, ask the user if it shall be deleted.
-    if os.path.isfile(args.outfile):
-        os.remove(args.outfile)
-    shutil.copyfile(args.train, args.outfile)
+    if not args.resume or not os.path.isfile(args.outfile):
+        if os.path.isfile(args.outfile):
+            os.remove(args.outfile)
+        shutil.copyfile(args.train, args.outfile)
 
     # Create an ILP object for the project.
-    proj = ILP(args.outfile, args.cache, args.compression)
+    proj = ILP(args.outfile, args.cache, args.compression, args.merge_mode, args.block_budget, args.prob_encoding)
+    round_cache = open_round_cache(args, args.round_cache)
+    worker = start_worker(args)
 
     # Do the autocontext loop.
-    autocontext(args.ilastik, proj, args.nloops, args.labeldataset, weights=args.weights, predict_file=args.predict_file)
+    try:
+        autocontext(args.ilastik, proj, args.nloops, args.labeldataset, weights=args.weights,
+                    predict_file=args.predict_file, merge_workers=args.merge_workers, worker=worker, fused=args.fused,
+                    resume=args.resume, round_cache=round_cache, converge_threshold=args.converge_threshold,
+                    flip_threshold=args.flip_threshold, time_budget=args.time_budget, roi=args.roi,
+                    skip_unlabelled=args.skip_unlabelled, coarse_rounds=args.coarse_rounds,
+                    downsample=args.downsample)
+    finally:
+        if worker is not None:
+            worker.close()
+
+
+def open_round_cache(args, folder):
+    """Opens the round cache in the given folder. The merged datasets are hard linked, unless they are modified in
+    place.
+
+    :param args: command line arguments
+    :param folder: the round cache folder (None: no round cache)
+    :return: the round cache or None
+    """
+    if folder is None:
+        return None
+    if args.merge_mode == "virtual":
+        print col.Fore.YELLOW + "The round cache does not support the merge mode virtual, so it is not used." \
+            + col.Fore.RESET
+        return None
+    if args.seed is None and args.sweep is None:
+        print col.Fore.YELLOW + "Without --seed, the label subsets differ in each training, so the rounds in the " \
+                                "round cache cannot be reused." + col.Fore.RESET
+    return RoundCache(folder, link=args.merge_mode == "copy" and not args.roi)
+
+
+def start_worker(args):
+    """Starts the persistent ilastik worker that is selected by the command line arguments.
+
+    :param args: command line arguments
+    :return: the worker or None
+    """
+    if args.worker == "ilastik":
+        return IlastikWorker(args.ilastik)
+    elif args.worker == "local":
+        return LocalWorker()
+    return None
+
+
+def load_sweep(filename, default_seed):
+    """Reads the training configurations of a sweep from the json file.
+
+    The file contains either a list of configurations, e. g. [{"nloops": 3, "weights": [2, 1, 1], "seed": 1}, ...],
+    or a grid, e. g. {"nloops": [2, 3], "weights": [[1, 1], [2, 1, 1]], "seed": [1, 2]}. In a grid, each weight list is
+    only combined with the number of loops of the same length. Missing weights mean equal weights, a missing seed is
+    replaced by default_seed.
+    :param filename: the json file
+    :param default_seed: seed of the configurations without seed
+    :return: list of dicts with the keys nloops, weights and seed
+    """
+    with open(filename) as f:
+        spec = json.load(f)
+    if isinstance(spec, dict):
+        seeds = spec.get("seed", [default_seed])
+        weights_list = spec.get("weights", [None])
+        configs = [{"nloops": nloops, "weights": weights, "seed": seed}
+                   for nloops, weights, seed in itertools.product(spec["nloops"], weights_list, seeds)
+                   if weights is None or len(weights) == nloops]
+    else:
+        configs = [{"nloops": c["nloops"], "weights": c.get("weights"), "seed": c.get("seed", default_seed)}
+                   for c in spec]
+    for c in configs:
+        if c["seed"] is None:
+            raise Exception("Each configuration of the sweep needs a seed (or use --seed).")
+        if isinstance(c["seed"], bool) or not isinstance(c["seed"], (int, long)):
+            raise Exception("The seed of each configuration of the sweep must be an integer: %s" % c)
+        if c["weights"] is not None and len(c["weights"]) != c["nloops"]:
+            raise Exception("Number of weights must be equal to number of autocontext iterations: %s" % c)
+    if len(configs) == 0:
+        raise Exception("The sweep %s has no configurations." % filename)
+    return configs
+
+
+def sweep_order(project, label_data_nr, configs, roi=False):
+    """Returns the order in which the configurations of a sweep are trained.
+
+    For each configuration, the chain of the label subsets of its rounds is computed. Sorting the configurations by
+    these chains is a depth first traversal of the tree of shared round prefixes, so configurations that share rounds
+    are trained one after another.
+    :param project: the ILP object of the project that holds the labels
+    :param label_data_nr: number of dataset that contains the labels (-1: use all datasets)
+    :param configs: the configurations (see load_sweep())
+    :param roi: whether only the regions around the labels are predicted (see round_keys())
+    :return: list with the configuration indices and the number of rounds that are shared with the previous
+             configuration
+    """
+    chains = []
+    for config in configs:
+        label_seed = random.Random(config["seed"]).getrandbits(32)
+        blocks_with_slicing, scattered_labels_list = split_labels(project, label_data_nr, config["nloops"],
+                                                                  config["weights"], label_seed)
+        chain = []
+        key = ""
+        runs = config["nloops"]
+        for i in range(runs):
+            key = result_key(key, label_subset_sha1([(k, scattered_labels[i], block_slices)
+                                                     for (k, (blocks, block_slices)), scattered_labels
+                                                     in zip(blocks_with_slicing, scattered_labels_list)]))
+            if roi:
+                key = result_key(key, "roi%d" % (runs-1-i) if i+1 < runs else "roi-unpredicted")
+            chain.append(key)
+        chains.append(chain)
+    order = sorted(range(len(configs)), key=lambda i: chains[i])
+    shared = [0]
+    for previous, current in zip(order[:-1], order[1:]):
+        n = 0
+        while n < min(len(chains[previous]), len(chains[current])) and chains[previous][n] == chains[current][n]:
+            n += 1
+        shared.append(n)
+    return zip(order, shared)
+
+
+def sweep(args):
+    """Trains the project with each configuration of the sweep.
+
+    All configurations use the same round cache, so the rounds that are shared by several configurations are computed
+    only once. Each configuration gets its own output file and cache folder in the folder sweep_XX inside the cache
+    folder. The timing and the artifact locations of each configuration are written to sweep.json in the cache folder.
+    :param args: command line arguments
+    """
+    configs = load_sweep(args.sweep, args.seed)
+    label_project = ILP(args.train, args.cache)
+    order = sweep_order(label_project, args.labeldataset, configs, roi=args.roi)
+    round_cache_folder = args.round_cache
+    if round_cache_folder is None:
+        round_cache_folder = os.path.join(args.cache, "rounds")
+    round_cache = open_round_cache(args, round_cache_folder)
+    worker = start_worker(args)
+
+    report = []
+    try:
+        for index, shared in order:
+            config = configs[index]
+            print col.Fore.GREEN + "- Sweep configuration %d of %d: nloops %d, weights %s, seed %d (%d rounds shared " \
+                                   "with the previous configuration) -" \
+                % (len(report)+1, len(configs), config["nloops"], config["weights"], config["seed"], shared) \
+                + col.Fore.RESET
+            folder = os.path.join(args.cache, "sweep_%s" % str(index).zfill(2))
+            if os.path.isdir(folder):
+                shutil.rmtree(folder)
+            os.makedirs(folder)
+            outfile = os.path.join(folder, os.path.basename(args.outfile))
+            cache_folder = os.path.join(folder, "cache")
+            label_project.save(outfile)
+            proj = ILP(outfile, cache_folder, args.compression, args.merge_mode, args.block_budget,
+                       args.prob_encoding)
+            random.seed(config["seed"])
+            start = time.time()
+            skipped_rounds = autocontext(args.ilastik, proj, config["nloops"], args.labeldataset,
+                                         weights=config["weights"], predict_file=args.predict_file,
+                                         merge_workers=args.merge_workers, worker=worker, fused=args.fused,
+                                         round_cache=round_cache, converge_threshold=args.converge_threshold,
+                                         flip_threshold=args.flip_threshold, time_budget=args.time_budget, roi=args.roi,
+                                         skip_unlabelled=args.skip_unlabelled)
+            report.append(dict(config, index=index, seconds=time.time()-start, reused_rounds=skipped_rounds,
+                               outfile=outfile, cache=cache_folder))
+    finally:
+        if worker is not None:
+            worker.close()
+
+    # Write and print the report.
+    report = sorted(report, key=lambda r: r["index"])
+    with open(os.path.join(args.cache, "sweep.json"), "w") as f:
+        json.dump(report, f, indent=1)
+    print col.Fore.GREEN + "Sweep results:" + col.Fore.RESET
+    for r in report:
+        print "%2d: nloops %d, weights %s, seed %d: %.1f s (%d of %d rounds reused), output %s, forests %s" \
+            % (r["index"], r["nloops"], r["weights"], r["seed"], r["seconds"], r["reused_rounds"], r["nloops"],
+               r["outfile"], r["cache"])
 
 
 def process_command_line():
@@ -267,6 +1283,21 @@ def process_command_line():
                         help="name of the cache folder")
     parser.add_argument("--compression", default="lzf", type=str, choices=["lzf", "gzip", "szip", "None"],
                         help="compression filter for the hdf5 files")
+    parser.add_argument("--merge_mode", default="copy", type=str, choices=["copy", "inplace", "virtual"],
+                        help="how the ilastik output is merged into the datasets after each round (inplace: overwrite "
+                             "the probability channels in place, virtual: use hdf5 virtual datasets, requires hdf5 >= "
+                             "1.10 in ilastik)")
+    parser.add_argument("--prob_encoding", type=str, default=None, choices=PROB_ENCODINGS,
+                        help="dtype of the stored probabilities (raw: the dtype of the data, uint8: scaled to 0..255, "
+                             "float16); uint8 and float16 require --merge_mode virtual; the batch prediction uses the "
+                             "encoding of the training by default")
+    parser.add_argument("--merge_workers", type=int, default=1,
+                        help="number of processes that merge the ilastik output into the datasets")
+    parser.add_argument("--ingest_workers", type=int, default=1,
+                        help="number of processes that copy the batch prediction files into the cache")
+    parser.add_argument("--block_budget", type=float, default=64,
+                        help="maximum size (in MB) of the blocks that are held in memory when datasets are reshaped "
+                             "or merged")
     parser.add_argument("--clear_cache", action="store_true",
                         help="clear the cache folder without asking")
     parser.add_argument("--keep_cache", action="store_true",
@@ -285,6 +1316,42 @@ def process_command_line():
                         help="the random seed")
     parser.add_argument("--weights", type=float, nargs="*", default=[],
                         help="amount of labels that are used in each round")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted training after the last finished round (the cache folder is "
+                             "kept)")
+    parser.add_argument("--round_cache", type=str, default=None,
+                        help="folder that stores the results of the training rounds, so a new training with the same "
+                             "inputs and label subsets reuses them (requires --seed)")
+    parser.add_argument("--roi", action="store_true",
+                        help="only predict the regions around the labels in the intermediate rounds and skip the "
+                             "prediction of the last round")
+    parser.add_argument("--skip_unlabelled", action="store_true",
+                        help="do not predict the datasets without labels in the training rounds, but predict them with "
+                             "the saved forests after the training")
+    parser.add_argument("--coarse_rounds", type=int, default=0,
+                        help="number of training rounds that run on datasets and labels that are downsampled by "
+                             "--downsample; the probabilities are upsampled before the full resolution rounds")
+    parser.add_argument("--downsample", type=int, default=2,
+                        help="downsampling factor of the axes z, y and x in the coarse rounds")
+    parser.add_argument("--sweep", type=str, default=None,
+                        help="json file with a list or a grid of training configurations (nloops, weights, seed) that "
+                             "are trained one after another, sharing the common rounds in the round cache")
+    parser.add_argument("--converge_threshold", type=float, default=None,
+                        help="stop the training early if the mean absolute change of the probabilities of each class "
+                             "in a round is below this threshold")
+    parser.add_argument("--flip_threshold", type=float, default=None,
+                        help="stop the training early if the fraction of voxels whose most probable class changed in a "
+                             "round is below this threshold")
+    parser.add_argument("--time_budget", type=float, default=None,
+                        help="stop the training after the first round that ends later than this number of minutes after "
+                             "the start")
+    parser.add_argument("--fused", action="store_true",
+                        help="retrain and predict in a single ilastik call in each round (falls back to separate calls "
+                             "if ilastik does not support this)")
+    parser.add_argument("--worker", type=str, default="none", choices=["none", "ilastik", "local"],
+                        help="ilastik: keep one ilastik process alive for all rounds (requires the patched ilastik.py "
+                             "and ilastik_worker.py from ilastik_mods), local: use a fake worker that predicts "
+                             "uniform probabilities (for testing without ilastik)")
 
     # Batch prediction arguments.
     parser.add_argument("--batch_predict", type=str,
@@ -292,6 +1359,18 @@ def process_command_line():
                              "prediction")
     parser.add_argument("--files", type=str, nargs="+",
                         help="the files for the batch prediction")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of ilastik processes that run at the same time, each on a part of the files")
+    parser.add_argument("--wavefront", action="store_true",
+                        help="run one ilastik process per file and stage (at most --jobs at the same time), so each "
+                             "file advances to the next stage as soon as its previous stage is finished; an "
+                             "interrupted run can be resumed with --keep_cache")
+    parser.add_argument("--result_cache", type=str, default=None,
+                        help="folder of a cache for the final probabilities, which are reused if the same file is "
+                             "predicted again with the same trained autocontext")
+    parser.add_argument("--result_cache_size", type=float, default=0,
+                        help="size limit (in MB) of the result cache, the least recently used results are removed (0: "
+                             "unlimited)")
     parser.add_argument("--no_overwrite", action="store_true",
                         help="create one _probs file for each autocontext iteration in the batch prediction")
 
@@ -306,14 +1385,36 @@ def process_command_line():
     args.outfile = os.path.expanduser(args.outfile)
     if args.batch_predict is not None:
         args.batch_predict = os.path.expanduser(args.batch_predict)
-
-    # Check if ilastik is an executable.
-    if not os.path.isfile(args.ilastik) or not os.access(args.ilastik, os.X_OK):
-        raise Exception("%s is not an executable file." % args.ilastik)
+    if args.result_cache is not None:
+        args.result_cache = os.path.expanduser(args.result_cache)
+    if args.round_cache is not None:
+        args.round_cache = os.path.expanduser(args.round_cache)
+    if args.sweep is not None:
+        args.sweep = os.path.expanduser(args.sweep)
+
+    # Check if ilastik is an executable (the training with the local worker runs without ilastik).
+    if args.worker != "local" or args.train is None:
+        if not os.path.isfile(args.ilastik) or not os.access(args.ilastik, os.X_OK):
+            raise Exception("%s is not an executable file." % args.ilastik)
+
+    # Check the number of merge processes.
+    if args.merge_workers < 1:
+        raise Exception("--merge_workers must be at least 1.")
+    if args.ingest_workers < 1:
+        raise Exception("--ingest_workers must be at least 1.")
+    if args.jobs < 1:
+        raise Exception("--jobs must be at least 1.")
+
+    # Convert the block budget to bytes.
+    if args.block_budget <= 0:
+        raise Exception("--block_budget must be positive.")
+    args.block_budget = int(args.block_budget * 2**20)
 
     # Check that only one of the options --clear_cache, --keep_cache was set.
     if args.clear_cache and args.keep_cache:
         raise Exception("--clear_cache and --keep_cache must not be combined.")
+    if args.clear_cache and args.resume:
+        raise Exception("--clear_cache and --resume must not be combined.")
 
     # Check for conflicts between training and batch prediction arguments.
     if args.train is None and args.batch_predict is None:
@@ -340,6 +1441,30 @@ def process_command_line():
             args.weights = None
         if args.weights is not None and len(args.weights) != args.nloops:
             raise Exception("Number of weights must be equal to number of autocontext iterations.")
+        if args.sweep is not None and args.resume:
+            raise Exception("--sweep and --resume must not be combined.")
+        if args.sweep is not None and args.merge_mode == "virtual":
+            raise Exception("--sweep requires the round cache, which does not support --merge_mode virtual.")
+        if args.roi and (args.fused or args.merge_mode == "virtual" or args.converge_threshold is not None or
+                         args.flip_threshold is not None):
+            raise Exception("--roi cannot be combined with --fused, --merge_mode virtual, --converge_threshold or "
+                            "--flip_threshold.")
+        if args.coarse_rounds < 0 or args.coarse_rounds >= args.nloops:
+            raise Exception("--coarse_rounds must be smaller than the number of autocontext iterations.")
+        if args.coarse_rounds > 0:
+            if args.downsample < 2:
+                raise Exception("--downsample must be at least 2.")
+            if args.roi or args.skip_unlabelled or args.round_cache is not None or args.sweep is not None:
+                raise Exception("--coarse_rounds cannot be combined with --roi, --skip_unlabelled, --round_cache or "
+                                "--sweep.")
+        if args.time_budget is not None:
+            if args.time_budget <= 0:
+                raise Exception("--time_budget must be positive.")
+            args.time_budget *= 60
+        if args.prob_encoding is None:
+            args.prob_encoding = "raw"
+        if args.prob_encoding != "raw" and args.merge_mode != "virtual":
+            raise Exception("--prob_encoding %s requires --merge_mode virtual." % args.prob_encoding)
 
     # Check if the batch prediction arguments are valid.
     if args.batch_predict:
@@ -347,9 +1472,22 @@ def process_command_line():
             raise Exception("The --batch_predict and --cache directories must be different.")
         if args.files is None:
             raise Exception("Tried to use batch prediction without --files.")
+        if args.sweep is not None:
+            raise Exception("--sweep can only be used with --train.")
         if not os.path.isdir(args.batch_predict):
             raise Exception("%s is not a directory." % args.batch_predict)
 
+        # Use the probability encoding of the training, since the forests were trained on the encoded probabilities.
+        manifest = Manifest(os.path.join(args.batch_predict, "manifest.json"))
+        training_encoding = manifest.settings.get("prob_encoding", "raw") if manifest.exists else "raw"
+        if args.prob_encoding is None:
+            args.prob_encoding = training_encoding
+        elif args.prob_encoding != training_encoding:
+            print col.Fore.YELLOW + "The training used the probability encoding %s, but %s is used for the batch " \
+                                    "prediction." % (training_encoding, args.prob_encoding) + col.Fore.RESET
+        if args.prob_encoding != "raw" and args.merge_mode != "virtual":
+            raise Exception("The probability encoding %s requires --merge_mode virtual." % args.prob_encoding)
+
         # Expand filenames that include *.
         expanded_files = [os.path.expanduser(f) for f in args.files]
         args.files = []
@@ -401,6 +1539,8 @@ def main():
             clear_cache = True
         elif args.keep_cache:
             print "The option --keep_cache was set, so the cache folder will not be cleared."
+        elif args.resume:
+            print "The option --resume was set, so the cache folder will not be cleared."
         else:
             cc_input = raw_input("Clear cache folder? [y|n] : ")
             if cc_input in ["y", "Y"]:
@@ -420,7 +1560,10 @@ def main():
         else:
             print "Cache folder not cleared."
 
-    if args.train:
+    if args.train and args.sweep is not None:
+        # Train all configurations of the sweep.
+        sweep(args)
+    elif args.train:
         # Do the autocontext training.
         train(args)
     else:
@@ -6,6 +6,8 @@ from numbers import Number
 
 
 class BlockWithMargin(object):
+    __slots__ = ("innerBlock", "outerBlock", "localInnerBlock")
+
     def __init__(self, block, margin):
         shape = block.shape
         dim = len(shape)
@@ -36,14 +38,16 @@ class BlockWithMargin(object):
 
 
 class Block(object):
+    __slots__ = ("begin", "end", "blocking")
+
     def __init__(self,begin, end, blocking):
-        self.begin = begin
-        self.end = end
-        self.slicing = []
+        self.begin = tuple(begin)
+        self.end = tuple(end)
         self.blocking = blocking
-        for b,e in zip(self.begin, self.end):
-            self.slicing.append(slice(b, e))
 
+    @property
+    def slicing(self):
+        return [slice(b, e) for b, e in zip(self.begin, self.end)]
 
     def blockWithMargin(self, margin):
         return BlockWithMargin(block=self,margin=margin)
@@ -60,8 +64,14 @@ class Block(object):
 
 
 class Blocking(object):
+    """N-dimensional blocking of an array with the given shape.
+
+    The blocks are numbered in C order of their block coordinates. Single blocks can be accessed with blockAt(),
+    the begin and end of many blocks with blockBounds(). yieldBlocks() can be used with a start and a step, so several
+    workers can iterate over disjoint sets of blocks.
+    """
     def __init__(self,shape,blockShape=None, roi=None ):
-        self.shape = shape
+        self.shape = tuple(int(s) for s in shape)
         self.nDim = len(shape)
 
 
@@ -73,7 +83,7 @@ class Blocking(object):
         elif isinstance(blockShape,Number):
             self.blockShape = [int(blockShape)]*nDim
         else:
-            self.blockShape = list(blockShape)
+            self.blockShape = [int(b) for b in blockShape]
 
         for d in range(nDim):
             self.blockShape[d] = min(self.blockShape[d], shape[d])
@@ -87,72 +97,70 @@ class Blocking(object):
 
         nBlocks = 1
         for nb in self.blocksPerAxis:
-            nBlocks*=nb
+            nBlocks*=int(nb)
         self.nBlocks = nBlocks
 
-
-
-    def yieldBlocks(self):
-        blocksPerAxis = self.blocksPerAxis
-        shape = self.shape
-        bshape = self.blockShape
-
-        if self.nDim == 2 :
-
-            for bx in range(blocksPerAxis[0]):
-                for by in range(blocksPerAxis[1]):
-
-                    bs = (bx*bshape[0],by*bshape[1])
-                    be = (min((bx+1)*bshape[0],shape[0]),
-                          min((by+1)*bshape[1],shape[1]))
-
-                    yield Block(bs,be,self)
-
-        elif self.nDim == 3 :
-            for bx in range(blocksPerAxis[0]):
-                for by in range(blocksPerAxis[1]):
-                    for bz in range(blocksPerAxis[2]):
-                        bs = (bx*bshape[0],by*bshape[1],bz*bshape[2])
-                        be = (min((bx+1)*bshape[0],shape[0]),
-                              min((by+1)*bshape[1],shape[1]),
-                              min((bz+1)*bshape[2],shape[2]))
-
-                        yield Block(bs,be,self)
-
-        elif self.nDim == 4 :
-            for bx in range(blocksPerAxis[0]):
-                for by in range(blocksPerAxis[1]):
-                    for bz in range(blocksPerAxis[2]):
-                        for bt in range(blocksPerAxis[3]):
-                            bs = (bx*bshape[0],by*bshape[1],bz*bshape[2],bt*bshape[3])
-                            be = (min((bx+1)*bshape[0],shape[0]),
-                                  min((by+1)*bshape[1],shape[1]),
-                                  min((bz+1)*bshape[2],shape[2]),
-                                  min((bt+1)*bshape[3],shape[3]))
-
-                            yield Block(bs,be,self)
-
-        elif self.nDim == 5 :
-            for bx in range(blocksPerAxis[0]):
-                for by in range(blocksPerAxis[1]):
-                    for bz in range(blocksPerAxis[2]):
-                        for bt in range(blocksPerAxis[3]):
-                            for bc in range(blocksPerAxis[4]):
-                                bs = (bx*bshape[0],by*bshape[1],bz*bshape[2],bt*bshape[3],bc*bshape[4])
-                                be = (min((bx+1)*bshape[0],shape[0]),
-                                      min((by+1)*bshape[1],shape[1]),
-                                      min((bz+1)*bshape[2],shape[2]),
-                                      min((bt+1)*bshape[3],shape[3]),
-                                      min((bc+1)*bshape[4],shape[4]))
-
-                                yield Block(bs,be,self)
-
-        else:
-            raise Exception("%d dimensional data not supported." % self.nDim)
+    def __len__(self):
+        return self.nBlocks
+
+    def blockBounds(self, indices=None):
+        """Returns the begin and end of the blocks with the given indices as arrays of shape (len(indices), nDim).
+
+        :param indices: block indices (default: all blocks)
+        :return: tuple with begin and end array
+        """
+        if indices is None:
+            indices = numpy.arange(self.nBlocks)
+        indices = numpy.asarray(indices)
+        if numpy.any(indices < 0) or numpy.any(indices >= self.nBlocks):
+            raise IndexError("Block index out of range.")
+        coordinates = numpy.array(numpy.unravel_index(indices, self.blocksPerAxis)).reshape(self.nDim, -1).T
+        begins = coordinates * numpy.array(self.blockShape)
+        ends = numpy.minimum(begins + numpy.array(self.blockShape), numpy.array(self.shape))
+        return begins, ends
+
+    def blockAt(self, index):
+        """Returns the block with the given index.
+
+        :param index: block index
+        :return: the block
+        :rtype: Block
+        """
+        if index < 0:
+            index += self.nBlocks
+        begins, ends = self.blockBounds([index])
+        return Block(begins[0].tolist(), ends[0].tolist(), self)
+
+    def blockIndexOf(self, coordinate):
+        """Returns the index of the block that contains the given coordinate.
+
+        :param coordinate: coordinate inside the blocked array
+        :return: block index
+        :rtype: int
+        """
+        if len(coordinate) != self.nDim:
+            raise IndexError("The coordinate must have %d dimensions." % self.nDim)
+        for c, s in zip(coordinate, self.shape):
+            if c < 0 or c >= s:
+                raise IndexError("Coordinate out of range.")
+        blockCoordinate = [int(c) // b for c, b in zip(coordinate, self.blockShape)]
+        return int(numpy.ravel_multi_index(blockCoordinate, self.blocksPerAxis))
+
+    def yieldBlocks(self, start=0, step=1):
+        """Yields the blocks with the indices start, start+step, start+2*step, ... .
+
+        :param start: index of the first block
+        :param step: step between the block indices
+        """
+        batchSize = 4096
+        for batchStart in xrange(start, self.nBlocks, step*batchSize):
+            indices = numpy.arange(batchStart, min(self.nBlocks, batchStart + step*batchSize), step)
+            begins, ends = self.blockBounds(indices)
+            for begin, end in zip(begins.tolist(), ends.tolist()):
+                yield Block(begin, end, self)
 
 
 if __name__ == "__main__":
 
     for block in Blocking([1,10,1],[1,3,2]).yieldBlocks():
         print block
-
@@ -0,0 +1,127 @@
+import numpy
+import h5py
+import block_yielder
+
+
+# Default number of bytes of one block that is held in memory by copy_dataset().
+DEFAULT_BLOCK_BUDGET = 64 * 2**20
+
+
+def _gcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
+
+
+def _lcm(a, b):
+    return a * b // _gcd(a, b)
+
+
+def open_h5(path, mode="r", cache_bytes=None):
+    """Opens the h5 file. If cache_bytes is given, the chunk cache of all datasets in the file is set to that size.
+
+    Setting the chunk cache requires h5py >= 2.9, older versions use the default chunk cache.
+    :param path: path to h5 file
+    :param mode: file mode
+    :param cache_bytes: size of the chunk cache in bytes
+    :return: the h5 file
+    :rtype: h5py.File
+    """
+    if cache_bytes is None:
+        return h5py.File(path, mode)
+    try:
+        return h5py.File(path, mode, rdcc_nbytes=int(cache_bytes), rdcc_nslots=10007)
+    except TypeError:
+        return h5py.File(path, mode)
+
+
+def _aligned_unit(shape, chunk_shapes):
+    """Returns the smallest shape that is a multiple of all given chunk shapes, clipped to the given shape.
+    """
+    unit = [1] * len(shape)
+    for chunks in chunk_shapes:
+        if chunks is not None:
+            unit = [_lcm(u, c) for u, c in zip(unit, chunks)]
+    return [min(u, s) for u, s in zip(unit, shape)]
+
+
+def copy_block_shape(shape, itemsize, chunk_shapes=(), budget=DEFAULT_BLOCK_BUDGET):
+    """Returns the shape of the blocks that are used to copy a region of the given shape.
+
+    The block shape is a multiple of all given chunk shapes (clipped to the region shape), so each chunk is read and
+    written exactly once. If such a block does not fit into the budget, the first chunk shapes are dropped from the
+    alignment, so the last chunk shape (the one of the target) is preferred. Starting with the last axis, the block is
+    grown as long as it fits into the budget.
+    :param shape: shape of the region
+    :param itemsize: number of bytes per element
+    :param chunk_shapes: chunk shapes of the source and target datasets (None for contiguous datasets)
+    :param budget: maximum number of bytes per block
+    :return: block shape
+    :rtype: tuple
+    """
+    chunk_shapes = list(chunk_shapes)
+    unit = [1] * len(shape)
+    for i in range(len(chunk_shapes)+1):
+        candidate = _aligned_unit(shape, chunk_shapes[i:])
+        if itemsize * numpy.prod(candidate) <= budget:
+            unit = candidate
+            break
+
+    block = list(unit)
+    for d in reversed(range(len(shape))):
+        others = itemsize
+        for k in range(len(shape)):
+            if k != d:
+                others *= block[k]
+        factor = max(1, budget // (others * unit[d]))
+        block[d] = min(shape[d], unit[d] * factor)
+    return tuple(block)
+
+
+def copy_dataset(src, dst, src_offset=None, dst_offset=None, shape=None, scale=None, budget=DEFAULT_BLOCK_BUDGET):
+    """Copies the region of the given shape that starts at src_offset in src to dst_offset in dst.
+
+    The region is copied in blocks that are aligned to the chunks of both datasets. The buffers are allocated once and
+    reused for all blocks. If scale is given, the values are multiplied by scale. The multiplication and the cast to
+    the dtype of dst are done in place.
+    :param src: source h5py dataset
+    :param dst: target h5py dataset
+    :param src_offset: start of the region in src (default: zero)
+    :param dst_offset: start of the region in dst (default: zero)
+    :param shape: shape of the region (default: from src_offset to the end of src)
+    :param scale: factor that is applied to the values
+    :param budget: maximum number of bytes per block and buffer
+    """
+    ndim = len(src.shape)
+    if src_offset is None:
+        src_offset = (0,) * ndim
+    if dst_offset is None:
+        dst_offset = (0,) * ndim
+    if shape is None:
+        shape = tuple(s - o for s, o in zip(src.shape, src_offset))
+    if len(dst.shape) != ndim or len(src_offset) != ndim or len(dst_offset) != ndim or len(shape) != ndim:
+        raise Exception("The datasets, offsets and shape must have the same number of dimensions.")
+    if any(s == 0 for s in shape):
+        return
+
+    # Allocate the buffers.
+    itemsize = max(src.dtype.itemsize, dst.dtype.itemsize)
+    block_shape = copy_block_shape(shape, itemsize, (src.chunks, dst.chunks), budget)
+    src_buffer = numpy.empty(block_shape, dtype=src.dtype)
+    if scale is None and dst.dtype == src.dtype:
+        dst_buffer = src_buffer
+    else:
+        dst_buffer = numpy.empty(block_shape, dtype=dst.dtype)
+
+    # Copy the blocks.
+    blocking = block_yielder.Blocking(shape, block_shape)
+    for block in blocking.yieldBlocks():
+        local = tuple(slice(0, e-b) for b, e in zip(block.begin, block.end))
+        src_sel = tuple(slice(o+b, o+e) for o, b, e in zip(src_offset, block.begin, block.end))
+        dst_sel = tuple(slice(o+b, o+e) for o, b, e in zip(dst_offset, block.begin, block.end))
+        src.read_direct(src_buffer, src_sel, local)
+        if scale is not None:
+            numpy.multiply(src_buffer[local], scale, out=dst_buffer[local], casting="unsafe")
+        elif dst_buffer is not src_buffer:
+            numpy.copyto(dst_buffer[local], src_buffer[local], casting="unsafe")
+        dst.write_direct(dst_buffer, local, dst_sel)
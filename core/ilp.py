@@ -4,9 +4,15 @@ import os
 import h5py
 import ilp_constants as const
 import block_yielder
+import h5_copy
 import sys
 import subprocess
 import shutil
+import collections
+import contextlib
+import itertools
+import multiprocessing
+import time
 
 
 def eval_h5(proj, key_list):
@@ -43,6 +49,63 @@ def del_from_h5(proj, key_list):
     del val[key_list[-1]]
 
 
+def write_h5_value(proj, h5_key, value):
+    """Writes the value into the dataset with the given h5 key.
+
+    An existing dataset with matching shape and dtype (or a variable length string dataset) is overwritten in place,
+    so the file does not fragment. Otherwise, the dataset is replaced.
+    :param proj: h5py File object
+    :param h5_key: h5 key of the dataset
+    :param value: the value
+    """
+    if not isinstance(proj, h5py.File):
+        raise Exception("A valid h5py File object must be given.")
+    value = numpy.asarray(value)
+    if h5_key in proj:
+        dataset = proj[h5_key]
+        if isinstance(dataset, h5py.Dataset) and dataset.shape == value.shape:
+            if dataset.dtype == value.dtype:
+                dataset[()] = value
+                return
+            if value.dtype.kind in "SU" and h5py.check_dtype(vlen=dataset.dtype) is not None:
+                dataset[()] = value.item()
+                return
+        del proj[h5_key]
+    proj.create_dataset(h5_key, data=value)
+
+
+def write_label_block(labels, block_name, block, block_slice):
+    """Writes the label block and its block slice into the label group, if they differ from the stored ones.
+
+    An existing block with the same shape and dtype is overwritten in place, otherwise it is replaced. Sparse blocks
+    (objects with a todense() method, e. g. labels.SparseLabelBlock) are only densified here.
+    :param labels: h5py group of the label blocks of a dataset
+    :param block_name: name of the block inside the group
+    :param block: label block
+    :param block_slice: block slice
+    :return: whether the block was written
+    :rtype: bool
+    """
+    if hasattr(block, "todense"):
+        block = block.todense()
+    block = numpy.asarray(block)
+    if block_name in labels:
+        h5_block = labels[block_name]
+        if h5_block.shape == block.shape and h5_block.dtype == block.dtype:
+            changed = False
+            if not numpy.array_equal(h5_block[()], block):
+                h5_block[...] = block
+                changed = True
+            if h5_block.attrs.get("blockSlice") != block_slice:
+                h5_block.attrs["blockSlice"] = block_slice
+                changed = True
+            return changed
+        del labels[block_name]
+    h5_block = labels.create_dataset(block_name, data=block)
+    h5_block.attrs["blockSlice"] = block_slice
+    return True
+
+
 def reshape_tzyxc(data):
     """Reshape data to tzyxc axisorder and set proper axistags.
 
@@ -76,23 +139,199 @@ def reshape_tzyxc(data):
     return data.reshape(data_shape, axistags=axistags)
 
 
-def merge_datasets(data0_path, data0_key, data1_path, data1_key, n=0, compression=None):
-    """Merge data1 into data0, but keep the first n channels of data0. It is assumed, that the channels are in the last
-    dimension.
+def tzyxc_axistags(axistags):
+    """Returns the axistags in tzyxc order. Axes that are missing in the given axistags are added.
 
-    :param data0_path: path to first h5 file
-    :param data0_key: h5 key of first file
-    :param data1_path: path to second h5 file
-    :param data1_key: h5 key of second file
-    :param n: number of channels to keep
+    :param axistags: axistags
+    :type axistags: vigra.AxisTags
+    :return: axistags in tzyxc order
+    :rtype: vigra.AxisTags
+    """
+    keys = [axis.key for axis in axistags]
+    new_axistags = vigra.AxisTags()
+    for key in "tzyxc":
+        if key in keys:
+            new_axistags.append(axistags[key])
+        else:
+            new_axistags.append(getattr(vigra.AxisInfo, key))
+    return new_axistags
+
+
+def reshape_tzyxc_blockwise(h5_data, h5_file, key, axistags, compression=None, resizable=False,
+                            block_budget=h5_copy.DEFAULT_BLOCK_BUDGET):
+    """Copies the h5 dataset into a new tzyxc dataset, like reshape_tzyxc(), but blockwise.
+
+    Each block of the new dataset is read from the source, transposed and extended by the missing singleton axes, so
+    the memory usage is bounded by the block budget, regardless of the dataset size.
+    :param h5_data: h5py dataset
+    :param h5_file: h5py file or group of the new dataset
+    :param key: h5 key of the new dataset
+    :param axistags: axistags of h5_data (in the order of the stored axes)
+    :type axistags: vigra.AxisTags
     :param compression: the compression
+    :param resizable: whether the channel axis of the new dataset can be resized
+    :param block_budget: maximum number of bytes per block
+    :return: the new dataset
     """
-    # Get the data.
-    h5_data_file = h5py.File(data0_path, "r")
-    h5_data = h5_data_file[data0_key]
-    h5_output_data_file = h5py.File(data1_path, "r")
-    h5_output_data = h5_output_data_file[data1_key]
+    keys = [axis.key for axis in axistags]
+    if len(keys) != len(h5_data.shape):
+        raise Exception("The axistags do not match the dataset.")
+    for k in keys:
+        if k not in "tzyxc" or keys.count(k) > 1:
+            raise Exception("Dataset has wrong axistags.")
+
+    # Create the new dataset.
+    shape = tuple(h5_data.shape[keys.index(k)] if k in keys else 1 for k in "tzyxc")
+    chunk_shape = default_chunk_shape(shape)
+    maxshape = shape[:-1] + (None,) if resizable else None
+    if key in h5_file:
+        del h5_file[key]
+    h5_new = h5_file.create_dataset(key, shape=shape, dtype=h5_data.dtype, chunks=chunk_shape, maxshape=maxshape,
+                                    compression=compression)
+    h5_new.attrs["axistags"] = tzyxc_axistags(axistags).toJSON()
+
+    # Copy the blocks.
+    transpose_order = [keys.index(k) for k in "tzyxc" if k in keys]
+    block_shape = h5_copy.copy_block_shape(shape, h5_data.dtype.itemsize, (chunk_shape,), block_budget)
+    blocking = block_yielder.Blocking(shape, block_shape)
+    for block in blocking.yieldBlocks():
+        source_slicing = [None] * len(keys)
+        for d, k in enumerate("tzyxc"):
+            if k in keys:
+                source_slicing[keys.index(k)] = slice(block.begin[d], block.end[d])
+        data = h5_data[tuple(source_slicing)].transpose(transpose_order)
+        h5_new[tuple(block.slicing)] = data.reshape(tuple(e-b for b, e in zip(block.begin, block.end)))
+    return h5_new
+
+
+def default_chunk_shape(shape):
+    """Returns the chunk shape of the tzyxc datasets in the cache folder. Each channel is stored in its own chunks, so
+    the probability channels can be written without touching the raw channels.
+
+    :param shape: shape of the dataset
+    :return: chunk shape
+    :rtype: tuple
+    """
+    max_chunk_shape = (1, 100, 100, 100, 1)
+    return tuple(min(a, b) for a, b in zip(shape, max_chunk_shape))
+
+
+def write_h5_array(data, path, key, compression=None, resizable=False):
+    """Writes the array to the h5 file, like vigra.writeHDF5.
+
+    If resizable is True, the dataset is chunked with default_chunk_shape() and the last (channel) axis can be resized.
+    :param data: the array
+    :type data: vigra or numpy array
+    :param path: path to h5 file
+    :param key: h5 key of the dataset
+    :param compression: the compression
+    :param resizable: whether the channel axis can be resized
+    """
+    if not resizable:
+        vigra.writeHDF5(data, path, key, compression=compression)
+        return
+    axistags = None
+    if hasattr(data, "axistags"):
+        data = data.transposeToNumpyOrder()
+        axistags = data.axistags.toJSON()
+    data = numpy.asarray(data)
+    h5_file = h5py.File(path, "a")
+    try:
+        if key in h5_file:
+            del h5_file[key]
+        h5_data = h5_file.create_dataset(key, data=data, chunks=default_chunk_shape(data.shape),
+                                         maxshape=data.shape[:-1] + (None,), compression=compression)
+        if axistags is not None:
+            h5_data.attrs["axistags"] = axistags
+    finally:
+        h5_file.close()
+
+
+# Encodings of the probability channels of the merged datasets, see probability_encoding().
+PROB_ENCODINGS = ("raw", "uint8", "float16")
+
+
+def probability_encoding(dtype, encoding="raw"):
+    """Returns the dtype in which the probability channels of a merged dataset are stored and the stored value of the
+    probability 1.
+
+    Encodings:
+    "raw": The probabilities have the dtype of the dataset. If it is an integer type, they are scaled to its full range.
+    "uint8": The probabilities are scaled to [0, 255] and stored as uint8.
+    "float16": The probabilities are stored as float16. Datasets of integer type use the encoding "raw".
+    The dataset itself always has a single dtype, so the encoded dtype only saves space where the probabilities are
+    stored on their own, i. e. in the ilastik outputs and in the probability files of the virtual merge mode. The
+    autocontext therefore only allows the encodings other than "raw" with the virtual merge mode.
+    :param dtype: dtype of the dataset
+    :param encoding: the encoding
+    :return: tuple with the dtype of the probabilities and the value of the probability 1
+    """
+    dtype = numpy.dtype(dtype)
+    if encoding not in PROB_ENCODINGS:
+        raise Exception("Unknown probability encoding: %s" % encoding)
+    if encoding == "uint8":
+        return numpy.dtype(numpy.uint8), 255
+    if dtype.kind in "ui":
+        return dtype, numpy.iinfo(dtype).max
+    if encoding == "float16":
+        return numpy.dtype(numpy.float16), 1
+    return dtype, 1
+
+
+def output_one(dtype):
+    """Returns the value of the probability 1 in an ilastik output of the given dtype (integer outputs are scaled to the
+    full range of their dtype).
+
+    :param dtype: dtype of the output
+    :return: value of the probability 1
+    """
+    dtype = numpy.dtype(dtype)
+    if dtype.kind in "ui":
+        return numpy.iinfo(dtype).max
+    return 1
+
 
+def ilastik_export_arguments(encoding="raw"):
+    """Returns the ilastik command line arguments that export the intermediate probabilities in the given encoding.
+    ilastik cannot export float16, so only the encoding uint8 changes the export.
+
+    :param encoding: the encoding, see probability_encoding()
+    :return: list with ilastik arguments
+    """
+    if encoding == "uint8":
+        return ["--export_dtype=uint8", "--pipeline_result_drange=(0.0,1.0)", "--export_drange=(0,255)"]
+    return []
+
+
+def copy_probabilities(h5_output_data, h5_target, n=0, encoding="raw", dtype=None,
+                       block_budget=h5_copy.DEFAULT_BLOCK_BUDGET):
+    """Copies the probabilities of h5_output_data into the channels n, n+1, ... of h5_target. The probabilities are
+    scaled from the range of the output to the range of the encoding, see probability_encoding().
+
+    :param h5_output_data: h5py dataset with the probabilities
+    :param h5_target: h5py dataset
+    :param n: index of the first target channel
+    :param encoding: the encoding of the probabilities
+    :param dtype: dtype of the merged dataset (default: the dtype of h5_target)
+    :param block_budget: maximum number of bytes per copied block
+    """
+    if dtype is None:
+        dtype = h5_target.dtype
+    one = probability_encoding(dtype, encoding)[1]
+    scale = None
+    if one != output_one(h5_output_data.dtype):
+        scale = float(one) / output_one(h5_output_data.dtype)
+    dst_offset = (0,) * (len(h5_target.shape)-1) + (n,)
+    h5_copy.copy_dataset(h5_output_data, h5_target, dst_offset=dst_offset, scale=scale, budget=block_budget)
+
+
+def check_merge_datasets(h5_data, h5_output_data):
+    """Checks that the output data can be merged into the data. Both datasets must have the same axistags with the
+    channels in the last dimension and they must have the same shape, except for the number of channels.
+
+    :param h5_data: h5py dataset with the data
+    :param h5_output_data: h5py dataset with the output data
+    """
     # Check if the last dimension is used for the channels.
     if "axistags" not in h5_data.attrs or "axistags" not in h5_output_data.attrs:
         raise Exception("Dataset has no axistags.")
@@ -107,58 +346,505 @@ def merge_datasets(data0_path, data0_key, data1_path, data1_key, n=0, compressio
     if h5_data.shape[:-1] != h5_output_data.shape[:-1] or len(h5_data.shape) != len(h5_output_data.shape):
         raise Exception("Both datasets must have the same shape, except for the number of channels.")
 
+
+def merge_datasets(data0_path, data0_key, data1_path, data1_key, n=0, compression=None, mode="copy",
+                   move_output=True, encoding="raw", block_budget=h5_copy.DEFAULT_BLOCK_BUDGET):
+    """Merge data1 into data0, but keep the first n channels of data0. It is assumed, that the channels are in the last
+    dimension.
+
+    Merge modes:
+    "copy": The first n channels of data0 and the channels of data1 are copied into a new file that replaces data0.
+    "virtual": data0 is replaced by an HDF5 virtual dataset, see merge_datasets_virtual().
+    "inplace": The probability channels of data0 are overwritten in place, see merge_datasets_inplace().
+    :param data0_path: path to first h5 file
+    :param data0_key: h5 key of first file
+    :param data1_path: path to second h5 file
+    :param data1_key: h5 key of second file
+    :param n: number of channels to keep
+    :param compression: the compression
+    :param mode: the merge mode
+    :param move_output: whether the virtual merge may move data1 instead of referencing it in place
+    :param encoding: the encoding of the probabilities, see probability_encoding()
+    :param block_budget: maximum number of bytes per copied block
+    """
+    if mode == "copy":
+        merge_datasets_copy(data0_path, data0_key, data1_path, data1_key, n=n, compression=compression,
+                            encoding=encoding, block_budget=block_budget)
+    elif mode == "inplace":
+        merge_datasets_inplace(data0_path, data0_key, data1_path, data1_key, n=n, compression=compression,
+                               encoding=encoding, block_budget=block_budget)
+    elif mode == "virtual":
+        merge_datasets_virtual(data0_path, data0_key, data1_path, data1_key, n=n, compression=compression,
+                               move_output=move_output, encoding=encoding, block_budget=block_budget)
+    else:
+        raise Exception("Unknown merge mode: %s" % mode)
+
+
+def probability_change(data_path, data_key, output_path, output_key, n=0, encoding="raw",
+                       block_budget=h5_copy.DEFAULT_BLOCK_BUDGET):
+    """Compares the probability channels n, n+1, ... of the dataset (the probabilities of the previous autocontext
+    round) with the new probabilities in the ilastik output. The datasets are read blockwise, each block contains all
+    channels. The probabilities are scaled to [0, 1].
+
+    :param data_path: path to the h5 file of the dataset
+    :param data_key: h5 key of the dataset
+    :param output_path: path to the h5 file of the ilastik output
+    :param output_key: h5 key of the ilastik output
+    :param n: number of channels of the dataset that are no probabilities
+    :param encoding: the encoding of the probabilities in the dataset, see probability_encoding()
+    :param block_budget: maximum number of bytes per block
+    :return: tuple with the sum of the absolute changes of each class, the number of voxels whose most probable class
+             changed and the number of voxels; None if the dataset has no probability channels yet
+    """
+    with h5_copy.open_h5(data_path, "r", cache_bytes=block_budget) as f_data:
+        with h5_copy.open_h5(output_path, "r", cache_bytes=block_budget) as f_output:
+            h5_data = f_data[data_key]
+            h5_output = f_output[output_key]
+            check_merge_datasets(h5_data, h5_output)
+            channels = h5_output.shape[-1]
+            if h5_data.shape[-1] == n:
+                return None
+            if h5_data.shape[-1] != n + channels:
+                raise Exception("The dataset has %d probability channels, but the output has %d."
+                                % (h5_data.shape[-1] - n, channels))
+
+            # Each block contains all channels, so the most probable class can be found.
+            shape = h5_data.shape[:-1]
+            chunk_shapes = [None if c is None else c[:-1] for c in (h5_data.chunks, h5_output.chunks)]
+            block_shape = h5_copy.copy_block_shape(shape, 8 * channels, chunk_shapes, block_budget)
+            old_scale = 1.0 / probability_encoding(h5_data.dtype, encoding)[1]
+            new_scale = 1.0 / output_one(h5_output.dtype)
+
+            abs_sums = numpy.zeros(channels, dtype=numpy.float64)
+            flips = 0
+            for block in block_yielder.Blocking(shape, block_shape).yieldBlocks():
+                old = h5_data[tuple(block.slicing) + (slice(n, n+channels),)].astype(numpy.float64) * old_scale
+                new = h5_output[tuple(block.slicing) + (slice(None),)].astype(numpy.float64) * new_scale
+                abs_sums += numpy.abs(new - old).reshape(-1, channels).sum(axis=0)
+                flips += numpy.count_nonzero(numpy.argmax(old, axis=-1) != numpy.argmax(new, axis=-1))
+    return abs_sums, flips, int(numpy.prod(shape))
+
+
+def _run_job(job):
+    """Runs one job of run_jobs_parallel(). Errors are returned instead of raised, so they can be reported for each job.
+
+    :param job: tuple with function, job index, positional and keyword arguments
+    :return: tuple with job index, return value of the function, error message (None if successful) and duration in
+             seconds
+    """
+    func, index, args, kwargs = job
+    start = time.time()
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e:
+        return index, None, "%s: %s" % (type(e).__name__, e), time.time()-start
+    return index, result, None, time.time()-start
+
+
+def run_jobs_parallel(func, jobs, workers=1, callback=None):
+    """Calls func for all jobs, using a pool of worker processes.
+
+    :param func: module level function (it must be picklable)
+    :param jobs: list with tuples of positional and keyword arguments of func
+    :param workers: number of worker processes (1: run the jobs in this process)
+    :param callback: function that is called with job index, return value, error message (None if successful) and
+                     duration in seconds whenever a job is finished
+    :return: tuple with the list of return values and the list of error messages (None if successful)
+    """
+    indexed_jobs = [(func, i, args, kwargs) for i, (args, kwargs) in enumerate(jobs)]
+    results = [None] * len(jobs)
+    errors = [None] * len(jobs)
+    pool = None
+    if workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(workers, len(jobs)))
+        finished = pool.imap_unordered(_run_job, indexed_jobs)
+    else:
+        finished = itertools.imap(_run_job, indexed_jobs)
+    try:
+        for index, result, error, seconds in finished:
+            results[index] = result
+            errors[index] = error
+            if callback is not None:
+                callback(index, result, error, seconds)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return results, errors
+
+
+def merge_datasets_parallel(jobs, workers=1, callback=None):
+    """Runs merge_datasets() for all jobs, using a pool of worker processes.
+
+    :param jobs: list with tuples of positional and keyword arguments of merge_datasets()
+    :param workers: number of worker processes (1: merge in this process)
+    :param callback: function that is called with job index, error message (None if successful) and duration in seconds
+                     whenever a job is finished
+    :return: list with the error message of each job (None if successful)
+    """
+    job_callback = None
+    if callback is not None:
+        def job_callback(index, result, error, seconds):
+            callback(index, error, seconds)
+    return run_jobs_parallel(merge_datasets, jobs, workers, job_callback)[1]
+
+
+def ingest_dataset(filename, output_folder, compression=None, resizable=False,
+                   block_budget=h5_copy.DEFAULT_BLOCK_BUDGET):
+    """Copies the dataset into the output folder and reshapes it to tzyxc.
+
+    hdf5 datasets (filename of the form path/to/file.h5/key) are copied blockwise with reshape_tzyxc_blockwise(), so
+    the memory usage is bounded by the block budget. Images are read with vigra.readImage. If the data has no axistags,
+    the default axistags x, xy, xyz, xyzc or txyzc are used (in the order of the stored axes).
+    :param filename: path to image or hdf5 dataset
+    :param output_folder: the output folder
+    :param compression: the compression
+    :param resizable: whether the channel axis of the new dataset can be resized
+    :param block_budget: maximum number of bytes per block
+    :return: tuple with path and key of the new dataset, number of channels and number of bytes
+    """
+    default_tags = {1: "x",
+                    2: "xy",
+                    3: "xyz",
+                    4: "xyzc",
+                    5: "txyzc"}
+    if ".h5/" in filename or ".hdf5/" in filename:
+        data_key = os.path.basename(filename)
+        data_path = filename[:-len(data_key)-1]
+        output_path = os.path.join(output_folder, os.path.basename(data_path))
+        with h5_copy.open_h5(data_path, "r", cache_bytes=block_budget) as f_in:
+            h5_data = f_in[data_key]
+            if "axistags" in h5_data.attrs:
+                axistags = vigra.AxisTags.fromJSON(h5_data.attrs["axistags"])
+            else:
+                axistags = vigra.defaultAxistags(default_tags[len(h5_data.shape)])
+            with h5_copy.open_h5(output_path, "a", cache_bytes=block_budget) as f_out:
+                h5_new = reshape_tzyxc_blockwise(h5_data, f_out, data_key, axistags, compression=compression,
+                                                 resizable=resizable, block_budget=block_budget)
+                shape, itemsize = h5_new.shape, h5_new.dtype.itemsize
+    else:
+        data_key = const.default_export_key()
+        output_path = os.path.join(output_folder, os.path.splitext(os.path.basename(filename))[0] + ".h5")
+        data = vigra.readImage(filename)
+        if not hasattr(data, "axistags"):
+            data = vigra.VigraArray(data, axistags=vigra.defaultAxistags(default_tags[len(data.shape)]),
+                                    dtype=data.dtype)
+        new_data = reshape_tzyxc(data)
+        write_h5_array(new_data, output_path, data_key, compression=compression, resizable=resizable)
+        shape, itemsize = new_data.shape, new_data.dtype.itemsize
+    return output_path, data_key, shape[-1], int(numpy.prod(shape)) * itemsize
+
+
+def ingest_datasets_parallel(jobs, workers=1, callback=None):
+    """Runs ingest_dataset() for all jobs, using a pool of worker processes.
+
+    :param jobs: list with tuples of positional and keyword arguments of ingest_dataset()
+    :param workers: number of worker processes (1: ingest in this process)
+    :param callback: function that is called with job index, return value of ingest_dataset(), error message (None if
+                     successful) and duration in seconds whenever a job is finished
+    :return: tuple with the list of return values and the list of error messages (None if successful)
+    """
+    return run_jobs_parallel(ingest_dataset, jobs, workers, callback)
+
+
+def merge_datasets_copy(data0_path, data0_key, data1_path, data1_key, n=0, compression=None, resizable=False,
+                        encoding="raw", block_budget=h5_copy.DEFAULT_BLOCK_BUDGET):
+    """Merge data1 into data0 by copying the first n channels of data0 and the channels of data1 into a new file that
+    replaces data0.
+
+    :param data0_path: path to first h5 file
+    :param data0_key: h5 key of first file
+    :param data1_path: path to second h5 file
+    :param data1_key: h5 key of second file
+    :param n: number of channels to keep
+    :param compression: the compression
+    :param resizable: whether the channel axis of the merged dataset can be resized
+    :param encoding: the encoding of the probabilities, see probability_encoding()
+    :param block_budget: maximum number of bytes per copied block
+    """
+    # Get the data.
+    h5_data_file = h5_copy.open_h5(data0_path, "r", cache_bytes=block_budget)
+    h5_data = h5_data_file[data0_key]
+    h5_output_data_file = h5_copy.open_h5(data1_path, "r", cache_bytes=block_budget)
+    h5_output_data = h5_output_data_file[data1_key]
+    check_merge_datasets(h5_data, h5_output_data)
+
     # Create the h5 file for the merged dataset.
     merge_shape = h5_data.shape[:-1] + (n+h5_output_data.shape[-1],)
-    max_chunk_shape = (1, 100, 100, 100, 1)
-    chunk_shape = tuple(min(a, b) for a, b in zip(merge_shape, max_chunk_shape))
+    chunk_shape = default_chunk_shape(merge_shape)
+    maxshape = merge_shape[:-1] + (None,) if resizable else None
     temp_filepath = data0_path + "_TMP_"
-    h5_merged_file = h5py.File(temp_filepath, "w")
-    h5_merged_file.create_dataset(data0_key, shape=merge_shape, chunks=chunk_shape,
+    h5_merged_file = h5_copy.open_h5(temp_filepath, "w", cache_bytes=block_budget)
+    h5_merged_file.create_dataset(data0_key, shape=merge_shape, chunks=chunk_shape, maxshape=maxshape,
                                   compression=compression, dtype=h5_data.dtype)
     h5_merged = h5_merged_file[data0_key]
     h5_merged.attrs["axistags"] = h5_data.attrs["axistags"]
 
     # Copy the raw data to the merge dataset.
-    data_merge_shape = h5_data.shape[:-1] + (n,)
-    data_blocking = block_yielder.Blocking(data_merge_shape, chunk_shape)
-    for block in data_blocking.yieldBlocks():
-        slicing = tuple(block.slicing)
-        h5_merged[slicing] = h5_data[slicing]
+    h5_copy.copy_dataset(h5_data, h5_merged, shape=h5_data.shape[:-1] + (n,), budget=block_budget)
 
     # Copy the output data to the merge dataset.
-    round_probs = h5_data.dtype.kind in "ui"  # round the probabilities if the raw data is of integer type
-    output_data_blocking = block_yielder.Blocking(h5_output_data.shape, chunk_shape)
-    for block in output_data_blocking.yieldBlocks():
-        slicing = tuple(block.slicing)
-        tmp_s = slicing[-1]
-        s = slice(tmp_s.start + n, tmp_s.stop + n, tmp_s.step)
-        merge_slicing = slicing[:-1] + (s,)
-        if round_probs:
-            h5_merged[merge_slicing] = h5_output_data[slicing] * numpy.iinfo(h5_data.dtype).max
-        else:
-            h5_merged[merge_slicing] = h5_output_data[slicing]
+    copy_probabilities(h5_output_data, h5_merged, n, encoding=encoding, block_budget=block_budget)
 
-    # Close the files and rename them.
+    # Close the files and replace data0 in a single rename, so an interrupted merge leaves data0 intact.
     h5_merged_file.close()
     h5_data_file.close()
     h5_output_data_file.close()
-    os.remove(data0_path)
     os.rename(temp_filepath, data0_path)
 
 
+def merge_datasets_virtual(data0_path, data0_key, data1_path, data1_key, n=0, compression=None, move_output=True,
+                           encoding="raw", block_budget=h5_copy.DEFAULT_BLOCK_BUDGET):
+    """Merge data1 into data0 without copying the first n channels of data0.
+
+    On the first merge, the file data0_path is renamed to <data0>_raw.h5. Afterwards, data0 is an HDF5 virtual dataset
+    whose first n channels map to the raw data and whose remaining channels map to the probabilities of the latest
+    merge. The probabilities are stored in the dtype of the encoding (see probability_encoding()), the virtual dataset
+    converts them to the dtype of data0. If data1 already has that dtype, it is moved to <data0>_ctx<round>.h5 (or
+    referenced in place, if move_output is False), otherwise it is converted into that file once. The probabilities
+    of the previous merge are deleted.
+
+    Virtual datasets require h5py >= 2.9 and HDF5 >= 1.10, both in this script and in ilastik.
+    :param data0_path: path to first h5 file
+    :param data0_key: h5 key of first file
+    :param data1_path: path to second h5 file
+    :param data1_key: h5 key of second file
+    :param n: number of channels to keep
+    :param compression: the compression of converted probabilities
+    :param move_output: whether data1 may be moved instead of being referenced in place
+    :param encoding: the encoding of the probabilities
+    :param block_budget: maximum number of bytes per copied block
+    """
+    if not hasattr(h5py, "VirtualLayout"):
+        raise Exception("The virtual merge mode requires h5py >= 2.9.")
+    data0_base = os.path.splitext(os.path.abspath(data0_path))[0]
+    raw_path = data0_base + "_raw.h5"
+
+    # Read the state of the previous merge.
+    h5_data_file = h5py.File(data0_path, "r")
+    h5_data = h5_data_file[data0_key]
+    h5_output_data_file = h5py.File(data1_path, "r")
+    h5_output_data = h5_output_data_file[data1_key]
+    try:
+        check_merge_datasets(h5_data, h5_output_data)
+        dtype = h5_data.dtype
+        axistags = h5_data.attrs["axistags"]
+        output_shape = h5_output_data.shape
+        output_dtype = h5_output_data.dtype
+        is_virtual = h5_data.is_virtual
+        if is_virtual:
+            merge_round = int(h5_data.attrs["merge_round"]) + 1
+            old_probs_path = h5_data.attrs["probs_path"]
+            old_probs_owned = bool(h5_data.attrs["probs_owned"])
+        else:
+            merge_round = 0
+            old_probs_path = None
+            old_probs_owned = False
+    finally:
+        h5_data_file.close()
+        h5_output_data_file.close()
+
+    # On the first merge, the file with the raw data becomes the raw source of the virtual dataset.
+    if not is_virtual:
+        os.rename(data0_path, raw_path)
+    h5_raw_file = h5py.File(raw_path, "r")
+    raw_shape = h5_raw_file[data0_key].shape
+    h5_raw_file.close()
+    if raw_shape[-1] < n:
+        raise Exception("The raw data has less than %d channels." % n)
+
+    # Move, reference or convert the probabilities. An output of the encoded dtype already has the encoded range.
+    probs_dtype, one = probability_encoding(dtype, encoding)
+    if output_dtype == probs_dtype and output_one(output_dtype) == one:
+        if move_output:
+            probs_path = data0_base + "_ctx%d.h5" % merge_round
+            os.rename(data1_path, probs_path)
+            probs_owned = True
+        else:
+            probs_path = os.path.abspath(data1_path)
+            probs_owned = False
+    else:
+        probs_path = data0_base + "_ctx%d.h5" % merge_round
+        h5_output_data_file = h5_copy.open_h5(data1_path, "r", cache_bytes=block_budget)
+        h5_output_data = h5_output_data_file[data1_key]
+        h5_probs_file = h5_copy.open_h5(probs_path, "w", cache_bytes=block_budget)
+        h5_probs = h5_probs_file.create_dataset(data1_key, shape=output_shape, dtype=probs_dtype,
+                                                compression=compression, chunks=default_chunk_shape(output_shape))
+        copy_probabilities(h5_output_data, h5_probs, encoding=encoding, dtype=dtype, block_budget=block_budget)
+        h5_probs_file.close()
+        h5_output_data_file.close()
+        probs_owned = True
+
+    # Create the virtual dataset and replace data0.
+    merge_shape = raw_shape[:-1] + (n + output_shape[-1],)
+    spatial = (slice(None),) * (len(merge_shape) - 1)
+    raw_source = h5py.VirtualSource(raw_path, data0_key, shape=raw_shape)
+    probs_source = h5py.VirtualSource(probs_path, data1_key, shape=output_shape)
+    layout = h5py.VirtualLayout(shape=merge_shape, dtype=dtype)
+    layout[spatial + (slice(0, n),)] = raw_source[spatial + (slice(0, n),)]
+    layout[spatial + (slice(n, merge_shape[-1]),)] = probs_source
+    temp_filepath = data0_path + "_TMP_"
+    h5_merged_file = h5py.File(temp_filepath, "w")
+    h5_merged = h5_merged_file.create_virtual_dataset(data0_key, layout)
+    h5_merged.attrs["axistags"] = axistags
+    h5_merged.attrs["merge_round"] = merge_round
+    h5_merged.attrs["probs_path"] = probs_path
+    h5_merged.attrs["probs_owned"] = probs_owned
+    h5_merged_file.close()
+    os.rename(temp_filepath, data0_path)
+
+    # Remove the probabilities of the previous merge.
+    if old_probs_owned and old_probs_path != probs_path and os.path.isfile(old_probs_path):
+        os.remove(old_probs_path)
+
+
+def recover_virtual_merge(data0_path, data0_key, data1_path=None):
+    """Prepares redoing a virtual merge of data1 into data0 that was interrupted, see merge_datasets_virtual(). If the
+    first merge was interrupted after data0 was renamed, the rename is undone. If data1 was already moved to the
+    probabilities file of the interrupted merge, it is moved back.
+
+    :param data0_path: path to first h5 file
+    :param data0_key: h5 key of first file
+    :param data1_path: path to second h5 file (None if only data0 is recovered)
+    :return: True if the merge was already finished, so data1 is missing
+    :rtype: bool
+    """
+    data0_base = os.path.splitext(os.path.abspath(data0_path))[0]
+    if not os.path.isfile(data0_path) and os.path.isfile(data0_base + "_raw.h5"):
+        os.rename(data0_base + "_raw.h5", data0_path)
+    if data1_path is None or os.path.isfile(data1_path):
+        return False
+    is_virtual = False
+    merge_round = 0
+    if os.path.isfile(data0_path):
+        with h5py.File(data0_path, "r") as f:
+            is_virtual = f[data0_key].is_virtual
+            if is_virtual:
+                merge_round = int(f[data0_key].attrs["merge_round"]) + 1
+    probs_path = data0_base + "_ctx%d.h5" % merge_round
+    if os.path.isfile(probs_path):
+        os.rename(probs_path, data1_path)
+        return False
+    return is_virtual
+
+
+def merge_datasets_inplace(data0_path, data0_key, data1_path, data1_key, n=0, compression=None, encoding="raw",
+                           block_budget=h5_copy.DEFAULT_BLOCK_BUDGET):
+    """Merge data1 into data0 by overwriting the channels n, n+1, ... of data0 in place.
+
+    If the channel axis of data0 is not resizable, data0 is rewritten once with merge_datasets_copy(), so all further
+    merges are done in place.
+    :param data0_path: path to first h5 file
+    :param data0_key: h5 key of first file
+    :param data1_path: path to second h5 file
+    :param data1_key: h5 key of second file
+    :param n: number of channels to keep
+    :param compression: the compression that is used if data0 must be rewritten
+    :param encoding: the encoding of the probabilities, see probability_encoding()
+    :param block_budget: maximum number of bytes per copied block
+    """
+    h5_data_file = h5_copy.open_h5(data0_path, "r+", cache_bytes=block_budget)
+    h5_data = h5_data_file[data0_key]
+    h5_output_data_file = h5_copy.open_h5(data1_path, "r", cache_bytes=block_budget)
+    h5_output_data = h5_output_data_file[data1_key]
+    try:
+        check_merge_datasets(h5_data, h5_output_data)
+        resizable = h5_data.maxshape[-1] is None and not h5_data.is_virtual
+        if resizable:
+            if h5_data.shape[-1] < n:
+                raise Exception("The dataset has less than %d channels." % n)
+            merge_channels = n + h5_output_data.shape[-1]
+            if h5_data.shape[-1] != merge_channels:
+                h5_data.resize(merge_channels, axis=len(h5_data.shape)-1)
+            copy_probabilities(h5_output_data, h5_data, n, encoding=encoding, block_budget=block_budget)
+    finally:
+        h5_data_file.close()
+        h5_output_data_file.close()
+    if not resizable:
+        merge_datasets_copy(data0_path, data0_key, data1_path, data1_key, n=n, compression=compression, resizable=True,
+                            encoding=encoding, block_budget=block_budget)
+
+
+class ProjectMetadata(object):
+    """In-memory index of the metadata of an ilp project.
+
+    The index is filled with a single pass over the open project file. It contains the values of all datasets below
+    "Input Data/infos", the label names and the block slices of all label blocks (but not the label blocks themselves).
+    """
+
+    def __init__(self, proj):
+        if not isinstance(proj, h5py.File):
+            raise Exception("A valid h5py File object must be given.")
+
+        # Read all datasets of the lane infos.
+        self.values = {}
+        input_infos = eval_h5(proj, const.input_infos_list())
+        self.lanes = sorted(input_infos.keys())
+
+        def read_value(name, obj):
+            if isinstance(obj, h5py.Dataset):
+                self.values[const.input_infos() + "/" + name] = obj[()]
+        input_infos.visititems(read_value)
+
+        # Read the label names.
+        if const.label_names() in proj:
+            self.values[const.label_names()] = proj[const.label_names()][()]
+
+        # Read the block slices of the label blocks.
+        self.label_sets = {}
+        if const.label_sets() in proj:
+            label_sets = eval_h5(proj, const.label_sets_list())
+            for set_name, label_set in label_sets.items():
+                self.label_sets[set_name] = {block_name: block.attrs["blockSlice"]
+                                             for block_name, block in label_set.items()}
+
+    def value(self, h5_key):
+        """Returns the value of the dataset with the given h5 key.
+
+        :param h5_key: h5 key of the dataset
+        :return: value of the dataset
+        """
+        if h5_key not in self.values:
+            raise KeyError("The project metadata has no entry %s." % h5_key)
+        return self.values[h5_key]
+
+    def label_block_count(self, data_nr):
+        """Returns the number of label blocks of the dataset.
+
+        :param data_nr: number of dataset
+        :return: number of label blocks of the dataset
+        :rtype: int
+        """
+        set_name = const.labels_list(data_nr)[-1]
+        if set_name not in self.label_sets:
+            raise KeyError("The project has no label set %s." % set_name)
+        return len(self.label_sets[set_name])
+
+
 class ILP(object):
     """Provides basic interactions with ilp files.
+
+    The metadata of the project file (lane infos, label names, label block slices) is read once into a ProjectMetadata
+    snapshot. Every method that changes the project file invalidates the snapshot.
+
+    Metadata writes can be batched with the transaction() context manager.
     """
-    # TODO:
-    # Use joblib to cache the accesses of the h5 project file.
-    # https://pythonhosted.org/joblib/memory.html
 
-    def __init__(self, project_filename, output_folder, compression="lzf"):
+    def __init__(self, project_filename, output_folder, compression="lzf", merge_mode="copy",
+                 block_budget=h5_copy.DEFAULT_BLOCK_BUDGET, prob_encoding="raw"):
         self._project_filename = project_filename
         self._cache_folder = output_folder
         if not os.path.exists(output_folder):
             os.makedirs(output_folder)
         self._compression = compression
+        self._merge_mode = merge_mode
+        self._block_budget = block_budget
+        self._prob_encoding = prob_encoding
+        self._metadata = None
+        self._metadata_hits = 0
+        self._metadata_misses = 0
+        self._pending_writes = None
+        self._transaction_depth = 0
         # TODO:
         # Maybe check if the project exists and can be opened.
 
@@ -189,6 +875,140 @@ class ILP(object):
         """
         return self._cache_folder
 
+    @property
+    def compression(self):
+        """Returns the compression of the datasets in the cache folder.
+
+        :return: the compression
+        """
+        return self._compression
+
+    @property
+    def merge_mode(self):
+        """Returns the merge mode (see merge_datasets()).
+
+        :return: the merge mode
+        :rtype: str
+        """
+        return self._merge_mode
+
+    @property
+    def block_budget(self):
+        """Returns the maximum number of bytes per block that is copied or merged.
+
+        :return: the block budget
+        :rtype: int
+        """
+        return self._block_budget
+
+    @property
+    def prob_encoding(self):
+        """Returns the encoding of the probability channels (see probability_encoding()).
+
+        :return: the encoding
+        :rtype: str
+        """
+        return self._prob_encoding
+
+    @property
+    def metadata(self):
+        """Returns the metadata snapshot of the project file. The project file is only read if there is no valid
+        snapshot.
+
+        :return: metadata snapshot
+        :rtype: ProjectMetadata
+        """
+        if self._metadata is None:
+            self._metadata_misses += 1
+            proj = h5py.File(self.project_filename, "r")
+            try:
+                self._metadata = ProjectMetadata(proj)
+            finally:
+                proj.close()
+        else:
+            self._metadata_hits += 1
+        return self._metadata
+
+    @property
+    def metadata_cache_info(self):
+        """Returns the number of metadata accesses that were served from the snapshot (hits) and the number of times
+        the project file had to be read (misses).
+
+        :return: dict with the keys "hits" and "misses"
+        :rtype: dict
+        """
+        return {"hits": self._metadata_hits, "misses": self._metadata_misses}
+
+    def invalidate_metadata(self):
+        """Discards the metadata snapshot, so the next access reads the project file again.
+
+        This must be called whenever the project file is changed.
+        """
+        self._metadata = None
+
+    def _read_metadata(self, h5_key):
+        """Returns the value of the given h5 key from the metadata snapshot. Writes that are queued in a running
+        transaction are taken into account.
+
+        :param h5_key: h5 key of the dataset
+        :return: value of the dataset
+        """
+        if self._pending_writes is not None and h5_key in self._pending_writes:
+            return self._pending_writes[h5_key]
+        return self.metadata.value(h5_key)
+
+    def _write_metadata(self, h5_key, value):
+        """Writes the value to the given h5 key of the project file. Inside a transaction, the write is queued.
+
+        :param h5_key: h5 key of the dataset
+        :param value: the value
+        """
+        if self._pending_writes is not None:
+            self._pending_writes[h5_key] = value
+        else:
+            self._commit_writes({h5_key: value})
+
+    def _commit_writes(self, writes):
+        """Writes all given values into the project file, using a single file handle.
+
+        :param writes: dict with h5 keys and values
+        """
+        if len(writes) == 0:
+            return
+        proj = h5py.File(self.project_filename, "r+")
+        try:
+            for h5_key, value in writes.items():
+                write_h5_value(proj, h5_key, value)
+        finally:
+            proj.close()
+            self.invalidate_metadata()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Context manager that queues all metadata writes and commits them with a single open of the project file.
+
+        Transactions can be nested, the writes are committed when the outermost transaction ends. If an exception is
+        raised inside the transaction, the queued writes are discarded.
+
+        Example:
+            with project.transaction():
+                project.set_axisorder(0, "tzyxc")
+                project.set_axisorder(1, "tzyxc")
+        """
+        if self._transaction_depth == 0:
+            self._pending_writes = collections.OrderedDict()
+        self._transaction_depth += 1
+        success = False
+        try:
+            yield self
+            success = True
+        finally:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                writes, self._pending_writes = self._pending_writes, None
+                if success:
+                    self._commit_writes(writes)
+
     @property
     def data_count(self):
         """Returns the number of datasets inside the project file.
@@ -196,11 +1016,7 @@ class ILP(object):
         :return: number of datasets
         :rtype: int
         """
-        proj = h5py.File(self.project_filename, "r")
-        input_infos = eval_h5(proj, const.input_infos_list())
-        data_count = len(input_infos.keys())
-        proj.close()
-        return data_count
+        return len(self.metadata.lanes)
 
     @property
     def labelsets_count(self):
@@ -209,11 +1025,7 @@ class ILP(object):
         :return: number of label sets
         :rtype: int
         """
-        proj = h5py.File(self.project_filename, "r")
-        label_sets = eval_h5(proj, const.label_sets_list())
-        count = len(label_sets.keys())
-        proj.close()
-        return count
+        return len(self.metadata.label_sets)
 
     def get_data_path(self, data_nr):
         """Returns the file path of the dataset.
@@ -225,8 +1037,7 @@ class ILP(object):
         if self.is_internal(data_nr):
             return self.project_filename
         else:
-            h5_key = const.filepath(data_nr)
-            data_path = vigra.readHDF5(self.project_filename, h5_key)
+            data_path = self._read_metadata(const.filepath(data_nr))
             if self._datatype(data_nr) == "hdf5":
                 data_key = os.path.basename(data_path)
                 data_path = data_path[:-len(data_key)-1]
@@ -246,8 +1057,7 @@ class ILP(object):
         else:
             if self._datatype(data_nr) != "hdf5":
                 return const.default_export_key()
-            h5_key = const.filepath(data_nr)
-            data_path = vigra.readHDF5(self.project_filename, h5_key)
+            data_path = self._read_metadata(const.filepath(data_nr))
             data_key = os.path.basename(data_path)
         return data_key
 
@@ -270,8 +1080,18 @@ class ILP(object):
         :param new_key: new h5 key
         """
         rel_path = os.path.relpath(os.path.abspath(new_path), self.project_dir) + "/" + new_key
-        h5_key = const.filepath(data_nr)
-        vigra.writeHDF5(rel_path, self.project_filename, h5_key)
+        self._write_metadata(const.filepath(data_nr), rel_path)
+
+    def set_data_paths_from(self, other):
+        """Sets file paths and h5 keys of all datasets to the ones of the other project, which must have the same number
+        of datasets.
+
+        :param other: the other project
+        :type other: ILP
+        """
+        with self.transaction():
+            for i in xrange(other.data_count):
+                self.set_data_path_key(i, other.get_data_path(i), other.get_data_key(i))
 
     def get_data_location(self, data_nr):
         """Returns the data location (either "ProjectInternal" or "FileSystem").
@@ -280,9 +1100,7 @@ class ILP(object):
         :return: data location
         :rtype: str
         """
-        h5_key = const.datalocation(data_nr)
-        data_location = vigra.readHDF5(self.project_filename, h5_key)
-        return data_location
+        return self._read_metadata(const.datalocation(data_nr))
 
     def get_dataset_id(self, data_nr):
         """Returns the ilp dataset id.
@@ -291,9 +1109,7 @@ class ILP(object):
         :return: dataset id
         :rtype: str
         """
-        h5_key = const.datasetid(data_nr)
-        dataset_id = vigra.readHDF5(self.project_filename, h5_key)
-        return dataset_id
+        return self._read_metadata(const.datasetid(data_nr))
 
     def get_localdata_key(self, data_nr):
         """Returns the h5 key of the data that is stored inside the ilp file.
@@ -324,9 +1140,9 @@ class ILP(object):
         """
         h5_key = const.datalocation(data_nr)
         if val:
-            vigra.writeHDF5("ProjectInternal", self.project_filename, h5_key)
+            self._write_metadata(h5_key, "ProjectInternal")
         else:
-            vigra.writeHDF5("FileSystem", self.project_filename, h5_key)
+            self._write_metadata(h5_key, "FileSystem")
 
     def _datatype(self, data_nr):
         """Returns the data type of the given data. Valid data types are: "hdf5", "tiff", "bmp". If none of these types
@@ -335,8 +1151,7 @@ class ILP(object):
         :param data_nr: number of dataset
         :return: data type
         """
-        h5_key = const.filepath(data_nr)
-        data_path = vigra.readHDF5(self.project_filename, h5_key)
+        data_path = self._read_metadata(const.filepath(data_nr))
         if ".h5/" in data_path.lower() or ".hdf5/" in data_path.lower():
             return "hdf5"
         elif data_path[-4:].lower() == ".tif" or data_path[-5:].lower() == ".tiff":
@@ -363,7 +1178,7 @@ class ILP(object):
         :param data_nr: number of dataset
         :return: output dataset of ilastik
         """
-        return vigra.readHDF5(self._get_output_data_path(data_nr), const.default_export_key())
+        return vigra.readHDF5(self.get_output_data_path(data_nr), const.default_export_key())
 
     def get_cache_data_path(self, data_nr):
         """Returns the file path to the dataset copy in the cache folder.
@@ -381,7 +1196,7 @@ class ILP(object):
                 data_path = data_base + ".h5"
             return os.path.join(self.cache_folder, data_path)
 
-    def _get_output_data_path(self, data_nr):
+    def get_output_data_path(self, data_nr):
         """Returns the file path to the output file produced by ilastik.
 
         :param data_nr: number of dataset
@@ -420,7 +1235,7 @@ class ILP(object):
         :return: axisorder of dataset
         :rtype: str
         """
-        return vigra.readHDF5(self.project_filename, const.axisorder(data_nr))
+        return self._read_metadata(const.axisorder(data_nr))
 
     def set_axisorder(self, data_nr, new_axisorder):
         """Sets the axisorder of the dataset.
@@ -428,8 +1243,7 @@ class ILP(object):
         :param data_nr: number of dataset
         :param new_axisorder: new axisorder of dataset
         """
-        h5_key = const.axisorder(data_nr)
-        vigra.writeHDF5(new_axisorder, self.project_filename, h5_key)
+        self._write_metadata(const.axisorder(data_nr), new_axisorder)
 
     def get_axistags(self, data_nr):
         """Returns the axistags of the dataset as they are in the project file.
@@ -438,7 +1252,7 @@ class ILP(object):
         :return: axistags of dataset
         :rtype: str
         """
-        return vigra.readHDF5(self.project_filename, const.axistags(data_nr))
+        return self._read_metadata(const.axistags(data_nr))
 
     def set_axistags(self, data_nr, new_axistags):
         """Sets the axistags of the dataset (only in the project file, not in the dataset itself).
@@ -446,8 +1260,7 @@ class ILP(object):
         :param data_nr: number of dataset
         :param new_axistags: new axistags of dataset
         """
-        h5_key = const.axistags(data_nr)
-        vigra.writeHDF5(new_axistags, self.project_filename, h5_key)
+        self._write_metadata(const.axistags(data_nr), new_axistags)
 
     def _get_axistags_from_data(self, data_nr):
         """Returns the axistags of the dataset.
@@ -494,42 +1307,48 @@ class ILP(object):
         :return: number of label blocks of the dataset
         :rtype: int
         """
-        proj = h5py.File(self.project_filename, "r")
-        labels = ILP._h5_labels(proj, data_nr)
-        block_count = len(labels.keys())
-        proj.close()
-        return block_count
+        return self.metadata.label_block_count(data_nr)
 
     def get_labels(self, data_nr):
         """Returns the labels and their block slices of the dataset.
 
+        All blocks are read using a single handle of the project file.
         :param data_nr: number of dataset
         :return: labels and blockslices of the dataset
         :rtype: tuple
         """
-        # Read the label blocks.
-        block_count = self._label_block_count(data_nr)
-        blocks = [vigra.readHDF5(self.project_filename, const.label_blocks(data_nr, i))
-                  for i in range(block_count)]
-
-        # Read the block slices.
         proj = h5py.File(self.project_filename, "r")
-        block_slices = [eval_h5(proj, const.label_blocks_list(data_nr, i)).attrs['blockSlice']
-                        for i in range(block_count)]
-        proj.close()
+        try:
+            labels = ILP._h5_labels(proj, data_nr)
+            blocks = []
+            block_slices = []
+            for i in range(len(labels)):
+                h5_block = labels[const.label_blocks_list(data_nr, i)[-1]]
+                blocks.append(h5_block[()])
+                block_slices.append(h5_block.attrs["blockSlice"])
+        finally:
+            proj.close()
         return blocks, block_slices
 
     def remove_labels(self, data_nr=None):
         """Remove the label blocks of the given dataset from the project.
+
+        If data_nr is None, the label blocks of all datasets are removed.
+        :param data_nr: number of dataset
         """
         if data_nr is None:
-            for i in xrange(self.data_count):
-                self.remove_labels(i)
+            lanes = range(self.data_count)
         else:
-            proj = h5py.File(self.project_filename, "r+")
-            for i in range(self._label_block_count(data_nr)):
-                del_from_h5(proj, const.label_blocks_list(data_nr, i))
+            lanes = [data_nr]
+        proj = h5py.File(self.project_filename, "r+")
+        try:
+            for k in lanes:
+                labels = ILP._h5_labels(proj, k)
+                for block_name in list(labels.keys()):
+                    del labels[block_name]
+        finally:
             proj.close()
+            self.invalidate_metadata()
 
     def remove_internal_data(self):
         """Remove the internal data from the project.
@@ -547,31 +1366,45 @@ class ILP(object):
         :return: names of the labels of the dataset
         :rtype: numpy.ndarray
         """
-        return vigra.readHDF5(self.project_filename, const.label_names())
+        return self._read_metadata(const.label_names())
 
     def replace_labels(self, data_nr, blocks, block_slices, delete_old_blocks=True):
         """Replaces the labels and their block slices of the dataset.
 
+        All blocks are written using a single handle of the project file. Only the blocks whose contents or block
+        slices changed are written, existing blocks of the same shape and dtype are overwritten in place.
         :param data_nr: number of dataset
-        :param blocks: label blocks
+        :param blocks: label blocks (numpy arrays or labels.SparseLabelBlock objects)
         :param block_slices: block slices
-        :param delete_old_blocks: whether the old blocks in the project file shall be deleted
+        :param delete_old_blocks: whether the old blocks in the project file that are not replaced shall be deleted
+        :return: number of written blocks
+        :rtype: int
         """
         if len(blocks) != len(block_slices):
             raise Exception("The number of blocks and block slices must be the same.")
-        if not delete_old_blocks:
-            if len(blocks) != self._label_block_count(data_nr):
-                raise Exception("Wrong number of label blocks to be inserted.")
-
-        if delete_old_blocks:
-            self.remove_labels(data_nr)
 
         proj = h5py.File(self.project_filename, "r+")
-        for i in range(len(blocks)):
-            vigra.writeHDF5(blocks[i], self.project_filename, const.label_blocks(data_nr, i))
-            h5_blocks = eval_h5(proj, const.label_blocks_list(data_nr, i))
-            h5_blocks.attrs['blockSlice'] = block_slices[i]
-        proj.close()
+        try:
+            labels = ILP._h5_labels(proj, data_nr)
+            old_block_count = len(labels)
+            if not delete_old_blocks:
+                if len(blocks) != old_block_count:
+                    raise Exception("Wrong number of label blocks to be inserted.")
+
+            # Write the changed blocks.
+            written = 0
+            for i in range(len(blocks)):
+                block_name = const.label_blocks_list(data_nr, i)[-1]
+                if write_label_block(labels, block_name, blocks[i], block_slices[i]):
+                    written += 1
+
+            # Delete the old blocks that were not replaced.
+            for i in range(len(blocks), old_block_count):
+                del labels[const.label_blocks_list(data_nr, i)[-1]]
+        finally:
+            proj.close()
+            self.invalidate_metadata()
+        return written
 
     def _reshape_labels(self, data_nr, old_axisorder, new_axisorder):
         """Reshapes the label blocks and their slices.
@@ -630,66 +1463,137 @@ class ILP(object):
     def extend_data_tzyxc(self, data_nr=None):
         """Extends the dimension of the dataset and its labels to tzyxc.
 
-        If data_nr is None, all datasets are extended.
+        If data_nr is None, all datasets are extended. Each dataset is committed to the project file on its own, since
+        its labels are reshaped right after its metadata was written.
         :param data_nr: number of dataset
         """
         if data_nr is None:
             for i in range(self.data_count):
                 self.extend_data_tzyxc(i)
         else:
-            # Reshape the data with the correct axistags.
-            data = self.get_data(data_nr)
             axisorder = self.get_axisorder(data_nr)
-            if not hasattr(data, "axistags"):
-                data = vigra.VigraArray(data, axistags=vigra.defaultAxistags(axisorder), dtype=data.dtype)
-            new_data = reshape_tzyxc(data)
-
-            # Save the reshaped dataset.
             output_folder, output_filename = os.path.split(self.get_cache_data_path(data_nr))
             output_path = os.path.join(output_folder, str(data_nr).zfill(4) + "_" + output_filename)
             if self.is_internal(data_nr):
                 output_key = self.get_dataset_id(data_nr)
             else:
                 output_key = self.get_data_key(data_nr)
-            vigra.writeHDF5(new_data, output_path, output_key, compression=self._compression)
+            resizable = self._merge_mode == "inplace"
+
+            if self._datatype(data_nr) == "hdf5" or self.is_internal(data_nr):
+                # Stream the h5 dataset blockwise into the cache, so it does not have to fit into memory.
+                with h5_copy.open_h5(self.get_data_path(data_nr), "r", cache_bytes=self._block_budget) as f_in:
+                    h5_data = f_in[self.get_data_key(data_nr)]
+                    if "axistags" in h5_data.attrs:
+                        axistags = vigra.AxisTags.fromJSON(h5_data.attrs["axistags"])
+                    else:
+                        axistags = vigra.defaultAxistags(axisorder)
+                    with h5_copy.open_h5(output_path, "a", cache_bytes=self._block_budget) as f_out:
+                        reshape_tzyxc_blockwise(h5_data, f_out, output_key, axistags, compression=self._compression,
+                                                resizable=resizable, block_budget=self._block_budget)
+            else:
+                # Reshape the image with the correct axistags and save it.
+                data = self.get_data(data_nr)
+                if not hasattr(data, "axistags"):
+                    data = vigra.VigraArray(data, axistags=vigra.defaultAxistags(axisorder), dtype=data.dtype)
+                new_data = reshape_tzyxc(data)
+                write_h5_array(new_data, output_path, output_key, compression=self._compression, resizable=resizable)
 
             # Update the project file.
-            self.set_data_path_key(data_nr, output_path, output_key)
-            self._set_internal(data_nr, False)
-            self.set_axisorder(data_nr, "tzyxc")
-            self._set_axistags_from_data(data_nr)
+            with self.transaction():
+                self.set_data_path_key(data_nr, output_path, output_key)
+                self._set_internal(data_nr, False)
+                self.set_axisorder(data_nr, "tzyxc")
+                self._set_axistags_from_data(data_nr)
 
             # If the dataset has labels, reshape them.
             if self._label_block_count(data_nr) > 0:
                 self._reshape_labels(data_nr, axisorder, "tzyxc")
 
-    def retrain(self, ilastik_cmd):
+    def retrain(self, ilastik_cmd, worker=None):
         """Retrains the project using ilastik.
 
         :param ilastik_cmd: path to the file run_ilastik.sh
+        :param worker: persistent ilastik worker (see core.worker) that is used instead of a new ilastik process
         """
         cmd = [ilastik_cmd, "--headless", "--project=%s" % self.project_filename, "--retrain"]
-        subprocess.call(cmd, stdout=sys.stdout)
+        if worker is not None:
+            worker.retrain(cmd[1:])
+        else:
+            subprocess.call(cmd, stdout=sys.stdout)
+        self.invalidate_metadata()  # ilastik saves the retrained project
 
-    def predict_all_datasets(self, ilastik_cmd, predict_file=False):
-        """Predicts the probabilities of all datasets in the project.
+    def _predict_all_arguments(self, predict_file=False, filenames=None):
+        """Returns the ilastik command line arguments that export the probabilities of all datasets into the cache.
 
-        :param ilastik_cmd: path to the file run_ilastik.sh
         :param predict_file: if this is True, the --predict_file option of ilastik is used
+        :param filenames: h5 paths with keys of the predicted files (default: all datasets of the project)
+        :return: list with ilastik arguments
         """
+        if filenames is None:
+            filenames = [self.get_data_path_key(i) for i in range(self.data_count)]
         output_filename = os.path.join(self.cache_folder, "{nickname}_probs.h5")
-        cmd = [ilastik_cmd, "--headless", "--project=%s" % self.project_filename, "--output_format=hdf5",
-               "--output_filename_format=%s" % output_filename]
+        args = ["--output_format=hdf5", "--output_filename_format=%s" % output_filename]
+        args += ilastik_export_arguments(self._prob_encoding)
         if predict_file:
             pfile = os.path.join(self.cache_folder, "predict_file.txt")
             with open(pfile, "w") as f:
-                for i in range(self.data_count):
-                    f.write(self.get_data_path_key(i) + "\n")
-            cmd.append("--predict_file=%s" % pfile)
+                for filename in filenames:
+                    f.write(filename + "\n")
+            args.append("--predict_file=%s" % pfile)
         else:
-            for i in range(self.data_count):
-                cmd.append(self.get_data_path_key(i))
-        subprocess.call(cmd, stdout=sys.stdout)
+            args += filenames
+        return args
+
+    def predict_all_datasets(self, ilastik_cmd, predict_file=False, worker=None, filenames=None):
+        """Predicts the probabilities of all datasets in the project.
+
+        :param ilastik_cmd: path to the file run_ilastik.sh
+        :param predict_file: if this is True, the --predict_file option of ilastik is used
+        :param worker: persistent ilastik worker (see core.worker) that is used instead of a new ilastik process
+        :param filenames: h5 paths with keys of the predicted files (default: all datasets of the project); the
+                          outputs are written to the cache folder as {nickname}_probs.h5
+        """
+        cmd = [ilastik_cmd, "--headless", "--project=%s" % self.project_filename]
+        cmd += self._predict_all_arguments(predict_file, filenames)
+        if worker is not None:
+            worker.predict(cmd[1:])
+        else:
+            subprocess.call(cmd, stdout=sys.stdout)
+
+    def retrain_and_predict_all_datasets(self, ilastik_cmd, predict_file=False, worker=None, data_nrs=None):
+        """Retrains the project and predicts the probabilities of all datasets in a single ilastik call, so the project
+        is loaded and the features are computed only once.
+
+        Not all ilastik versions export the predictions when --retrain is given. The old outputs are removed before the
+        call, so it can be checked afterwards whether ilastik wrote the outputs of all datasets. If not, False is
+        returned and retrain() and predict_all_datasets() must be used instead.
+        :param ilastik_cmd: path to the file run_ilastik.sh
+        :param predict_file: if this is True, the --predict_file option of ilastik is used
+        :param worker: persistent ilastik worker (see core.worker) that is used instead of a new ilastik process
+        :param data_nrs: numbers of the predicted datasets (default: all datasets)
+        :return: whether ilastik wrote the outputs of all datasets
+        :rtype: bool
+        """
+        if data_nrs is None:
+            data_nrs = range(self.data_count)
+        output_paths = [self.get_output_data_path(i) for i in data_nrs]
+        for path in output_paths:
+            if os.path.isfile(path):
+                os.remove(path)
+        cmd = [ilastik_cmd, "--headless", "--project=%s" % self.project_filename, "--retrain"]
+        cmd += self._predict_all_arguments(predict_file, [self.get_data_path_key(i) for i in data_nrs])
+        success = True
+        if worker is not None:
+            try:
+                worker.retrain(cmd[1:])
+            except Exception as e:
+                print "The fused retrain and predict call failed:", e
+                success = False
+        else:
+            success = subprocess.call(cmd, stdout=sys.stdout) == 0
+        self.invalidate_metadata()  # ilastik saves the retrained project
+        return success and all(os.path.isfile(path) for path in output_paths)
 
     def predict_dataset(self, ilastik_cmd, data_nr):
         """Uses ilastik to predict the probabilities of the dataset.
@@ -702,6 +1606,7 @@ class ILP(object):
         data_path_key = self.get_data_path_key(data_nr)
         cmd = [ilastik_cmd, "--headless", "--project=%s" % self.project_filename, "--output_format=hdf5",
                "--output_filename_format=%s" % output_filename, data_path_key]
+        cmd += ilastik_export_arguments(self._prob_encoding)
         subprocess.call(cmd, stdout=sys.stdout)
 
     def predict(self, ilastik_cmd, input_filename, output_filename):
@@ -715,18 +1620,81 @@ class ILP(object):
                "--output_filename_format=%s" % output_filename, input_filename]
         subprocess.call(cmd, stdout=sys.stdout)
 
-    def merge_output_into_dataset(self, data_nr, n=0):
-        """Merges the ilastik output in the dataset. The first n channels of the dataset are left unchanged.
+    def _merge_arguments(self, data_nr, n=0):
+        """Returns the positional and keyword arguments of merge_datasets() that merge the ilastik output into the
+        dataset.
 
-        It is assumed, that extend_data_tzyxc() has been called, so the channels are in the last dimension.
         :param data_nr: number of dataset
         :param n: number of channels that are left unchanged
+        :return: tuple with positional and keyword arguments
         """
         filepath = self.get_data_path(data_nr)
         h5key = self.get_data_key(data_nr)
-        filepath_out = self._get_output_data_path(data_nr)
+        filepath_out = self.get_output_data_path(data_nr)
         h5key_out = const.default_export_key()
-        merge_datasets(filepath, h5key, filepath_out, h5key_out, n=n, compression=self._compression)
+        return (filepath, h5key, filepath_out, h5key_out), {"n": n, "compression": self._compression,
+                                                            "mode": self._merge_mode,
+                                                            "encoding": self._prob_encoding,
+                                                            "block_budget": self._block_budget}
+
+    def probability_changes(self, keep_channels, data_nrs=None, workers=1):
+        """Compares the probabilities in the datasets with the new ilastik outputs, see probability_change(). This must
+        be called before the outputs are merged into the datasets.
+
+        :param keep_channels: list with the number of channels that are no probabilities for each dataset
+        :param data_nrs: numbers of the datasets (default: all datasets)
+        :param workers: number of worker processes
+        :return: list with the results of probability_change() for each dataset
+        """
+        if data_nrs is None:
+            data_nrs = range(self.data_count)
+        jobs = [((self.get_data_path(k), self.get_data_key(k), self.get_output_data_path(k),
+                  const.default_export_key()), {"n": keep_channels[k], "encoding": self._prob_encoding,
+                                                "block_budget": self._block_budget})
+                for k in data_nrs]
+        results, errors = run_jobs_parallel(probability_change, jobs, workers)
+        for k, error in zip(data_nrs, errors):
+            if error is not None:
+                raise Exception("Comparing the probabilities of %s failed: %s" % (self.get_data_path_key(k), error))
+        return results
+
+    def recover_merges(self, data_nrs=None):
+        """Prepares redoing the merges of the ilastik outputs into the datasets after the merge was interrupted. Only
+        the virtual merge mode moves the outputs, so the other modes can simply merge again.
+
+        :param data_nrs: numbers of the datasets (default: all datasets)
+        :return: list with the numbers of the datasets whose merge was already finished
+        """
+        if data_nrs is None:
+            data_nrs = range(self.data_count)
+        if self._merge_mode != "virtual":
+            return []
+        return [k for k in data_nrs if recover_virtual_merge(self.get_data_path(k), self.get_data_key(k),
+                                                             self.get_output_data_path(k))]
+
+    def merge_output_into_dataset(self, data_nr, n=0):
+        """Merges the ilastik output in the dataset. The first n channels of the dataset are left unchanged.
+
+        It is assumed, that extend_data_tzyxc() has been called, so the channels are in the last dimension.
+        :param data_nr: number of dataset
+        :param n: number of channels that are left unchanged
+        """
+        args, kwargs = self._merge_arguments(data_nr, n)
+        merge_datasets(*args, **kwargs)
+
+    def merge_outputs_into_datasets(self, keep_channels, data_nrs=None, workers=1, callback=None):
+        """Merges the ilastik outputs into the datasets, using a pool of worker processes.
+
+        :param keep_channels: list with the number of channels that are left unchanged for each dataset
+        :param data_nrs: numbers of the datasets (default: all datasets)
+        :param workers: number of worker processes
+        :param callback: see merge_datasets_parallel()
+        :return: list with the error message of each dataset (None if successful)
+        """
+        if data_nrs is None:
+            data_nrs = range(self.data_count)
+        jobs = [self._merge_arguments(k, keep_channels[k]) for k in data_nrs]
+        return merge_datasets_parallel(jobs, workers=workers, callback=callback)
 
     def save(self, filename, remove_labels=False, remove_internal_data=False):
         """Save the project to the given file and adjust the relative filepaths in the copy.
@@ -739,11 +1707,9 @@ class ILP(object):
         shutil.copyfile(self.project_filename, filename)
 
         # Adjust the relative filepaths.
-        p = ILP(filename, self.cache_folder)
-        for i in xrange(self.data_count):
-            data_path = self.get_data_path(i)
-            data_key = self.get_data_key(i)
-            p.set_data_path_key(i, data_path, data_key)
+        p = ILP(filename, self.cache_folder, self._compression, self._merge_mode, self._block_budget,
+                self._prob_encoding)
+        p.set_data_paths_from(self)
 
         # Remove the labels.
         if remove_labels:
@@ -3,56 +3,129 @@ import math
 import random
 
 
-def scatter_labels_single_block(label_block, label_count, n, weights=None):
-    """Creates n blocks of the same size as label_block, where each block contains a subset of the original labels.
+def _layer_counts(count, weights):
+    """Returns how many of count labels are put into each layer.
 
-    The new blocks are a decomposition of the original block, meaning that they are pairwise disjoint and form the
-    original block when merged.
+    In each layer, the fraction weight / (sum of the remaining weights) of the remaining labels is taken (rounded up),
+    so the last layer takes all remaining labels.
+    :param count: number of labels
+    :param weights: weights of the layers
+    :return: list with the number of labels in each layer
+    """
+    counts = []
+    remaining = count
+    for k in range(len(weights)):
+        weight_factor = weights[k] / float(sum(weights[k:]))
+        c = min(remaining, int(math.ceil(remaining*weight_factor)))
+        counts.append(c)
+        remaining -= c
+    return counts
+
+
+def scatter_label_indices(label_block, label_count, n, weights=None, rng=None):
+    """Distributes the labelled voxels of label_block into n layers.
+
+    The labelled voxels are grouped by class in a single pass. For each class, one random permutation of its voxels is
+    split according to the weights. Each labelled voxel is assigned to exactly one layer, so the layers are pairwise
+    disjoint and together contain all labels of the block.
     :param label_block: label block
     :param label_count: number of labels inside the block
-    :param n: number of blocks
+    :param n: number of layers
     :param weights: weights how the labels are spread in the layers
-    :return: list label blocks, where each block contains a subset of the original labels
+    :param rng: random number generator with a permutation() method, e. g. numpy.random.RandomState (default: seeded
+                from the random module)
+    :return: list of length n, each item is a tuple with the flat indices into the block and the labels at those indices
     """
     # Create weights if none were given.
     if weights is None:
         weights = [1]*n
     if len(weights) < n:
         raise Exception("The number of weights is smaller than the number of layers.")
-    weights = weights[:n]
+    weights = list(weights[:n])
+    if rng is None:
+        rng = numpy.random.RandomState(random.getrandbits(32))
+
+    # Find the labelled voxels and group them by class.
+    flat_block = label_block.ravel()
+    indices = numpy.flatnonzero((flat_block > 0) & (flat_block <= label_count))
+    labels = flat_block[indices]
+    order = numpy.argsort(labels, kind="mergesort")
+    indices = indices[order]
+    labels = labels[order]
+    class_bounds = numpy.searchsorted(labels, numpy.arange(1, label_count+2))
+
+    # Assign the voxels of each class to the layers.
+    layers = numpy.empty(len(indices), dtype=numpy.intp)
+    for i in range(label_count):
+        begin, end = class_bounds[i], class_bounds[i+1]
+        counts = _layer_counts(end-begin, weights)
+        layers[begin + rng.permutation(end-begin)] = numpy.repeat(numpy.arange(n), counts)
+
+    # Group the voxels by layer.
+    order = numpy.argsort(layers, kind="mergesort")
+    layer_bounds = numpy.searchsorted(layers[order], numpy.arange(n+1))
+    return [(indices[order[layer_bounds[k]:layer_bounds[k+1]]], labels[order[layer_bounds[k]:layer_bounds[k+1]]])
+            for k in range(n)]
+
+
+class SparseLabelBlock(object):
+    """Label block that only stores its labelled voxels as flat indices and labels.
+    """
+
+    def __init__(self, shape, dtype, indices, labels):
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self.indices = indices
+        self.labels = labels
+
+    def todense(self):
+        """Returns the label block as numpy array.
 
-    # Find the label coordinates inside the block.
-    wh_list = [numpy.where(label_block == i+1) for i in range(label_count)]
-    available_list = [range(len(wh[0])) for wh in wh_list]
+        :return: label block
+        :rtype: numpy.ndarray
+        """
+        block = numpy.zeros(self.shape, dtype=self.dtype)
+        block.reshape(-1)[self.indices] = self.labels
+        return block
 
-    # Spread the labels.
-    scatter_blocks = []
-    for k in range(n):
-        # Create a new block to save the labels.
-        block = numpy.zeros(label_block.shape, dtype=label_block.dtype)
 
-        # Get the weight factor for the current run.
-        weight_factor = weights[0] / float(sum(weights))
-        weights.pop(0)
+def scatter_labels_single_block(label_block, label_count, n, weights=None, rng=None):
+    """Creates n blocks of the same size as label_block, where each block contains a subset of the original labels.
+
+    The new blocks are a decomposition of the original block, meaning that they are pairwise disjoint and form the
+    original block when merged.
+    :param label_block: label block
+    :param label_count: number of labels inside the block
+    :param n: number of blocks
+    :param weights: weights how the labels are spread in the layers
+    :param rng: random number generator, see scatter_label_indices()
+    :return: list label blocks, where each block contains a subset of the original labels
+    """
+    return [SparseLabelBlock(label_block.shape, label_block.dtype, indices, labels).todense()
+            for indices, labels in scatter_label_indices(label_block, label_count, n, weights, rng)]
 
-        for i in range(label_count):
-            # Choose a random sample of the available indices.
-            available_indices = available_list[i]
-            num_samples = int(math.ceil(len(available_indices)*weight_factor))
-            chosen_indices = random.sample(available_indices, num_samples)
 
-            # Remove the chosen indices from the available indices.
-            available_list[i] = list(numpy.delete(available_indices, chosen_indices))
-            # available_list[i] = [x for x in available_indices if x not in chosen_indices]
+def scatter_labels_sparse(label_blocks, label_count, n, weights=None, rng=None):
+    """Spread the labels of the given label blocks into n layers, like scatter_labels(), but return the layers as
+    SparseLabelBlock objects. The memory usage is proportional to the number of labelled voxels.
 
-            # Take the coordinates of the chosen indices in the block and put the current label there.
-            wh = tuple(w[chosen_indices] for w in wh_list[i])
-            block[wh] = i+1
-        scatter_blocks.append(block)
-    return scatter_blocks
+    :param label_blocks: list of label blocks
+    :param label_count: number of labels
+    :param n: number of layers
+    :param weights: weights how the labels are spread in the layers
+    :param rng: random number generator, see scatter_label_indices()
+    :return: list of length n, where each item is a list of sparse label blocks
+    """
+    if rng is None:
+        rng = numpy.random.RandomState(random.getrandbits(32))
+    return_list = [[] for _ in range(n)]
+    for block in label_blocks:
+        for i, (indices, labels) in enumerate(scatter_label_indices(block, label_count, n, weights, rng)):
+            return_list[i].append(SparseLabelBlock(block.shape, block.dtype, indices, labels))
+    return return_list
 
 
-def scatter_labels(label_blocks, label_count, n, weights=None):
+def scatter_labels(label_blocks, label_count, n, weights=None, rng=None):
     """Spread the labels of the given label blocks into n layers.
 
     If weights is None, the labels are equally spread.
@@ -60,6 +133,7 @@ def scatter_labels(label_blocks, label_count, n, weights=None):
     :param label_count: number of labels
     :param n: number of layers
     :param weights: weights how the labels are spread in the layers
+    :param rng: random number generator, see scatter_label_indices()
     :return: list of length n, where each item is a list of label blocks of the original size,
              but containing only a subset of the original labels
     """
@@ -68,11 +142,13 @@ def scatter_labels(label_blocks, label_count, n, weights=None):
         weights = [1]*n
     if len(weights) < n:
         raise Exception("The number of weights is smaller than the number of layers.")
+    if rng is None:
+        rng = numpy.random.RandomState(random.getrandbits(32))
 
     # Scatter the labels in each block.
     return_list = [[] for _ in range(n)]
     for block in label_blocks:
-        scatter_blocks = scatter_labels_single_block(block, label_count, n, weights)
+        scatter_blocks = scatter_labels_single_block(block, label_count, n, weights, rng)
         for i, b in enumerate(scatter_blocks):
             return_list[i].append(b)
     return return_list
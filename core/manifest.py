@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import time
+
+
+def file_sha1(path, block_size=2**20):
+    """Returns the sha1 hex digest of the file content.
+
+    :param path: path to the file
+    :param block_size: number of bytes that are read at once
+    :return: sha1 hex digest
+    :rtype: str
+    """
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def file_fingerprint(path):
+    """Returns size and modification time of the file. Other than file_sha1(), this does not read the file, so it can
+    be used for large datasets.
+
+    :param path: path to the file
+    :return: dict with size and modification time
+    :rtype: dict
+    """
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+class Manifest(object):
+    """Checkpoint manifest of the autocontext training.
+
+    The manifest is a json file in the cache folder that stores the settings of the training and, for each finished
+    round, the saved random forest file with its sha1 hash and the fingerprints of the merged datasets. It is replaced
+    atomically, so it always describes the last fully finished round. Before the ilastik outputs of a round are merged
+    into the datasets, a merge marker with the fingerprints of the outputs is stored, so a merge that was interrupted
+    can be redone.
+    """
+
+    def __init__(self, path):
+        """Loads the manifest if the file exists.
+
+        :param path: path to the manifest file
+        """
+        self.path = path
+        self._data = None
+        if os.path.isfile(path):
+            with open(path) as f:
+                self._data = json.load(f)
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    @property
+    def settings(self):
+        return self._data["settings"]
+
+    @property
+    def rounds(self):
+        return self._data["rounds"]
+
+    @property
+    def stopped(self):
+        """Returns the reason why the training was stopped before the last round (None if it was not stopped).
+        """
+        return self._data.get("stopped")
+
+    @property
+    def merging(self):
+        """Returns the merge marker of the round after the last finished round (None if no merge was started).
+        """
+        return self._data.get("merging")
+
+    def start(self, settings):
+        """Starts a new manifest with the given json serializable settings and no finished rounds.
+
+        :param settings: the settings
+        """
+        self._data = {"settings": settings, "rounds": []}
+        self._save()
+
+    def finish_round(self, rf_file, datasets, label_seed, change=None):
+        """Appends the round to the manifest and saves it.
+
+        :param rf_file: the random forest file that was saved in this round
+        :param datasets: list with the h5 paths and keys of the merged datasets
+        :param label_seed: seed of the label subsets
+        :param change: json serializable description of the change of the probabilities in this round
+        """
+        self._data["rounds"].append({"round": len(self._data["rounds"]),
+                                     "rf_file": rf_file,
+                                     "rf_sha1": file_sha1(rf_file),
+                                     "datasets": [dict(file_fingerprint(path), path=path, key=key)
+                                                  for path, key in datasets],
+                                     "label_seed": label_seed,
+                                     "change": change,
+                                     "finished": time.time()})
+        self._data.pop("merging", None)
+        self._save()
+
+    def start_merge(self, rf_file, datasets, outputs, change=None):
+        """Stores the merge marker of the round after the last finished round. It must be stored before the ilastik
+        outputs are merged into the datasets and is removed by finish_round().
+
+        :param rf_file: the random forest file that was saved in this round
+        :param datasets: list with the h5 paths and keys of the datasets that are modified by the merge
+        :param outputs: list with the paths of the ilastik outputs that are merged
+        :param change: see finish_round()
+        """
+        self._data["merging"] = {"round": len(self._data["rounds"]),
+                                 "rf_file": rf_file,
+                                 "rf_sha1": file_sha1(rf_file),
+                                 "datasets": [path for path, key in datasets],
+                                 "outputs": [dict(file_fingerprint(path), path=path) for path in outputs],
+                                 "change": change}
+        self._save()
+
+    def check_merge(self, merged_outputs=()):
+        """Checks that the files of the merge marker were not modified after the marker was stored, so the merge can be
+        redone.
+
+        :param merged_outputs: paths of the outputs that were already merged and may be missing
+        :return: list with the descriptions of the differences (empty if nothing was modified)
+        """
+        m = self.merging
+        problems = []
+        if not os.path.isfile(m["rf_file"]):
+            problems.append("%s is missing" % m["rf_file"])
+        elif file_sha1(m["rf_file"]) != m["rf_sha1"]:
+            problems.append("%s was modified" % m["rf_file"])
+        for d in m["outputs"]:
+            if not os.path.isfile(d["path"]):
+                if d["path"] not in merged_outputs:
+                    problems.append("%s is missing" % d["path"])
+            elif file_fingerprint(d["path"]) != {"size": d["size"], "mtime": d["mtime"]}:
+                problems.append("%s was modified" % d["path"])
+        return problems
+
+    def stop(self, reason):
+        """Marks the training as stopped after the last finished round, so a resumed training does not continue it.
+
+        :param reason: description why the training was stopped
+        """
+        self._data["stopped"] = reason
+        self._save()
+
+    def set_flag(self, name, datasets=None):
+        """Stores the flag with the given name, e. g. to mark a step after the last round as finished.
+
+        :param name: name of the flag
+        :param datasets: list with the h5 paths and keys of the datasets that were modified by the step; their
+                         fingerprints in the last round are updated
+        """
+        flags = self._data.setdefault("flags", [])
+        if name not in flags:
+            flags.append(name)
+        if datasets is not None and len(self._data["rounds"]) > 0:
+            paths = set(path for path, key in datasets)
+            for d in self._data["rounds"][-1]["datasets"]:
+                if d["path"] in paths:
+                    d.update(file_fingerprint(d["path"]))
+        self._save()
+
+    def has_flag(self, name):
+        """Returns whether the flag with the given name was stored.
+
+        :param name: name of the flag
+        :rtype: bool
+        """
+        return name in self._data.get("flags", [])
+
+    def check_round(self, index, exclude=()):
+        """Checks that the files of the given round were not modified after the round was finished.
+
+        :param index: round index
+        :param exclude: paths of datasets that are not checked, e. g. because an interrupted merge modified them
+        :return: list with the descriptions of the differences (empty if nothing was modified)
+        """
+        r = self.rounds[index]
+        problems = []
+        if not os.path.isfile(r["rf_file"]):
+            problems.append("%s is missing" % r["rf_file"])
+        elif file_sha1(r["rf_file"]) != r["rf_sha1"]:
+            problems.append("%s was modified" % r["rf_file"])
+        for d in r["datasets"]:
+            if d["path"] in exclude:
+                continue
+            if not os.path.isfile(d["path"]):
+                problems.append("%s is missing" % d["path"])
+            elif file_fingerprint(d["path"]) != {"size": d["size"], "mtime": d["mtime"]}:
+                problems.append("%s was modified" % d["path"])
+        return problems
+
+    def _save(self):
+        """Writes the manifest to a temporary file that replaces the manifest file.
+        """
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self._data, f, indent=1)
+        os.rename(temp_path, self.path)
@@ -0,0 +1,226 @@
+import json
+import os
+
+import numpy
+
+import block_yielder
+import h5_copy
+from ilp import default_chunk_shape, probability_encoding
+from roi import parse_block_slice
+
+
+# Name of the file in the cache folder that stores the pyramid settings of a training, so the batch prediction can
+# repeat them.
+SETTINGS_FILENAME = "pyramid.json"
+
+
+def save_settings(folder, coarse_rounds, factor):
+    """Writes the pyramid settings into the given cache folder. If there are no coarse rounds, an old settings file is
+    removed.
+
+    :param folder: the cache folder
+    :param coarse_rounds: number of rounds that run on the downsampled datasets
+    :param factor: downsampling factor of the axes z, y and x
+    """
+    path = os.path.join(folder, SETTINGS_FILENAME)
+    if coarse_rounds == 0:
+        if os.path.isfile(path):
+            os.remove(path)
+        return
+    with open(path, "w") as f:
+        json.dump({"coarse_rounds": coarse_rounds, "downsample": factor}, f)
+
+
+def load_settings(folder):
+    """Returns the pyramid settings that are stored in the given cache folder.
+
+    :param folder: the cache folder
+    :return: tuple with the number of coarse rounds and the downsampling factor ((0, 1) if there are no settings)
+    """
+    path = os.path.join(folder, SETTINGS_FILENAME)
+    if not os.path.isfile(path):
+        return 0, 1
+    with open(path) as f:
+        settings = json.load(f)
+    return settings["coarse_rounds"], settings["downsample"]
+
+
+def coarse_shape(shape, factor):
+    """Returns the shape of the downsampled tzyxc dataset. The axes t and c are not downsampled.
+
+    :param shape: shape of the dataset (tzyxc)
+    :param factor: downsampling factor of the axes z, y and x
+    :return: the shape
+    :rtype: tuple
+    """
+    return (shape[0],) + tuple(-(-s // factor) for s in shape[1:4]) + tuple(shape[4:])
+
+
+def _mean_pool(data, factor):
+    """Returns the means of the cells of factor**3 voxels of the tzyxc array. The cells at the upper borders may be
+    smaller.
+    """
+    data = numpy.asarray(data, dtype=numpy.float64)
+    for axis in (1, 2, 3):
+        starts = numpy.arange(0, data.shape[axis], factor)
+        counts = numpy.diff(numpy.append(starts, data.shape[axis]))
+        data = numpy.add.reduceat(data, starts, axis=axis)
+        count_shape = [1] * data.ndim
+        count_shape[axis] = len(counts)
+        data /= counts.reshape(count_shape)
+    return data
+
+
+def downsample_dataset(data_path, data_key, output_path, output_key, factor, n, compression=None, resizable=False,
+                       block_budget=h5_copy.DEFAULT_BLOCK_BUDGET):
+    """Writes the first n channels of the tzyxc dataset, downsampled by taking the mean of each cell of factor**3
+    voxels, into a new h5 file. The dataset is read blockwise, each output block is computed from the aligned input
+    cells.
+
+    :param data_path: path to the h5 file of the dataset
+    :param data_key: h5 key of the dataset
+    :param output_path: path of the new h5 file
+    :param output_key: h5 key of the downsampled dataset
+    :param factor: downsampling factor of the axes z, y and x
+    :param n: number of channels
+    :param compression: the compression
+    :param resizable: whether the channel axis of the downsampled dataset can be resized
+    :param block_budget: maximum number of bytes per block
+    """
+    with h5_copy.open_h5(data_path, "r", cache_bytes=block_budget) as f_in:
+        h5_data = f_in[data_key]
+        shape = coarse_shape(h5_data.shape[:-1] + (n,), factor)
+        maxshape = shape[:-1] + (None,) if resizable else None
+        with h5_copy.open_h5(output_path, "w", cache_bytes=block_budget) as f_out:
+            h5_coarse = f_out.create_dataset(output_key, shape=shape, dtype=h5_data.dtype, maxshape=maxshape,
+                                             chunks=default_chunk_shape(shape), compression=compression)
+            if "axistags" in h5_data.attrs:
+                h5_coarse.attrs["axistags"] = h5_data.attrs["axistags"]
+
+            # Each output voxel needs factor**3 input voxels as float64.
+            block_shape = h5_copy.copy_block_shape(shape, 8 * factor**3, (h5_coarse.chunks,), block_budget)
+            for block in block_yielder.Blocking(shape, block_shape).yieldBlocks():
+                source = [slice(block.begin[0], block.end[0])]
+                source += [slice(b * factor, min(e * factor, s)) for b, e, s in
+                           zip(block.begin[1:4], block.end[1:4], h5_data.shape[1:4])]
+                source += [slice(block.begin[4], block.end[4])]
+                data = _mean_pool(h5_data[tuple(source)], factor)
+                if h5_data.dtype.kind in "ui":
+                    data = numpy.round(data)
+                h5_coarse[tuple(block.slicing)] = data.astype(h5_data.dtype)
+
+
+def upsample_probabilities(coarse_path, coarse_key, data_path, data_key, n, output_path, output_key,
+                           factor, encoding="raw", block_budget=h5_copy.DEFAULT_BLOCK_BUDGET):
+    """Writes the probability channels n, n+1, ... of the downsampled dataset, upsampled to the shape of the full
+    resolution dataset by repeating each voxel factor times along the axes z, y and x, into a new h5 file. The new file
+    looks like an ilastik output (float32 probabilities with the axistags of the dataset), so it can be merged into the
+    dataset with merge_datasets(). The probabilities are decoded to [0, 1].
+
+    :param coarse_path: path to the h5 file of the downsampled dataset
+    :param coarse_key: h5 key of the downsampled dataset
+    :param data_path: path to the h5 file of the full resolution dataset
+    :param data_key: h5 key of the full resolution dataset
+    :param n: number of channels of the downsampled dataset that are no probabilities
+    :param output_path: path of the new h5 file
+    :param output_key: h5 key of the upsampled probabilities
+    :param factor: downsampling factor of the axes z, y and x
+    :param encoding: the encoding of the probabilities, see ilp.probability_encoding()
+    :param block_budget: maximum number of bytes per block
+    """
+    with h5_copy.open_h5(data_path, "r", cache_bytes=block_budget) as f_data:
+        data_shape = f_data[data_key].shape
+        axistags = f_data[data_key].attrs["axistags"]
+    with h5_copy.open_h5(coarse_path, "r", cache_bytes=block_budget) as f_in:
+        h5_coarse = f_in[coarse_key]
+        if h5_coarse.shape[:-1] != coarse_shape(data_shape, factor)[:-1]:
+            raise Exception("%s does not have the downsampled shape of %s." % (coarse_path, data_path))
+        scale = None
+        one = probability_encoding(h5_coarse.dtype, encoding)[1]
+        if one != 1:
+            scale = float(one)
+        shape = data_shape[:-1] + (h5_coarse.shape[-1] - n,)
+        with h5_copy.open_h5(output_path, "w", cache_bytes=block_budget) as f_out:
+            h5_output = f_out.create_dataset(output_key, shape=shape, dtype=numpy.float32,
+                                             chunks=default_chunk_shape(shape))
+            h5_output.attrs["axistags"] = axistags
+            block_shape = h5_copy.copy_block_shape(shape, 4, (h5_output.chunks,), block_budget)
+            for block in block_yielder.Blocking(shape, block_shape).yieldBlocks():
+                # Read the coarse voxels that cover the block, repeat them and crop the block.
+                begin = [b // factor for b in block.begin[1:4]]
+                end = [-(-e // factor) for e in block.end[1:4]]
+                source = [slice(block.begin[0], block.end[0])] + [slice(b, e) for b, e in zip(begin, end)]
+                source += [slice(n + block.begin[4], n + block.end[4])]
+                data = numpy.asarray(h5_coarse[tuple(source)], dtype=numpy.float32)
+                for axis in (1, 2, 3):
+                    data = numpy.repeat(data, factor, axis=axis)
+                crop = [slice(None)] + [slice(b - cb * factor, e - cb * factor) for b, e, cb in
+                                        zip(block.begin[1:4], block.end[1:4], begin)] + [slice(None)]
+                data = data[tuple(crop)]
+                if scale is not None:
+                    data /= scale
+                h5_output[tuple(block.slicing)] = data
+
+
+def downsample_labels(blocks, block_slices, factor):
+    """Downsamples the tzyxc label blocks by a majority vote of the labelled voxels in each cell of factor**3 voxels.
+    Cells without labelled voxels stay unlabelled, ties are won by the smaller label. If the block boundaries are not
+    aligned with the cells, neighbouring blocks share the boundary cells, so the votes of all blocks in a cell are
+    counted together.
+
+    :param blocks: label blocks (numpy arrays or labels.SparseLabelBlock objects)
+    :param block_slices: block slices of the label blocks
+    :param factor: downsampling factor of the axes z, y and x
+    :return: tuple with the downsampled label blocks and their block slices
+    """
+    blocks = [block.todense() if hasattr(block, "todense") else block for block in blocks]
+    labels = sorted(set(label for block in blocks for label in numpy.unique(block) if label != 0))
+
+    # Count the votes of each label in the cells of each block.
+    counts = []
+    begins = []
+    ends = []
+    for block, block_slice in zip(blocks, block_slices):
+        begin, end = parse_block_slice(block_slice)
+        coarse_begin = begin[:1] + [b // factor for b in begin[1:4]] + begin[4:]
+        coarse_end = end[:1] + [-(-e // factor) for e in end[1:4]] + end[4:]
+
+        # Pad the block with unlabelled voxels, so it is aligned with the cells.
+        pad = [(0, 0)] + [(b - cb * factor, ce * factor - e) for b, e, cb, ce in
+                          zip(begin[1:4], end[1:4], coarse_begin[1:4], coarse_end[1:4])] + [(0, 0)]
+        padded = numpy.pad(block, pad, mode="constant")
+        t, z, y, x, c = padded.shape
+        cells = padded.reshape(t, z // factor, factor, y // factor, factor, x // factor, factor, c)
+        cells = cells.transpose(0, 1, 3, 5, 7, 2, 4, 6).reshape(t, z // factor, y // factor, x // factor, c, -1)
+        count = numpy.zeros(cells.shape[:-1] + (len(labels),), dtype=numpy.int64)
+        for j, label in enumerate(labels):
+            count[..., j] = (cells == label).sum(axis=-1)
+        counts.append(count)
+        begins.append(coarse_begin)
+        ends.append(coarse_end)
+
+    # Add the votes of the other blocks in the shared cells.
+    begins = numpy.array(begins, dtype=numpy.int64).reshape(-1, 5)
+    ends = numpy.array(ends, dtype=numpy.int64).reshape(-1, 5)
+    totals = [count.copy() for count in counts]
+    for a in xrange(len(blocks)):
+        shared = numpy.all((begins < ends[a]) & (begins[a] < ends), axis=1)
+        shared[a] = False
+        for b in numpy.nonzero(shared)[0]:
+            overlap_begin = numpy.maximum(begins[a], begins[b])
+            overlap_end = numpy.minimum(ends[a], ends[b])
+            totals[a][tuple(slice(ob - ba, oe - ba) for ob, oe, ba in zip(overlap_begin, overlap_end, begins[a]))] += \
+                counts[b][tuple(slice(ob - bb, oe - bb) for ob, oe, bb in zip(overlap_begin, overlap_end, begins[b]))]
+
+    # Take the label with the most votes in each cell.
+    coarse_blocks = []
+    coarse_slices = []
+    for block, total, coarse_begin, coarse_end in zip(blocks, totals, begins, ends):
+        votes = numpy.zeros(total.shape[:-1], dtype=block.dtype)
+        if len(labels) > 0:
+            best = numpy.argmax(total, axis=-1)
+            voted = numpy.take(numpy.array(labels, dtype=block.dtype), best)
+            votes = numpy.where(total.max(axis=-1) > 0, voted, votes)
+        coarse_blocks.append(votes)
+        coarse_slices.append("[" + ",".join("%d:%d" % (b, e) for b, e in zip(coarse_begin, coarse_end)) + "]")
+    return coarse_blocks, coarse_slices
@@ -0,0 +1,48 @@
+import multiprocessing
+import os
+
+
+def cpu_count():
+    """Returns the number of cpus of the machine.
+
+    :return: number of cpus
+    :rtype: int
+    """
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def total_ram_mb():
+    """Returns the size of the physical memory of the machine in MB.
+
+    :return: memory size in MB (None if it cannot be determined)
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) // 1024
+    except IOError:
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2**20
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def lazyflow_environment(processes):
+    """Returns a copy of the environment where the lazyflow thread and memory limits are set to an equal share of the
+    machine for each of the given number of concurrent ilastik processes.
+
+    :param processes: number of concurrent ilastik processes
+    :return: the environment
+    :rtype: dict
+    """
+    env = dict(os.environ)
+    env["LAZYFLOW_THREADS"] = str(max(1, cpu_count() // processes))
+    ram_mb = total_ram_mb()
+    if ram_mb is not None:
+        env["LAZYFLOW_TOTAL_RAM_MB"] = str(max(1, ram_mb // processes))
+    return env
@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import h5py
+import numpy
+
+import block_yielder
+import h5_copy
+from manifest import file_sha1
+
+
+def dataset_sha1(filename, block_budget=h5_copy.DEFAULT_BLOCK_BUDGET):
+    """Returns the sha1 hex digest of the given input file of the batch prediction. For hdf5 datasets (filename of the
+    form path/to/file.h5/key), only the dataset and its axistags are hashed, see dataset_content_sha1(), so other
+    datasets in the same file do not change the digest.
+
+    :param filename: path to image or hdf5 dataset
+    :param block_budget: maximum number of bytes per block
+    :return: sha1 hex digest
+    :rtype: str
+    """
+    if ".h5/" in filename or ".hdf5/" in filename:
+        key = os.path.basename(filename)
+        path = filename[:-len(key)-1]
+        with h5py.File(path, "r") as f:
+            axistags = f[key].attrs.get("axistags", "")
+        return hashlib.sha1(dataset_content_sha1(path, key, block_budget) + "/" + axistags).hexdigest()
+    return file_sha1(filename)
+
+
+def dataset_content_sha1(path, key, block_budget=h5_copy.DEFAULT_BLOCK_BUDGET):
+    """Returns the sha1 hex digest of shape, dtype and values of the h5 dataset. Other than the hash of the file, this
+    does not depend on the chunking or compression of the dataset. The dataset is read blockwise, but the values are
+    hashed in C order, so the digest does not depend on the block budget either, see c_order_block_shape().
+
+    :param path: path to the h5 file
+    :param key: h5 key of the dataset
+    :param block_budget: maximum number of bytes per block
+    :return: sha1 hex digest
+    :rtype: str
+    """
+    sha1 = hashlib.sha1()
+    with h5_copy.open_h5(path, "r", cache_bytes=block_budget) as f:
+        h5_data = f[key]
+        sha1.update(str(h5_data.dtype) + str(h5_data.shape))
+        if all(s > 0 for s in h5_data.shape):
+            block_shape = c_order_block_shape(h5_data.shape, h5_data.dtype.itemsize, block_budget)
+            blocking = block_yielder.Blocking(h5_data.shape, block_shape)
+            for block in blocking.yieldBlocks():
+                sha1.update(numpy.ascontiguousarray(h5_data[tuple(block.slicing)]).tobytes())
+    return sha1.hexdigest()
+
+
+def c_order_block_shape(shape, itemsize, budget=h5_copy.DEFAULT_BLOCK_BUDGET):
+    """Returns the shape of blocks that cover all axes behind one split axis completely. The blocks of such a blocking
+    are numbered in C order, so reading them one after another yields the values of the dataset in C order.
+
+    The split axis is the first axis such that the axes behind it fit into the budget. Along the split axis, the block
+    is as large as the budget allows.
+    :param shape: shape of the dataset
+    :param itemsize: number of bytes per element
+    :param budget: maximum number of bytes per block
+    :return: block shape
+    :rtype: tuple
+    """
+    d = len(shape) - 1
+    tail = itemsize
+    while d > 0 and tail * shape[d] <= budget:
+        tail *= shape[d]
+        d -= 1
+    block = [1] * d + [max(1, min(shape[d], budget // tail))] + list(shape[d+1:])
+    return tuple(block)
+
+
+def _value_bytes(value):
+    """Returns the content of the hdf5 value as string. Object arrays (e. g. variable length strings) are converted with
+    repr(), since their raw bytes are pointers.
+    """
+    value = numpy.asarray(value)
+    if value.dtype.kind == "O":
+        return repr(value.tolist())
+    return numpy.ascontiguousarray(value).tobytes()
+
+
+def project_sha1(project_filename, exclude=("Input Data",), include=None):
+    """Returns the sha1 hex digest of the datasets and attributes in the ilastik project.
+
+    The groups in exclude are skipped. By default, this is the group with the lanes, since the batch prediction changes
+    the file paths of the lanes, but not the trained classifier.
+    :param project_filename: path to the ilastik project
+    :param exclude: names of the top level groups that are skipped
+    :param include: names of the top level groups that are hashed (None: all groups)
+    :return: sha1 hex digest
+    :rtype: str
+    """
+    sha1 = hashlib.sha1()
+
+    def update(name, obj):
+        group = name.split("/")[0]
+        if group in exclude or (include is not None and group not in include):
+            return
+        sha1.update(name)
+        for attr_name in sorted(obj.attrs.keys()):
+            sha1.update(attr_name)
+            sha1.update(_value_bytes(obj.attrs[attr_name]))
+        if isinstance(obj, h5py.Dataset):
+            sha1.update(str(obj.dtype) + str(obj.shape))
+            sha1.update(_value_bytes(obj[()]))
+
+    with h5py.File(project_filename, "r") as f:
+        names = []
+        f.visit(names.append)
+        for name in sorted(names):
+            update(name, f[name])
+    return sha1.hexdigest()
+
+
+def result_key(*parts):
+    """Returns the key of a cached result, which is the sha1 hex digest of the given strings.
+
+    :param parts: strings that determine the result, e. g. input hash, hash of the random forest stack and settings
+    :return: key
+    :rtype: str
+    """
+    return hashlib.sha1("\n".join(str(p) for p in parts)).hexdigest()
+
+
+def link_or_copy(src, dst):
+    """Creates a hard link of src at dst (an existing file at dst is replaced). If that is not possible, e. g. because
+    src and dst are on different file systems, src is copied.
+    """
+    if os.path.isfile(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class ResultCache(object):
+    """Content addressed cache for the results of the batch prediction.
+
+    The results are stored as files in the cache folder, named by their key. An index file stores the size and the last
+    usage of each result. If the total size exceeds the size limit, the least recently used results are removed.
+    Results are hard linked into and out of the cache, so they do not use additional space. Since a hard link shares
+    the file content, a linked output must be removed (not overwritten in place) before it is written again.
+    """
+
+    def __init__(self, folder, max_bytes=None):
+        """
+        :param folder: the cache folder
+        :param max_bytes: size limit in bytes (None: unlimited)
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self._index_path = os.path.join(folder, "index.json")
+        self._index = {}
+        if os.path.isfile(self._index_path):
+            with open(self._index_path) as f:
+                self._index = json.load(f)
+
+        # Forget the results whose files were removed.
+        for key in self._index.keys():
+            if not os.path.isfile(self._path(key)):
+                del self._index[key]
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + ".h5")
+
+    def _save(self):
+        temp_path = self._index_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self._index, f)
+        os.rename(temp_path, self._index_path)
+
+    @property
+    def size(self):
+        """Returns the total size of the cached results in bytes.
+        """
+        return sum(entry["size"] for entry in self._index.values())
+
+    def get(self, key, output_path):
+        """Links the cached result to the output path.
+
+        :param key: key of the result
+        :param output_path: the output path
+        :return: whether the result was in the cache
+        :rtype: bool
+        """
+        if key not in self._index:
+            return False
+        link_or_copy(self._path(key), output_path)
+        self._index[key]["last_used"] = time.time()
+        self._save()
+        return True
+
+    def put(self, key, output_path):
+        """Links the output into the cache and removes the least recently used results if the size limit is exceeded.
+
+        :param key: key of the result
+        :param output_path: path of the result
+        """
+        link_or_copy(output_path, self._path(key))
+        self._index[key] = {"size": os.path.getsize(output_path), "last_used": time.time()}
+        if self.max_bytes is not None:
+            for old_key in sorted(self._index.keys(), key=lambda k: self._index[k]["last_used"]):
+                if self.size <= self.max_bytes or old_key == key:
+                    break
+                os.remove(self._path(old_key))
+                del self._index[old_key]
+        self._save()
@@ -0,0 +1,182 @@
+import math
+import os
+
+import h5py
+import numpy
+
+import block_yielder
+import h5_copy
+from ilp import default_chunk_shape, output_one, probability_encoding
+
+
+# Ratio of the radius of the largest feature filter and its scale. The Gaussian filters of vigra are cut off at three
+# times the scale, the additional half covers the derivative filters.
+FILTER_WINDOW_RATIO = 3.5
+
+
+def feature_halo(project_filename):
+    """Returns the radius of the largest selected feature filter of the ilastik project, rounded up.
+
+    :param project_filename: path to the ilastik project
+    :return: the radius in pixels
+    :rtype: int
+    """
+    with h5py.File(project_filename, "r") as f:
+        if "FeatureSelections/Scales" not in f or "FeatureSelections/SelectionMatrix" not in f:
+            raise Exception("The project %s has no feature selection." % project_filename)
+        scales = numpy.asarray(f["FeatureSelections/Scales"][()], dtype=numpy.float64)
+        selection = numpy.asarray(f["FeatureSelections/SelectionMatrix"][()], dtype=bool)
+    selected = scales[selection.any(axis=0)]
+    if len(selected) == 0:
+        return 0
+    return int(math.ceil(FILTER_WINDOW_RATIO * selected.max()))
+
+
+def parse_block_slice(block_slice):
+    """Returns begin and end of the block slice of a label block (e. g. "[0:1,10:20,0:64,0:64,0:1]").
+
+    :param block_slice: the block slice
+    :return: tuple with begin and end
+    """
+    begin, end = zip(*[[int(x) for x in s.split(":")] for s in block_slice[1:-1].split(",")])
+    return list(begin), list(end)
+
+
+def label_boxes(blocks, block_slices):
+    """Returns the bounding boxes of the labelled voxels of each label block. The channel axis is not included.
+
+    :param blocks: label blocks (numpy arrays)
+    :param block_slices: block slices of the label blocks
+    :return: list with begin and end of each box
+    """
+    boxes = []
+    for block, block_slice in zip(blocks, block_slices):
+        labelled = numpy.asarray(block).reshape(block.shape[:-1] + (-1,)).any(axis=-1)
+        if not labelled.any():
+            continue
+        begin, end = parse_block_slice(block_slice)
+        coords = numpy.nonzero(labelled)
+        boxes.append(([b + int(c.min()) for b, c in zip(begin, coords)],
+                      [b + int(c.max()) + 1 for b, c in zip(begin, coords)]))
+    return boxes
+
+
+def merge_boxes(boxes):
+    """Replaces overlapping boxes by their bounding box until no boxes overlap.
+
+    :param boxes: list with begin and end of each box
+    :return: list with begin and end of the merged boxes
+    """
+    boxes = [(list(b), list(e)) for b, e in boxes]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i+1, len(boxes)):
+                (b0, e0), (b1, e1) = boxes[i], boxes[j]
+                if all(x0 < y1 and x1 < y0 for x0, y0, x1, y1 in zip(b0, e0, b1, e1)):
+                    boxes[i] = ([min(x, y) for x, y in zip(b0, b1)], [max(x, y) for x, y in zip(e0, e1)])
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
+
+
+def roi_blocks(shape, boxes, halo, rounds_left):
+    """Returns the regions that are predicted in an intermediate autocontext round.
+
+    The probabilities of a round must be correct wherever the features of the following rounds at the labelled voxels
+    depend on them. Each following round adds the halo of the largest feature filter, so the inner block is the label
+    box grown by rounds_left * halo. ilastik needs the halo around the inner block to compute the features, so the
+    outer block is predicted and only the inner block is merged. The margin is only added to the axes z, y and x.
+    :param shape: shape of the dataset (tzyx, without channels)
+    :param boxes: label boxes, see label_boxes()
+    :param halo: radius of the largest feature filter
+    :param rounds_left: number of following rounds that use the probabilities
+    :return: list with block_yielder.BlockWithMargin objects
+    """
+    blocking = block_yielder.Blocking(shape, shape)
+    margin = [0] + [halo * rounds_left] * (len(shape)-1)
+    inner_boxes = []
+    for begin, end in boxes:
+        grown = block_yielder.Block(begin, end, blocking).blockWithMargin(margin).outerBlock
+        inner_boxes.append((grown.begin, grown.end))
+    margin = [0] + [halo] * (len(shape)-1)
+    return [block_yielder.Block(begin, end, blocking).blockWithMargin(margin) for begin, end in merge_boxes(inner_boxes)]
+
+
+def write_roi_dataset(data_path, data_key, block, roi_path, block_budget=h5_copy.DEFAULT_BLOCK_BUDGET):
+    """Copies the outer block of the region (with all channels) into a new h5 file.
+
+    :param data_path: path to the h5 file of the dataset
+    :param data_key: h5 key of the dataset
+    :param block: the region
+    :type block: block_yielder.BlockWithMargin
+    :param roi_path: path of the new h5 file, the dataset gets the same key
+    :param block_budget: maximum number of bytes per copied block
+    """
+    outer = block.outerBlock
+    with h5_copy.open_h5(data_path, "r", cache_bytes=block_budget) as f_in:
+        h5_data = f_in[data_key]
+        shape = tuple(e - b for b, e in zip(outer.begin, outer.end)) + (h5_data.shape[-1],)
+        with h5_copy.open_h5(roi_path, "w", cache_bytes=block_budget) as f_out:
+            h5_roi = f_out.create_dataset(data_key, shape=shape, dtype=h5_data.dtype, chunks=default_chunk_shape(shape))
+            h5_roi.attrs["axistags"] = h5_data.attrs["axistags"]
+            h5_copy.copy_dataset(h5_data, h5_roi, src_offset=tuple(outer.begin) + (0,), shape=shape,
+                                 budget=block_budget)
+
+
+def merge_roi_outputs(data_path, data_key, outputs, n, channels, compression=None, encoding="raw",
+                      block_budget=h5_copy.DEFAULT_BLOCK_BUDGET):
+    """Merges the ilastik outputs of the regions into the channels n, n+1, ... of the dataset. Only the inner blocks of
+    the regions are written.
+
+    If the dataset does not have n+channels channels, its channel axis is resized, or, if it is not resizable, the
+    dataset is rewritten once with the first n channels and zeros in the probability channels.
+    :param data_path: path to the h5 file of the dataset
+    :param data_key: h5 key of the dataset
+    :param outputs: list with tuples of ilastik output path, output key and region (block_yielder.BlockWithMargin)
+    :param n: number of channels to keep
+    :param channels: number of probability channels
+    :param compression: the compression that is used if the dataset is rewritten
+    :param encoding: the encoding of the probabilities, see ilp.probability_encoding()
+    :param block_budget: maximum number of bytes per copied block
+    """
+    # Add the probability channels.
+    with h5_copy.open_h5(data_path, "r+", cache_bytes=block_budget) as f:
+        h5_data = f[data_key]
+        rewrite = h5_data.shape[-1] != n + channels and h5_data.maxshape[-1] is not None
+        if h5_data.shape[-1] != n + channels and not rewrite:
+            h5_data.resize(n + channels, axis=len(h5_data.shape)-1)
+    if rewrite:
+        temp_path = data_path + "_TMP_"
+        with h5_copy.open_h5(data_path, "r", cache_bytes=block_budget) as f_in:
+            h5_data = f_in[data_key]
+            shape = h5_data.shape[:-1] + (n + channels,)
+            with h5_copy.open_h5(temp_path, "w", cache_bytes=block_budget) as f_out:
+                h5_new = f_out.create_dataset(data_key, shape=shape, dtype=h5_data.dtype,
+                                              chunks=default_chunk_shape(shape), compression=compression)
+                h5_new.attrs["axistags"] = h5_data.attrs["axistags"]
+                h5_copy.copy_dataset(h5_data, h5_new, shape=h5_data.shape[:-1] + (n,), budget=block_budget)
+        os.rename(temp_path, data_path)
+
+    # Copy the inner blocks.
+    with h5_copy.open_h5(data_path, "r+", cache_bytes=block_budget) as f:
+        h5_data = f[data_key]
+        one = probability_encoding(h5_data.dtype, encoding)[1]
+        for output_path, output_key, block in outputs:
+            with h5_copy.open_h5(output_path, "r", cache_bytes=block_budget) as f_output:
+                h5_output = f_output[output_key]
+                if h5_output.shape[-1] != channels:
+                    raise Exception("%s has %d channels, expected %d." % (output_path, h5_output.shape[-1], channels))
+                scale = None
+                if one != output_one(h5_output.dtype):
+                    scale = float(one) / output_one(h5_output.dtype)
+                inner = block.innerBlock
+                local = block.localInnerBlock
+                h5_copy.copy_dataset(h5_output, h5_data, src_offset=tuple(local.begin) + (0,),
+                                     dst_offset=tuple(inner.begin) + (n,),
+                                     shape=tuple(e - b for b, e in zip(inner.begin, inner.end)) + (channels,),
+                                     scale=scale, budget=block_budget)
@@ -0,0 +1,99 @@
+import hashlib
+import os
+import shutil
+
+import numpy
+
+from result_cache import link_or_copy
+
+
+def label_subset_sha1(lanes):
+    """Returns the sha1 hex digest of the label subset of one autocontext round.
+
+    :param lanes: list with tuples (number of dataset, label blocks, block slices), where the label blocks are
+                  labels.SparseLabelBlock objects
+    :return: sha1 hex digest
+    :rtype: str
+    """
+    sha1 = hashlib.sha1()
+    for data_nr, blocks, block_slices in lanes:
+        sha1.update("lane %d\n" % data_nr)
+        for block, block_slice in zip(blocks, block_slices):
+            sha1.update("%s %s %s\n" % (block_slice, block.shape, block.dtype))
+            sha1.update(numpy.ascontiguousarray(block.indices, dtype=numpy.int64).tobytes())
+            sha1.update(numpy.ascontiguousarray(block.labels).tobytes())
+    return sha1.hexdigest()
+
+
+class RoundCache(object):
+    """Stores the results of autocontext training rounds, so a new training with the same inputs can skip them.
+
+    Each round is stored in a folder that is named by the key of the round. It contains the saved random forest file,
+    the project file after the retraining and the merged datasets. The key of a round should be computed from the key
+    of the previous round and the inputs of the round, so a stored round implies that all previous rounds were the same.
+    The folder of a round is written under a temporary name and renamed when it is complete.
+    """
+
+    def __init__(self, folder, link=False):
+        """
+        :param folder: the cache folder
+        :param link: if this is True, the datasets are hard linked instead of copied; this must only be used if the
+                     datasets are replaced and not modified in place by the merge
+        """
+        self.folder = folder
+        self.link = link
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def _path(self, key):
+        return os.path.join(self.folder, key)
+
+    def has(self, key):
+        """Returns whether the round with the given key is stored.
+
+        :param key: key of the round
+        :rtype: bool
+        """
+        return os.path.isdir(self._path(key))
+
+    def _transfer(self, src, dst):
+        if self.link:
+            link_or_copy(src, dst)
+        else:
+            shutil.copyfile(src, dst)
+
+    def store(self, key, rf_file, project_file, datasets):
+        """Stores the round.
+
+        :param key: key of the round
+        :param rf_file: the random forest file that was saved in the round
+        :param project_file: the project file
+        :param datasets: list with the paths of the merged dataset files
+        """
+        if self.has(key):
+            return
+        temp_path = self._path(key) + ".tmp"
+        if os.path.isdir(temp_path):
+            shutil.rmtree(temp_path)
+        os.makedirs(temp_path)
+        shutil.copyfile(rf_file, os.path.join(temp_path, "rf.ilp"))
+        shutil.copyfile(project_file, os.path.join(temp_path, "project.ilp"))
+        for i, path in enumerate(datasets):
+            self._transfer(path, os.path.join(temp_path, "data_%s.h5" % str(i).zfill(4)))
+        os.rename(temp_path, self._path(key))
+
+    def restore(self, key, rf_file, project_file, datasets):
+        """Copies the files of the stored round to the given paths. The file paths of the lanes inside the project
+        files still refer to the datasets of the training that stored the round, so they must be set again.
+
+        :param key: key of the round
+        :param rf_file: target path of the random forest file
+        :param project_file: target path of the project file (None: the project file is not restored)
+        :param datasets: list with the target paths of the merged dataset files
+        """
+        path = self._path(key)
+        shutil.copyfile(os.path.join(path, "rf.ilp"), rf_file)
+        if project_file is not None:
+            shutil.copyfile(os.path.join(path, "project.ilp"), project_file)
+        for i, dataset_path in enumerate(datasets):
+            self._transfer(os.path.join(path, "data_%s.h5" % str(i).zfill(4)), dataset_path)
@@ -0,0 +1,164 @@
+import json
+import os
+import Queue
+import threading
+import time
+
+
+class Wavefront(object):
+    """Schedules the autocontext stages of many files, so each file advances to the next stage as soon as its own
+    previous stage is finished, independent of the other files.
+
+    Each stage of a file consists of a prediction step and (except for the last stage) a merge step. The progress of
+    all files is saved in a json file after each step, so an interrupted run can be resumed.
+    """
+
+    def __init__(self, state_path, names, stage_count):
+        """Loads the state file. If it does not exist or belongs to other files or another number of stages, all files
+        start at the first stage.
+
+        :param state_path: path to the json state file
+        :param names: names of the files
+        :param stage_count: number of stages
+        """
+        self.state_path = state_path
+        self._lock = threading.Lock()
+        state = None
+        if os.path.isfile(state_path):
+            with open(state_path) as f:
+                state = json.load(f)
+            if state.get("names") != list(names) or state.get("stage_count") != stage_count:
+                state = None
+        if state is None:
+            state = {"names": list(names),
+                     "stage_count": stage_count,
+                     "files": [{"stage": 0, "predicted": False, "info": None} for _ in names]}
+        self._state = state
+
+    @property
+    def file_count(self):
+        return len(self._state["files"])
+
+    @property
+    def stage_count(self):
+        return self._state["stage_count"]
+
+    def stage(self, index):
+        """Returns the number of finished stages of the file.
+
+        :param index: file index
+        :return: number of finished stages
+        :rtype: int
+        """
+        return self._state["files"][index]["stage"]
+
+    def started(self, index):
+        """Returns whether a step of the file was already finished.
+
+        :param index: file index
+        :return: whether the file was started
+        :rtype: bool
+        """
+        f = self._state["files"][index]
+        return f["stage"] > 0 or f["predicted"]
+
+    def info(self, index):
+        """Returns the information that was stored with set_info().
+
+        :param index: file index
+        :return: the information (None if nothing was stored)
+        """
+        return self._state["files"][index]["info"]
+
+    def set_info(self, index, info):
+        """Stores json serializable information about the file in the state file.
+
+        :param index: file index
+        :param info: the information
+        """
+        with self._lock:
+            self._state["files"][index]["info"] = info
+            self._save()
+
+    def _save(self):
+        """Writes the state to a temporary file that replaces the state file, so the state file is always complete.
+        """
+        temp_path = self.state_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self._state, f)
+        os.rename(temp_path, self.state_path)
+
+    def _next_step(self, index):
+        """Returns the next step ("predict" or "merge") of the file and None if all stages are finished.
+        """
+        f = self._state["files"][index]
+        if f["stage"] >= self.stage_count:
+            return None
+        if f["predicted"]:
+            return "merge"
+        return "predict"
+
+    def _finish_step(self, index, step):
+        """Marks the step as finished and saves the state.
+        """
+        with self._lock:
+            f = self._state["files"][index]
+            if step == "predict" and f["stage"] < self.stage_count-1:
+                f["predicted"] = True
+            else:
+                f["stage"] += 1
+                f["predicted"] = False
+            self._save()
+
+    def run(self, predict, merge, workers=1, callback=None):
+        """Runs the remaining steps of all files, using at most the given number of threads at the same time.
+
+        Files that are further advanced are preferred, so finished files are available as early as possible. If a step
+        fails, the other files are continued.
+        :param predict: function that is called with file index and stage to run the prediction
+        :param merge: function that is called with file index and stage to merge the prediction into the file
+        :param workers: maximum number of steps that run at the same time
+        :param callback: function that is called with file index, stage, step, error message (None if successful) and
+                         duration in seconds whenever a step is finished
+        :return: list with the error message of each file (None if successful)
+        """
+        results = Queue.Queue()
+
+        def work(index, stage, step):
+            start = time.time()
+            try:
+                if step == "predict":
+                    predict(index, stage)
+                else:
+                    merge(index, stage)
+            except Exception as e:
+                results.put((index, stage, step, "%s: %s" % (type(e).__name__, e), time.time()-start))
+                return
+            results.put((index, stage, step, None, time.time()-start))
+
+        errors = [None] * self.file_count
+        pending = [i for i in xrange(self.file_count) if self._next_step(i) is not None]
+        running = 0
+        while len(pending) > 0 or running > 0:
+            while len(pending) > 0 and running < workers:
+                index = pending.pop(0)
+                thread = threading.Thread(target=work, args=(index, self.stage(index), self._next_step(index)))
+                thread.daemon = True
+                thread.start()
+                running += 1
+
+            # Wait with a timeout, so the main thread can be interrupted.
+            try:
+                index, stage, step, error, seconds = results.get(True, 1)
+            except Queue.Empty:
+                continue
+            running -= 1
+            if error is None:
+                self._finish_step(index, step)
+                if self._next_step(index) is not None:
+                    pending.insert(0, index)
+            else:
+                errors[index] = error
+            if callback is not None:
+                callback(index, stage, step, error, seconds)
+        return errors
@@ -0,0 +1,165 @@
+import argparse
+import json
+import os
+import subprocess
+
+import h5py
+import numpy
+import vigra
+
+import ilp_constants as const
+
+
+class IlastikWorker(object):
+    """Keeps one headless ilastik process alive, so the ilastik imports are done only once.
+
+    ilastik is started with the option --worker, which requires the patched ilastik.py and ilastik_worker.py from the
+    folder ilastik_mods. The commands are sent as json lines over a pipe.
+    """
+
+    def __init__(self, ilastik_cmd, env=None):
+        """Starts the worker process.
+
+        :param ilastik_cmd: path to the file run_ilastik.sh
+        :param env: environment of the worker process (default: the current environment)
+        """
+        self._process = subprocess.Popen([ilastik_cmd, "--worker"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         env=env, close_fds=True)
+
+    def _call(self, command, args=None):
+        """Sends the command to the worker and waits for the reply.
+
+        :param command: the command
+        :param args: ilastik command line arguments
+        """
+        if self._process is None:
+            raise Exception("The ilastik worker was closed.")
+        request = {"command": command}
+        if args is not None:
+            request["args"] = list(args)
+        try:
+            self._process.stdin.write(json.dumps(request) + "\n")
+            self._process.stdin.flush()
+        except IOError:
+            raise Exception("The ilastik worker is not running.")
+        # Skip the lines that are printed before the worker redirects stdout (e. g. by run_ilastik.sh or by the
+        # ilastik imports).
+        reply = None
+        while reply is None:
+            line = self._process.stdout.readline()
+            if len(line) == 0:
+                raise Exception("The ilastik worker exited with code %s." % self._process.wait())
+            if not line.lstrip().startswith("{"):
+                continue
+            try:
+                reply = json.loads(line)
+            except ValueError:
+                raise Exception("ilastik worker: invalid reply: %s" % line.strip())
+        if reply.get("status") != "ok":
+            raise Exception("ilastik worker: %s" % reply.get("message"))
+
+    def retrain(self, args):
+        """Retrains the project.
+
+        :param args: ilastik command line arguments (without the ilastik command)
+        """
+        self._call("retrain", args)
+
+    def predict(self, args):
+        """Runs the batch prediction.
+
+        :param args: ilastik command line arguments (without the ilastik command)
+        """
+        self._call("predict", args)
+
+    def reload(self):
+        """Closes the project that is currently opened by the worker.
+        """
+        self._call("reload")
+
+    def close(self):
+        """Stops the worker process.
+        """
+        if self._process is not None:
+            try:
+                self._call("quit")
+            except Exception:
+                self._process.kill()
+            self._process.wait()
+            self._process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class LocalWorker(object):
+    """Worker with the interface of IlastikWorker that runs without ilastik, e. g. to test the autocontext.
+
+    predict() writes the uniform probability 1/(number of labels) for each input file. retrain() only writes the
+    probabilities if fused is True and input files are given.
+    """
+
+    def __init__(self, fused=True):
+        """
+        :param fused: whether retrain() also exports the predictions (like ilastik versions that support --retrain
+                      together with input files)
+        """
+        self.fused = fused
+        self.calls = []
+
+    def retrain(self, args):
+        self.calls.append(("retrain", list(args)))
+        if self.fused and any(a.startswith("--output_filename_format") for a in args):
+            self._export(args)
+
+    def predict(self, args):
+        self.calls.append(("predict", list(args)))
+        self._export(args)
+
+    def _export(self, args):
+        """Writes the uniform probabilities for the input files in the ilastik command line arguments.
+        """
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--project", type=str, required=True)
+        parser.add_argument("--output_filename_format", type=str, required=True)
+        parser.add_argument("--output_internal_path", type=str, default=const.default_export_key())
+        parser.add_argument("--predict_file", type=str)
+        parsed_args, other_args = parser.parse_known_args(args)
+        filenames = [a for a in other_args if not a.startswith("--")]
+        if parsed_args.predict_file is not None:
+            with open(parsed_args.predict_file) as f:
+                filenames += [l.strip() for l in f if len(l.strip()) > 0]
+
+        # Get the number of labels.
+        with h5py.File(parsed_args.project, "r") as f:
+            label_count = len(f[const.label_names()])
+
+        project_dir = os.path.dirname(os.path.abspath(parsed_args.project))
+        for filename in filenames:
+            key = os.path.basename(filename)
+            path = filename[:-len(key)-1]
+            if not os.path.isabs(path) and not os.path.isfile(path):
+                path = os.path.join(project_dir, path)
+            with h5py.File(path, "r") as f:
+                shape = f[key].shape
+            nickname = os.path.splitext(os.path.basename(path))[0]
+            output_path = parsed_args.output_filename_format.replace("{nickname}", nickname)
+            with h5py.File(output_path, "w") as f:
+                probs = numpy.full(shape[:-1] + (label_count,), 1.0 / label_count, dtype=numpy.float32)
+                h5_probs = f.create_dataset(parsed_args.output_internal_path, data=probs)
+                h5_probs.attrs["axistags"] = vigra.defaultAxistags("tzyxc").toJSON()
+
+    def reload(self):
+        self.calls.append(("reload", []))
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
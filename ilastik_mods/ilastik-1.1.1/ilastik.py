@@ -21,6 +21,7 @@
 #		   http://ilastik.org/license.html
 ###############################################################################
 
+import sys
 import ilastik_main
 
 # Special command-line control over default tmp dir
@@ -28,6 +29,12 @@ import ilastik.monkey_patches
 ilastik.monkey_patches.extend_arg_parser(ilastik_main.parser)
 
 def main():
+    if "--worker" in sys.argv:
+        # Keep ilastik alive and read the commands from stdin (see ilastik_worker.py).
+        import ilastik_worker
+        ilastik_worker.serve(main)
+        return
+
     parsed_args, workflow_cmdline_args = ilastik_main.parser.parse_known_args()
     
     # allow to start-up by double-clicking an '.ilp' file
@@ -56,7 +63,7 @@ def main():
     #parsed_args.project='/Users/bergs/MyProject.ilp'
     #parsed_args.headless = True
 
-    ilastik_main.main(parsed_args, workflow_cmdline_args)
+    return ilastik_main.main(parsed_args, workflow_cmdline_args)
 
 if __name__ == "__main__":
     # Examples:
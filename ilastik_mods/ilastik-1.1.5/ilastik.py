@@ -59,6 +59,13 @@ def main():
         ilastik_dir = os.path.abspath(os.path.join(this_path, "..%s.." % os.path.sep))
         _clean_paths( ilastik_dir )
 
+    if "--worker" in sys.argv:
+        # Keep ilastik alive and read the commands from stdin (see ilastik_worker.py). The paths
+        # are cleaned first, since the commands of the worker do not contain --clean_paths.
+        import ilastik_worker
+        ilastik_worker.serve(main)
+        return
+
     import ilastik_main
     parsed_args, workflow_cmdline_args = ilastik_main.parser.parse_known_args()
 
@@ -88,7 +95,7 @@ def main():
     #parsed_args.headless = True
     #os.environ["LAZYFLOW_THREADS"] = "0"
 
-    ilastik_main.main(parsed_args, workflow_cmdline_args)
+    return ilastik_main.main(parsed_args, workflow_cmdline_args)
 
 if __name__ == "__main__":
     # Examples:
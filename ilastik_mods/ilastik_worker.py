@@ -0,0 +1,78 @@
+"""
+Persistent headless ilastik worker for the autocontext.
+
+Copy this file next to the patched ilastik.py (see ilastik_mods/ilastik-1.1.X) and start ilastik with the option
+--worker. The worker imports ilastik only once and then reads one json command per line from stdin:
+
+* {"command": "retrain", "args": [...]}: retrain the project (args are the ilastik command line arguments)
+* {"command": "predict", "args": [...]}: run the batch prediction
+* {"command": "reload"}: close the currently opened project
+* {"command": "quit"}: stop the worker
+
+For each command, one json reply {"status": "ok"} or {"status": "error", "message": "..."} is written to stdout.
+Everything that is printed by ilastik is redirected to stderr, so it does not interfere with the replies.
+"""
+import json
+import os
+import sys
+import traceback
+
+
+def serve(main):
+    """Runs the worker loop.
+
+    :param main: the main function of ilastik.py, it is called with the command line arguments of each command in
+                 sys.argv and returns the ilastik shell
+    """
+    # Keep the original stdout for the replies and redirect everything else to stderr.
+    sys.stdout.flush()
+    reply_file = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    program = sys.argv[0]
+    shell = [None]
+
+    def reply(**kwargs):
+        reply_file.write(json.dumps(kwargs) + "\n")
+        reply_file.flush()
+
+    def close_project():
+        if shell[0] is not None and hasattr(shell[0], "closeCurrentProject"):
+            shell[0].closeCurrentProject()
+        shell[0] = None
+
+    for line in iter(sys.stdin.readline, ""):
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        try:
+            request = json.loads(line)
+            command = request.get("command")
+            if command in ["retrain", "predict"]:
+                args = [a for a in request.get("args", []) if a != "--worker"]
+                if command == "retrain" and "--retrain" not in args:
+                    args.append("--retrain")
+                close_project()
+                sys.argv = [program] + args
+                try:
+                    shell[0] = main()
+                except SystemExit as e:
+                    if e.code not in [None, 0]:
+                        raise Exception("ilastik exited with code %s." % e.code)
+                finally:
+                    sys.argv = [program, "--worker"]
+
+                # Close the project, so it can be modified by the autocontext before the next command.
+                close_project()
+            elif command == "reload":
+                close_project()
+            elif command == "quit":
+                close_project()
+                reply(status="ok")
+                break
+            else:
+                raise Exception("Unknown command: %s" % command)
+        except Exception as e:
+            traceback.print_exc()
+            reply(status="error", message="%s: %s" % (type(e).__name__, e))
+        else:
+            reply(status="ok")